@@ -8,7 +8,9 @@ admin.site.register(Airport)
 admin.site.register(TransitionAirport)
 admin.site.register(Flight)
 admin.site.register(FlightDetail)
+admin.site.register(FlightFare)
 admin.site.register(TicketClass)
 admin.site.register(Ticket)
 admin.site.register(Reservation)
-admin.site.register(Policy)
\ No newline at end of file
+admin.site.register(Policy)
+admin.site.register(RevenueRollup)
\ No newline at end of file
@@ -1,7 +1,42 @@
 from .models import *
 from django.db.models.query import QuerySet
 
-class TicketClassDAO:
+class BulkDAOMixin:
+    #Model handled by the DAO, set by each DAO
+    model = None
+
+    #Save many objects with one INSERT per batch
+    #   (save() is not called and no signal is sent)
+    def bulk_create(self, objs: list, batch_size: int = None) -> list:
+        return self.model.objects.bulk_create(objs, batch_size = batch_size)
+
+    #Update the given fields of many objects with one UPDATE per batch
+    #   (save() is not called and no signal is sent), return the number of rows matched
+    def bulk_update(self, objs: list, fields: list, batch_size: int = None) -> int:
+        return self.model.objects.bulk_update(objs, fields, batch_size = batch_size)
+
+    #Delete an object with the given id, return the number of rows deleted (cascades included)
+    #   Only models without cascades nor delete signals (TransitionAirport, Reservation) are deleted
+    #   with a single DELETE. Others (Flight, Ticket, Airport, Customer, TicketClass, Policy) are
+    #   loaded with the rows they cascade to, and deleted with their signals so seat counters,
+    #   rollups and caches stay right: one query per related table, plus the queries of the signals.
+    def delete(self, id: int) -> int:
+        deleted, _ = self.model.objects.filter(pk = id).delete()
+        if not deleted:
+            raise self.model.DoesNotExist(f'{self.model.__name__} {id} does not exist.')
+        return deleted
+
+    #Find the objects with the given ids in one query, as an id -> object map
+    def find_many(self, ids: list) -> dict:
+        return self.model.objects.in_bulk(ids)
+
+    #Iterate over every object, reading chunk_size rows at a time instead of caching them all
+    def stream_all(self, chunk_size: int = 2000):
+        return self.model.objects.all().iterator(chunk_size = chunk_size)
+
+class TicketClassDAO(BulkDAOMixin):
+    model = TicketClass
+
     def __init__(self):
         #do nothing
         pass
@@ -17,12 +52,6 @@ class TicketClassDAO:
         ticketClass.save()
         return ticketClass
 
-    #Delete a ticket class with the given id
-    def delete(self, id: int) -> int:
-        ticketClass = TicketClass.objects.get(pk = id)
-        ticketClass.delete()
-        return 0
-    
     #Find a ticket class with the given id
     def find(self, id: int) -> TicketClass:
         ticketClass = TicketClass.objects.get(pk = id)
@@ -33,7 +62,9 @@ class TicketClassDAO:
         ticketClasses = TicketClass.objects.all()
         return ticketClasses
 
-class CustomerDAO:
+class CustomerDAO(BulkDAOMixin):
+    model = Customer
+
     def __init__(self):
         #do nothing
         pass
@@ -49,12 +80,6 @@ class CustomerDAO:
         customer.save()
         return customer
 
-    #Delete a customer with the given id
-    def delete(self, id: int) -> int:
-        customer = Customer.objects.get(pk = id)
-        customer.delete()
-        return 0
-    
     #Find a customer with the given id
     def find(self, id: int) -> Customer:
         customer = Customer.objects.get(pk = id)
@@ -66,7 +91,9 @@ class CustomerDAO:
         customers = Customer.objects.all()
         return customers
 
-class AirportDAO:
+class AirportDAO(BulkDAOMixin):
+    model = Airport
+
     def __init__(self):
         #do nothing
         pass
@@ -82,12 +109,6 @@ class AirportDAO:
         airport.save()
         return airport
 
-    #Delete a airport with the given id
-    def delete(self, id: int) -> int:
-        airport = Airport.objects.get(pk = id)
-        airport.delete()
-        return 0
-    
     #Find a airport with the given id
     def find(self, id: int) -> Airport:
         airport = Airport.objects.get(pk = id)
@@ -98,7 +119,9 @@ class AirportDAO:
         airports = Airport.objects.all()
         return airports
 
-class TransitionAirportDAO:
+class TransitionAirportDAO(BulkDAOMixin):
+    model = TransitionAirport
+
     def __init__(self):
         #do nothing
         pass
@@ -114,12 +137,6 @@ class TransitionAirportDAO:
         transitionAirport.save()
         return transitionAirport
 
-    #Delete a transition airport with the given id
-    def delete(self, id: int) -> int:
-        transitionAirport = TransitionAirport.objects.get(pk = id)
-        transitionAirport.delete()
-        return 0
-    
     #Find a transition airport with the given id
     def find(self, id: int) -> TransitionAirport:
         transitionAirport = TransitionAirport.objects.get(pk = id)
@@ -130,7 +147,9 @@ class TransitionAirportDAO:
         transitionAirports = TransitionAirport.objects.all()
         return transitionAirports
 
-class TicketDAO:
+class TicketDAO(BulkDAOMixin):
+    model = Ticket
+
     def __init__(self):
         #do nothing
         pass
@@ -146,12 +165,6 @@ class TicketDAO:
         ticket.save()
         return ticket
 
-    #Delete a ticket with the given id
-    def delete(self, id: int) -> int:
-        ticket = Ticket.objects.get(pk = id)
-        ticket.delete()
-        return 0
-    
     #Find a ticket with the given id
     def find(self, id: int) -> Ticket:
         ticket = Ticket.objects.get(pk = id)
@@ -162,7 +175,9 @@ class TicketDAO:
         tickets = Ticket.objects.all()
         return tickets
 
-class ReservationDAO:
+class ReservationDAO(BulkDAOMixin):
+    model = Reservation
+
     def __init__(self):
         #do nothing
         pass
@@ -178,12 +193,6 @@ class ReservationDAO:
         reservation.save()
         return reservation
 
-    #Delete a reservation with the given id
-    def delete(self, id: int) -> int:
-        reservation = Reservation.objects.get(pk = id)
-        reservation.delete()
-        return 0
-    
     #Find a reservation with the given id
     def find(self, id: int) -> Reservation:
         reservation = Reservation.objects.get(pk = id)
@@ -194,7 +203,9 @@ class ReservationDAO:
         reservations = Reservation.objects.all()
         return reservations
 
-class FlightDAO:
+class FlightDAO(BulkDAOMixin):
+    model = Flight
+
     def __init__(self):
         #do nothing
         pass
@@ -210,12 +221,6 @@ class FlightDAO:
         flight.save()
         return flight
 
-    #Delete a flight with the given id
-    def delete(self, id: int) -> int:
-        flight = Flight.objects.get(pk = id)
-        flight.delete()
-        return 0
-    
     #Find a flight with the given id
     def find(self, id: int) -> Flight:
         flight = Flight.objects.get(pk = id)
@@ -226,7 +231,9 @@ class FlightDAO:
         flights = Flight.objects.all()
         return flights
 
-class PolicyDAO:
+class PolicyDAO(BulkDAOMixin):
+    model = Policy
+
     def __init__(self):
         pass
     
@@ -12,18 +12,20 @@ from .forms import *
 class FlightFilter(FilterSet):
     departure_airport = ModelChoiceFilter(
         queryset = Airport.objects,
-        widget = forms.Select(
+        widget = AirportTypeahead(
             attrs = {
                 'class' : 'form-control',
+                'placeholder' : 'Type an airport',
             },
         ),
         label = 'Departure'
     )
     arrival_airport = ModelChoiceFilter(
         queryset = Airport.objects,
-        widget = forms.Select(
+        widget = AirportTypeahead(
             attrs = {
                 'class' : 'form-control',
+                'placeholder' : 'Type an airport',
             },
         ),
         label = 'Destination'
@@ -58,13 +60,6 @@ class FlightReportGeneralFilter(FilterSet):
         label = 'Data range',
     )
 
-    class Meta:
-        model = Flight
-        fields = [
-            'date_time'
-        ]
-
-class FlightReportYearlyFilter(FilterSet):
     class Meta:
         model = Flight
         fields = [
@@ -2,10 +2,64 @@ from django.forms import ModelForm, ValidationError
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm, PasswordChangeForm
 from django.contrib.auth.models import User
 from django import forms
+from django.forms.utils import flatatt
+from django.urls import reverse
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 
 from .models import *
+from .service import AirportCatalogService, FareService
 import re
 
+# Widgets
+class AirportSelect(forms.Select):
+    '''Select of every Airport, rendered from AirportCatalogService
+    instead of querying and rendering one option per Airport.
+    '''
+    empty_label = '---------'
+
+    def render(self, name, value, attrs = None, renderer = None):
+        final_attrs = self.build_attrs(self.attrs, attrs)
+        final_attrs['name'] = name
+
+        options = AirportCatalogService().get_options_html()
+        selected = '' if value in (None, '') else escape(str(value))
+
+        if selected:
+            options = options.replace(f'<option value="{selected}">', f'<option value="{selected}" selected>', 1)
+
+        empty_option = f'<option value=""{"" if selected else " selected"}>{self.empty_label}</option>'
+
+        return mark_safe(f'<select{flatatt(final_attrs)}>{empty_option}{options}</select>')
+
+class AirportTypeahead(forms.Widget):
+    '''Text input suggesting airports from the typeahead endpoint
+    (see static/js/typeahead.js), the chosen Airport ID is sent in a hidden input.
+    '''
+
+    def render(self, name, value, attrs = None, renderer = None):
+        final_attrs = self.build_attrs(self.attrs, attrs)
+        input_id = final_attrs.pop('id', f'id_{name}')
+
+        selected = '' if value in (None, '') else str(value)
+        label = AirportCatalogService().get_name(int(selected)) if selected.isdigit() else None
+
+        final_attrs.update({
+            'id' : input_id,
+            'type' : 'text',
+            'value' : label or '',
+            'autocomplete' : 'off',
+            'list' : f'{input_id}_list',
+            'data-typeahead-url' : reverse('airport.typeahead'),
+            'data-typeahead-target' : f'{input_id}_value',
+        })
+
+        return mark_safe(
+            f'<input type="hidden" name="{name}" id="{input_id}_value" value="{escape(selected)}">'
+            f'<input{flatatt(final_attrs)}>'
+            f'<datalist id="{input_id}_list"></datalist>'
+        )
+
 # Authentication forms
 class LoginForm(AuthenticationForm):
     '''Login form
@@ -120,10 +174,10 @@ class FlightForm(ModelForm):
         ]
 
         widgets = {
-            'departure_airport' : forms.Select(attrs = {
+            'departure_airport' : AirportSelect(attrs = {
                 'class' : 'form-control',
             }),
-            'arrival_airport' : forms.Select(attrs = {
+            'arrival_airport' : AirportSelect(attrs = {
                 'class' : 'form-control',
             }),
             'date_time' : forms.TextInput(attrs = {
@@ -146,91 +200,185 @@ class FlightForm(ModelForm):
                 'arrival_airport' : 'Departure and Arrival Airport must not be the same.'
             })
         
-class FlightDetailForm(ModelForm):
-    '''FlightDetailForm
+class ItinerarySearchForm(forms.Form):
+    '''Itinerary search form
 
     Required fields:
-    - flight_time
-    - first_class_seat_size
-    - second_class_seat_size
-    - first_class_ticket_price
-    - second_class_ticket_price
-    '''
-
-    '''Integers defined here
+    - departure_airport
+    - arrival_airport
+    - date
     '''
-    flight_time = forms.DecimalField(
-        widget = forms.NumberInput(attrs = {
+    departure_airport = forms.ModelChoiceField(
+        queryset = Airport.objects,
+        widget = AirportTypeahead(attrs = {
             'class' : 'form-control',
-            'placeholder' : 'Flight time (in minutes)',
-        })
+            'placeholder' : 'Type an airport',
+        }),
+        label = 'Departure',
     )
-    first_class_seat_size = forms.DecimalField(
-        widget = forms.NumberInput(attrs = {
+    arrival_airport = forms.ModelChoiceField(
+        queryset = Airport.objects,
+        widget = AirportTypeahead(attrs = {
             'class' : 'form-control',
-            'placeholder' : 'Total first class seats',
+            'placeholder' : 'Type an airport',
         }),
+        label = 'Destination',
     )
-    second_class_seat_size = forms.DecimalField(
-        widget = forms.NumberInput(attrs = {
+    date = forms.DateField(
+        widget = forms.DateInput(attrs = {
             'class' : 'form-control',
-            'placeholder' : 'Total economy class seats',
+            'type' : 'date',
         }),
+        label = 'Depart on',
     )
-    first_class_ticket_price = forms.DecimalField(
-        widget = forms.NumberInput(attrs = {
+    max_stops = forms.TypedChoiceField(
+        choices = [(0, 'Direct only'), (1, 'Up to 1 stop'), (2, 'Up to 2 stops')],
+        coerce = int,
+        initial = 2,
+        widget = forms.Select(attrs = {
             'class' : 'form-control',
-            'placeholder' : 'Price for a First Class ticket',
         }),
+        label = 'Stops',
     )
-    second_class_ticket_price = forms.DecimalField(
-        widget = forms.NumberInput(attrs = {
+    sort = forms.ChoiceField(
+        choices = [('arrival', 'Earliest arrival'), ('price', 'Cheapest'), ('duration', 'Shortest')],
+        initial = 'arrival',
+        widget = forms.Select(attrs = {
             'class' : 'form-control',
-            'placeholder' : 'Price for a Economy Class ticket',
         }),
+        label = 'Sort by',
+    )
+
+    def clean(self):
+        '''Custom form validation:
+
+        - Departure Airports cannot be the same as Arrival Airport
+        '''
+        departure_airport = self.cleaned_data.get('departure_airport')
+        arrival_airport = self.cleaned_data.get('arrival_airport')
+
+        if departure_airport is not None and departure_airport == arrival_airport:
+            raise ValidationError({
+                'departure_airport' : 'Departure and Arrival Airport must not be the same.',
+                'arrival_airport' : 'Departure and Arrival Airport must not be the same.'
+            })
+
+class FlightDetailForm(ModelForm):
+    '''FlightDetailForm
+
+    Required fields:
+    - flight_time
+
+    Seats and ticket price of every TicketClass are added on init, as
+    seat_size_<id> and price_<id>. A class left blank is not sold.
+    '''
+
+    '''Integers defined here
+    '''
+    flight_time = forms.DecimalField(
+        widget = forms.NumberInput(attrs = {
+            'class' : 'form-control',
+            'placeholder' : 'Flight time (in minutes)',
+        })
     )
 
     class Meta:
         model = FlightDetail
-        fields = '__all__'
-        exclude = ['flight']
+        fields = ['flight_time']
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.fare_service = FareService()
+        self.ticket_classes = self.fare_service.get_ticket_class_names()
+
+        self.fares = {}
+        if self.instance.flight_id is not None:
+            self.fares = {
+                fare.ticket_class_id : fare
+                for fare in self.fare_service.get_fares([self.instance.flight_id]).get(self.instance.flight_id, [])
+            }
+
+        for ticket_class_id, name in self.ticket_classes.items():
+            fare = self.fares.get(ticket_class_id)
+
+            self.fields[f'seat_size_{ticket_class_id}'] = forms.IntegerField(
+                label = f'{name} class seats',
+                required = False,
+                initial = fare and fare.seat_size,
+                widget = forms.NumberInput(attrs = {
+                    'class' : 'form-control',
+                    'placeholder' : f'Total {name.lower()} class seats',
+                }),
+            )
+            self.fields[f'price_{ticket_class_id}'] = forms.IntegerField(
+                label = f'{name} class ticket price',
+                required = False,
+                initial = fare and fare.price,
+                widget = forms.NumberInput(attrs = {
+                    'class' : 'form-control',
+                    'placeholder' : f'Price for a {name} class ticket',
+                }),
+            )
 
     def clean(self):
         '''Custom form validation:
 
         - Flight time must be > 0
-        - First class seats & Economy class seats must be >= 0
+        - Seats & ticket prices must be >= 0, both given or both blank
+        - Seats cannot be less than the tickets already booked
         '''
         flight_time = self.cleaned_data.get('flight_time')
-        first_class_seat_size = self.cleaned_data.get('first_class_seat_size')
-        second_class_seat_size = self.cleaned_data.get('second_class_seat_size')
-        first_class_ticket_price = self.cleaned_data.get('first_class_ticket_price')
-        second_class_ticket_price = self.cleaned_data.get('second_class_ticket_price')
 
         if flight_time <= 0:
             raise ValidationError({
                 'flight_time' : 'Flight time cannot be negative or zero minutes.'
             })
-        
-        if first_class_seat_size < 0:
-            raise ValidationError({
-                'first_class_seat_size' : 'First class seats cannot be a negative.'
-            })
 
-        if second_class_seat_size < 0:
-            raise ValidationError({
-                'second_class_seat_size' : 'Economy class seats cannot be a negative.'
-            })
-        
-        if first_class_ticket_price < 0:
-            raise ValidationError({
-                'first_class_ticket_price' : 'First class ticket price cannot be negative.'
-            })
-        
-        if second_class_ticket_price < 0:
-            raise ValidationError({
-                'second_class_ticket_price' : 'Economy class ticket price cannot be negative.'
-            })
+        self.cleaned_fares = {}
+
+        for ticket_class_id, name in self.ticket_classes.items():
+            seat_field = f'seat_size_{ticket_class_id}'
+            price_field = f'price_{ticket_class_id}'
+            seat_size = self.cleaned_data.get(seat_field)
+            price = self.cleaned_data.get(price_field)
+            fare = self.fares.get(ticket_class_id)
+
+            if seat_size is None and price is None:
+                if fare is None:
+                    continue
+                elif fare.tickets:
+                    self.add_error(seat_field, f'{name} class already has {fare.tickets} tickets booked.')
+                else:
+                    self.cleaned_fares[ticket_class_id] = None
+                continue
+            elif seat_size is None:
+                self.add_error(seat_field, f'Enter the number of {name} class seats.')
+                continue
+            elif price is None:
+                self.add_error(price_field, f'Enter the {name} class ticket price.')
+                continue
+
+            if seat_size < 0:
+                self.add_error(seat_field, f'{name} class seats cannot be a negative.')
+            elif fare is not None and seat_size < fare.tickets:
+                self.add_error(seat_field, f'{name} class already has {fare.tickets} tickets booked.')
+            elif price is not None and price < 0:
+                self.add_error(price_field, f'{name} class ticket price cannot be negative.')
+            else:
+                self.cleaned_fares[ticket_class_id] = (seat_size, price)
+
+    def save(self, commit = True):
+        '''Save the flight time, then the fares of every class.
+        Only flight_time is written, seat counters move with bookings made
+        while the form was edited (see SeatCounterService).
+        '''
+        flight_detail = super().save(commit = False)
+
+        if commit:
+            flight_detail.save(update_fields = ['flight_time'])
+            self.fare_service.set_fares(flight_detail.flight_id, self.cleaned_fares)
+
+        return flight_detail
 
 # Airport forms
 class AirportForm(ModelForm):
@@ -288,7 +436,7 @@ class TransitionAirportForm(ModelForm):
         ]
 
         widgets = {
-            'airport' : forms.Select(attrs = {
+            'airport' : AirportSelect(attrs = {
                 'class' : 'form-control',
             }),
         }
@@ -335,25 +483,39 @@ class FlightTicketForm(ModelForm):
         self.flight = kwargs.pop('flight', None)
         super().__init__(*args, **kwargs)
 
+        if self.flight is not None:
+            '''Only offer the classes of this flight with seats left,
+            and the class a ticket already holds.
+            '''
+            available = Q(flightfare__tickets__lt = F('flightfare__seat_size'))
+            if self.instance.ticket_class_id is not None:
+                available |= Q(pk = self.instance.ticket_class_id)
+
+            self.fields['ticket_class'].queryset = TicketClass.objects.filter(Q(flightfare__flight = self.flight) & available)
+
     def clean(self):
         ticket_class = self.cleaned_data.get('ticket_class')
 
-        ticket_class_condition_check = True
-
-        '''This is a complete hell, but we don't have time to make a dynamically loaded ticket-class validation.
+        '''Seats are checked against the FlightFare counters,
+        a ticket keeping its own class does not need a new seat.
         '''
+        if ticket_class is not None:
+            fare = FareService().get_fare(self.flight.id, ticket_class.id)
 
-        if ticket_class.name == "First":
-            ticket_class_condition_check = self.flight.flightdetail.first_class_seat_size > self.flight.ticket_set.filter(ticket_class = ticket_class).count()
+            if fare is None:
+                raise ValidationError({
+                    'ticket_class' : 'This class is not sold on this flight, please choose another class.'
+                })
 
-        elif ticket_class.name == "Economy":
-            ticket_class_condition_check = self.flight.flightdetail.second_class_seat_size > self.flight.ticket_set.filter(ticket_class = ticket_class).count()
+            booked_tickets = fare.tickets
+            if self.instance.pk is not None and self.instance.ticket_class_id == ticket_class.id:
+                booked_tickets -= 1
+
+            if fare.seat_size <= booked_tickets:
+                raise ValidationError({
+                    'ticket_class' : 'This class is out of seats, please choose another class.'
+                })
 
-        if not ticket_class_condition_check:
-            raise ValidationError({
-                'ticket_class' : 'This class is out of seats, please choose another class.'
-            })
-        
         '''Phone and Identity Code should be numeric only.
         '''
         phone = self.cleaned_data.get('phone')
@@ -376,6 +538,7 @@ class FlightTicketForm(ModelForm):
             'customer',
             'flight',
             'is_booked',
+            'is_canceled',
             'price'
         ]
 
@@ -0,0 +1,198 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+class FlightLeg:
+    '''One upcoming Flight, an edge of the FlightGraph.
+    '''
+    __slots__ = (
+        'flight_id',
+        'departure_airport_id',
+        'arrival_airport_id',
+        'departure',
+        'arrival',
+        'price',
+        'seats',
+    )
+
+    def __init__(self, flight_id : int, departure_airport_id : int, arrival_airport_id : int,
+            departure : datetime, arrival : datetime, price : int, seats : int) -> None:
+        self.flight_id = flight_id
+        self.departure_airport_id = departure_airport_id
+        self.arrival_airport_id = arrival_airport_id
+        self.departure = departure
+        self.arrival = arrival
+        self.price = price
+        self.seats = seats
+
+    @property
+    def sort_key(self) -> tuple:
+        return (self.departure, self.flight_id)
+
+class Itinerary:
+    '''A chain of FlightLegs, each one leaving where the previous one arrived.
+    '''
+
+    def __init__(self, legs : tuple) -> None:
+        self.legs = legs
+
+    def extend(self, leg : FlightLeg) -> 'Itinerary':
+        return Itinerary(self.legs + (leg,))
+
+    @property
+    def departure(self) -> datetime:
+        return self.legs[0].departure
+
+    @property
+    def arrival(self) -> datetime:
+        return self.legs[-1].arrival
+
+    @property
+    def duration(self) -> timedelta:
+        return self.arrival - self.departure
+
+    @property
+    def price(self) -> int:
+        return sum(leg.price for leg in self.legs)
+
+    @property
+    def stops(self) -> int:
+        return len(self.legs) - 1
+
+    @property
+    def flight_ids(self) -> list:
+        return [leg.flight_id for leg in self.legs]
+
+    def visits(self, airport_id : int) -> bool:
+        return airport_id == self.legs[0].departure_airport_id or any(
+            leg.arrival_airport_id == airport_id for leg in self.legs
+        )
+
+    def dominates(self, other : 'Itinerary') -> bool:
+        '''Arrives no later, costs no more and leaves no earlier
+        (so it has at least as much time left for the next legs).
+        '''
+        return (
+            self.arrival <= other.arrival
+            and self.price <= other.price
+            and self.departure >= other.departure
+        )
+
+class FlightGraph:
+    '''Time-expanded graph of upcoming flights.
+
+    Airports are nodes, every FlightLeg is an edge. Legs leaving an airport
+    are kept sorted by departure, so the legs of a time window are found
+    with a binary search instead of a scan.
+
+    add and remove replace the lists of an airport instead of changing them,
+    so a copy() can be changed while searches still run on the original.
+    '''
+
+    def __init__(self, legs = ()) -> None:
+        self.legs = {}
+        self.departures = defaultdict(list)
+        self.departure_keys = defaultdict(list)
+
+        for leg in sorted(legs, key = lambda leg: leg.sort_key):
+            self.legs[leg.flight_id] = leg
+            self.departures[leg.departure_airport_id].append(leg)
+            self.departure_keys[leg.departure_airport_id].append(leg.sort_key)
+
+    def __len__(self) -> int:
+        return len(self.legs)
+
+    def copy(self) -> 'FlightGraph':
+        '''Shallow copy, sharing the legs and the lists of every airport.
+        '''
+        graph = FlightGraph()
+        graph.legs = dict(self.legs)
+        graph.departures = defaultdict(list, self.departures)
+        graph.departure_keys = defaultdict(list, self.departure_keys)
+        return graph
+
+    def add(self, leg : FlightLeg) -> None:
+        '''Add or replace the leg of a Flight.
+        '''
+        self.remove(leg.flight_id)
+
+        airport_id = leg.departure_airport_id
+        keys = list(self.departure_keys[airport_id])
+        departures = list(self.departures[airport_id])
+
+        index = bisect_left(keys, leg.sort_key)
+        keys.insert(index, leg.sort_key)
+        departures.insert(index, leg)
+
+        self.departure_keys[airport_id] = keys
+        self.departures[airport_id] = departures
+        self.legs[leg.flight_id] = leg
+
+    def remove(self, flight_id : int) -> None:
+        leg = self.legs.pop(flight_id, None)
+        if leg is None:
+            return
+
+        airport_id = leg.departure_airport_id
+        index = bisect_left(self.departure_keys[airport_id], leg.sort_key)
+        self.departure_keys[airport_id] = self.departure_keys[airport_id][:index] + self.departure_keys[airport_id][index + 1:]
+        self.departures[airport_id] = self.departures[airport_id][:index] + self.departures[airport_id][index + 1:]
+
+    def legs_from(self, airport_id : int, after : datetime, before : datetime) -> list:
+        '''Legs leaving airport_id between after and before (both included).
+        '''
+        keys = self.departure_keys.get(airport_id)
+        if not keys:
+            return []
+
+        start = bisect_left(keys, (after, -1))
+        end = bisect_right(keys, (before, float('inf')))
+        return self.departures[airport_id][start:end]
+
+    def search(self, origin_id : int, destination_id : int, depart_after : datetime, depart_before : datetime,
+            max_legs : int = 3, min_connection : timedelta = timedelta(minutes = 45),
+            max_duration : timedelta = timedelta(hours = 48)) -> list:
+        '''Find itineraries from origin to destination with at most max_legs legs,
+        the first one leaving between depart_after and depart_before.
+
+        Legs are explored hop by hop. At every airport, a partial itinerary
+        dominated by one already seen there (see Itinerary.dominates) with
+        no more legs is dropped, which keeps the search small on busy airports.
+        Returns the non-dominated itineraries, unsorted.
+        '''
+        found = []
+        labels = defaultdict(list)
+        frontier = [
+            Itinerary((leg,)) for leg in self.legs_from(origin_id, depart_after, depart_before)
+            if leg.seats > 0
+        ]
+
+        for hop in range(1, max_legs + 1):
+            next_frontier = []
+
+            for itinerary in frontier:
+                airport_id = itinerary.legs[-1].arrival_airport_id
+
+                if any(label.dominates(itinerary) for label in labels[airport_id]):
+                    continue
+                labels[airport_id].append(itinerary)
+
+                if airport_id == destination_id:
+                    found.append(itinerary)
+                    continue
+
+                if hop == max_legs:
+                    continue
+
+                deadline = itinerary.departure + max_duration
+                for leg in self.legs_from(airport_id, itinerary.arrival + min_connection, deadline):
+                    if leg.seats <= 0 or leg.arrival > deadline or itinerary.visits(leg.arrival_airport_id):
+                        continue
+                    next_frontier.append(itinerary.extend(leg))
+
+            frontier = next_frontier
+
+        return [
+            itinerary for itinerary in found
+            if not any(other is not itinerary and other.dominates(itinerary) and not itinerary.dominates(other) for other in found)
+        ]
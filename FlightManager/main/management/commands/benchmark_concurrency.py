@@ -0,0 +1,222 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction, OperationalError
+from django.utils.timezone import now
+
+from collections import Counter
+from datetime import timedelta
+import random
+import threading
+import time
+
+from main.models import Airport, Customer, Flight, FlightDetail, FlightFare, Ticket, TicketClass
+from main.service import FlightService, ReservationResult, ReservationService
+
+class Command(BaseCommand):
+    '''Book and pay tickets from parallel writers while readers run flight searches
+    and the general report, then show the throughput, latencies and errors.
+
+    Bookings are split by outcome: only reserved tickets count as booked,
+    sold out classes and customer limits are listed apart. Lock conflicts
+    retried inside ReservationService.reserve are counted as retries, those
+    left after the last attempt (or met while paying) as lock errors.
+
+    The database is the one of DB_PROFILE (see settings), run the command once
+    per profile to compare them. Benchmark flights, customers and tickets are
+    left in the database, so only use this command on a scratch database.
+    '''
+    help = 'Benchmark concurrent bookings and searches on the configured database profile (scratch database only).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--writers',
+            type = int,
+            default = 8,
+            help = 'Threads booking and paying tickets.',
+        )
+        parser.add_argument(
+            '--readers',
+            type = int,
+            default = 8,
+            help = 'Threads running flight searches and reports.',
+        )
+        parser.add_argument(
+            '--duration',
+            type = float,
+            default = 10,
+            help = 'Seconds to run.',
+        )
+        parser.add_argument(
+            '--flights',
+            type = int,
+            default = 20,
+            help = 'Upcoming benchmark flights the writers book on.',
+        )
+
+    def handle(self, *args, **options):
+        flight_ids, customer_ids, ticket_class_ids = self.populate(options['flights'])
+        route = Flight.objects.filter(id = flight_ids[0]).values_list('departure_airport_id', 'arrival_airport_id').get()
+
+        self.stdout.write(self.style.MIGRATE_HEADING('Database'))
+        for name, value in self.describe().items():
+            self.stdout.write(f'{name}: {value}')
+
+        deadline = time.monotonic() + options['duration']
+        stats = {'write' : self.new_stats(), 'read' : self.new_stats()}
+        lock = threading.Lock()
+
+        def write() -> None:
+            reservation_service = ReservationService()
+            while time.monotonic() < deadline:
+                self.measure(stats['write'], lock, lambda: self.book(
+                    reservation_service,
+                    random.choice(flight_ids),
+                    random.choice(customer_ids),
+                    random.choice(ticket_class_ids),
+                ))
+
+            with lock:
+                stats['write']['retries'] += reservation_service.retries
+
+        def read() -> None:
+            flight_service = FlightService()
+            while time.monotonic() < deadline:
+                self.measure(stats['read'], lock, lambda: self.search(flight_service, route))
+
+        threads = [threading.Thread(target = self.run_thread, args = (write,)) for _ in range(options['writers'])]
+        threads += [threading.Thread(target = self.run_thread, args = (read,)) for _ in range(options['readers'])]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f'Results ({options["writers"]} writers, {options["readers"]} readers, {elapsed:.1f} s)'))
+        self.report('Bookings (reserve + pay)', stats['write'], elapsed, ReservationResult.RESERVED)
+        self.report('Searches + reports', stats['read'], elapsed)
+
+    def describe(self) -> dict:
+        '''Profile and effective settings of the default connection.
+        '''
+        description = {
+            'DB_PROFILE' : getattr(settings, 'DB_PROFILE', 'sqlite'),
+            'vendor' : connection.vendor,
+            'CONN_MAX_AGE' : connection.settings_dict.get('CONN_MAX_AGE'),
+        }
+
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size'):
+                    cursor.execute(f'PRAGMA {pragma}')
+                    description[pragma] = cursor.fetchone()[0]
+
+        return description
+
+    def populate(self, total_flights : int) -> tuple:
+        '''Create upcoming flights with room for every booking, and customers.
+        '''
+        ticket_class_ids = list(TicketClass.objects.order_by('id').values_list('id', flat = True))
+        seats = 1000000
+
+        with transaction.atomic():
+            departure = Airport.objects.create(name = 'Concurrency Benchmark Departure')
+            arrival = Airport.objects.create(name = 'Concurrency Benchmark Arrival')
+            customers = Customer.objects.bulk_create([Customer(name = f'Concurrency Benchmark Customer {i}') for i in range(200)])
+
+            flights = Flight.objects.bulk_create([
+                Flight(
+                    departure_airport = departure,
+                    arrival_airport = arrival,
+                    date_time = now() + timedelta(days = 30, hours = i),
+                )
+                for i in range(total_flights)
+            ])
+            FlightDetail.objects.bulk_create([
+                FlightDetail(flight = flight, flight_time = 60, seat_size = seats * len(ticket_class_ids))
+                for flight in flights
+            ])
+            FlightFare.objects.bulk_create([
+                FlightFare(flight = flight, ticket_class_id = ticket_class_id, seat_size = seats, price = 100)
+                for flight in flights
+                for ticket_class_id in ticket_class_ids
+            ])
+
+        return [flight.id for flight in flights], [customer.id for customer in customers], ticket_class_ids
+
+    def book(self, reservation_service : ReservationService, flight_id : int, customer_id : int, ticket_class_id : int) -> str:
+        '''Reserve then pay a ticket, return the ReservationResult status.
+        '''
+        result = reservation_service.reserve(flight_id, Ticket(
+            customer_id = customer_id,
+            ticket_class_id = ticket_class_id,
+            price = 100,
+        ))
+
+        if result.is_reserved:
+            result.ticket.is_booked = True
+            result.ticket.save()
+
+        return result.status
+
+    def search(self, flight_service : FlightService, route : tuple) -> None:
+        '''A flight search then a page of the general report, as the views run them.
+        '''
+        departure_airport_id, arrival_airport_id = route
+        list(flight_service.get_search_queryset(Flight.objects.filter(
+            departure_airport_id = departure_airport_id,
+            arrival_airport_id = arrival_airport_id,
+        ))[:10])
+        list(flight_service.get_general_report_queryset(Flight.objects.all())[:10])
+
+    def run_thread(self, target) -> None:
+        try:
+            target()
+        finally:
+            connection.close()
+
+    def new_stats(self) -> dict:
+        return {'timings' : [], 'retries' : 0, 'lock_errors' : 0, 'errors' : 0}
+
+    def measure(self, stats : dict, lock : threading.Lock, operation) -> None:
+        '''Time an operation, keeping its outcome (the value it returns) with its timing.
+        '''
+        start = time.perf_counter()
+        try:
+            outcome = operation()
+        except OperationalError as error:
+            with lock:
+                stats['lock_errors' if ReservationService.is_lock_error(error) else 'errors'] += 1
+            return
+        except Exception:
+            with lock:
+                stats['errors'] += 1
+            return
+
+        with lock:
+            stats['timings'].append((outcome, time.perf_counter() - start))
+
+    def report(self, label : str, stats : dict, elapsed : float, success : str = None) -> None:
+        '''Write throughput and latencies of the operations ending in success
+        (all completed operations without one), then how many ended otherwise.
+        '''
+        timings = sorted(seconds for outcome, seconds in stats['timings'] if success is None or outcome == success)
+        done = len(timings)
+
+        def percentile(share : float) -> float:
+            return timings[min(int(len(timings) * share), len(timings) - 1)] * 1000 if timings else 0
+
+        self.stdout.write(
+            f'{label}: {done} ok, {done / elapsed:.1f}/s, '
+            f'p50 {percentile(0.5):.1f} ms, p95 {percentile(0.95):.1f} ms, p99 {percentile(0.99):.1f} ms, '
+            f'{stats["lock_errors"]} lock error(s), {stats["errors"]} other error(s)'
+        )
+
+        outcomes = ', '.join(
+            f'{count} {outcome.replace("_", " ")}'
+            for outcome, count in sorted(Counter(outcome for outcome, _ in stats['timings']).items())
+            if outcome != success
+        )
+        if success is not None:
+            self.stdout.write(f'  not {success.replace("_", " ")}: {outcomes or "none"}, {stats["retries"]} lock retry(ies)')
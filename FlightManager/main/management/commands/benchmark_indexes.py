@@ -0,0 +1,189 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+from django.utils.timezone import now
+
+from datetime import timedelta
+import random
+import time
+
+from main.models import Airport, Customer, Flight, FlightDetail, FlightFare, Ticket, TicketClass
+
+class Command(BaseCommand):
+    '''Show EXPLAIN plans and timings of the search/report queries
+    without and with the Flight/Ticket composite indexes.
+
+    Indexes are dropped and re-created during the run,
+    so only use this command on a scratch database.
+    '''
+    help = 'Benchmark flight search and report queries with and without indexes (scratch database only).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--populate',
+            type = int,
+            default = 0,
+            metavar = 'TICKETS',
+            help = 'Generate this many tickets (and matching flights) before benchmarking, e.g. 1000000.',
+        )
+        parser.add_argument(
+            '--repeat',
+            type = int,
+            default = 5,
+            help = 'Runs per query, the best time is reported.',
+        )
+
+    def handle(self, *args, **options):
+        if options['populate']:
+            self.populate(options['populate'])
+
+        queries = self.get_queries()
+        if queries is None:
+            self.stdout.write(self.style.ERROR('No data to benchmark, use --populate.'))
+            return
+
+        indexes = [
+            (Flight, index) for index in Flight._meta.indexes
+        ] + [
+            (Ticket, index) for index in Ticket._meta.indexes
+        ]
+
+        with connection.schema_editor() as schema_editor:
+            for model, index in indexes:
+                schema_editor.remove_index(model, index)
+
+        try:
+            self.stdout.write(self.style.MIGRATE_HEADING('Without indexes'))
+            self.run(queries, options['repeat'])
+        finally:
+            with connection.schema_editor() as schema_editor:
+                for model, index in indexes:
+                    schema_editor.add_index(model, index)
+
+        self.stdout.write(self.style.MIGRATE_HEADING('With indexes'))
+        self.run(queries, options['repeat'])
+
+    def get_queries(self) -> dict:
+        '''Querysets shaped like the ones used by the views.
+        '''
+        flight = Flight.objects.order_by('?').first()
+        ticket = Ticket.objects.exclude(customer = None).order_by('?').first()
+        if flight is None or ticket is None:
+            return None
+
+        return {
+            'FlightFilter (route + date range)' : lambda: list(Flight.objects.filter(
+                departure_airport_id = flight.departure_airport_id,
+                arrival_airport_id = flight.arrival_airport_id,
+                date_time__range = (flight.date_time - timedelta(days = 30), flight.date_time + timedelta(days = 30)),
+            )),
+            'Upcoming flights (first page)' : lambda: list(Flight.objects.filter(
+                date_time__gt = now(),
+            ).order_by('date_time')[:10]),
+            'Yearly report' : lambda: list(Flight.objects.filter(
+                date_time__year = flight.date_time.year,
+                date_time__lt = now(),
+            ).aggregate(
+                tickets_sold = Count('ticket', filter = Q(ticket__is_booked = True)),
+                revenue = Sum('ticket__price', filter = Q(ticket__is_booked = True)),
+            ).values()),
+            'Sold seats per class' : lambda: Ticket.objects.filter(
+                flight_id = flight.id,
+                ticket_class_id = ticket.ticket_class_id,
+                is_booked = True,
+            ).count(),
+            'Ticket list of a customer' : lambda: list(Ticket.objects.filter(
+                customer_id = ticket.customer_id,
+            ).order_by('-date_created')[:10]),
+        }
+
+    def run(self, queries : dict, repeat : int) -> None:
+        for name, query in queries.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                query()
+                timings.append(time.perf_counter() - start)
+
+            self.stdout.write(f'{name}: {min(timings) * 1000:.2f} ms')
+            for line in self.explain(query):
+                self.stdout.write(f'    {line}')
+
+    def explain(self, query) -> list:
+        '''Run the query once more while capturing its EXPLAIN plan.
+        '''
+        plans = []
+
+        def explain_wrapper(execute, sql, params, many, context):
+            if sql.lstrip().upper().startswith('SELECT'):
+                with context['connection'].cursor() as cursor:
+                    prefix = 'EXPLAIN QUERY PLAN' if connection.vendor == 'sqlite' else 'EXPLAIN'
+                    cursor.execute(f'{prefix} {sql}', params)
+                    plans.extend(' '.join(str(column) for column in row) for row in cursor.fetchall())
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(explain_wrapper):
+            query()
+
+        return plans
+
+    def populate(self, total_tickets : int) -> None:
+        '''Bulk create synthetic airports, flights, details, fares, customers and tickets.
+        '''
+        batch_size = 5000
+        tickets_per_flight = 50
+        total_flights = max(1, total_tickets // tickets_per_flight)
+        ticket_class_ids = list(TicketClass.objects.order_by('id').values_list('id', flat = True))
+
+        with transaction.atomic():
+            airports = Airport.objects.bulk_create([Airport(name = f'Benchmark Airport {i}') for i in range(50)])
+            customers = Customer.objects.bulk_create([Customer(name = f'Benchmark Customer {i}') for i in range(1000)])
+
+            start = now() - timedelta(days = 365 * 2)
+            flights = Flight.objects.bulk_create([
+                Flight(
+                    departure_airport = departure,
+                    arrival_airport = random.choice([airport for airport in airports if airport != departure]),
+                    date_time = start + timedelta(minutes = random.randrange(60 * 24 * 365 * 3)),
+                )
+                for departure in (random.choice(airports) for _ in range(total_flights))
+            ], batch_size = batch_size)
+
+            FlightDetail.objects.bulk_create([
+                FlightDetail(
+                    flight = flight,
+                    flight_time = 120,
+                    seat_size = tickets_per_flight * len(ticket_class_ids),
+                )
+                for flight in flights
+            ], batch_size = batch_size)
+
+            FlightFare.objects.bulk_create([
+                FlightFare(
+                    flight = flight,
+                    ticket_class_id = ticket_class_id,
+                    seat_size = tickets_per_flight,
+                    price = 300 if index == 0 else 100,
+                )
+                for flight in flights
+                for index, ticket_class_id in enumerate(ticket_class_ids)
+            ], batch_size = batch_size)
+
+            batch = []
+            for i in range(total_tickets):
+                batch.append(Ticket(
+                    customer = random.choice(customers),
+                    flight = flights[i % total_flights],
+                    ticket_class_id = random.choice(ticket_class_ids),
+                    is_booked = random.random() < 0.7,
+                    price = 100,
+                ))
+                if len(batch) == batch_size:
+                    Ticket.objects.bulk_create(batch)
+                    batch = []
+            Ticket.objects.bulk_create(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {total_flights} flights and {total_tickets} tickets, '
+            f'run `manage.py rebuild_seat_counters` and `manage.py rebuild_revenue_rollup` to refresh counters.'
+        ))
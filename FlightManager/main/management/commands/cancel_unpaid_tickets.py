@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+import time
+
+from main.service import TicketService
+
+class Command(BaseCommand):
+    '''Cancel unpaid tickets of departed flights.
+
+    Run it periodically (cron), or keep it running with --interval.
+    Running it twice is harmless, canceled tickets are skipped.
+    '''
+    help = 'Cancel unpaid tickets of flights that already took off.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type = int,
+            default = 1000,
+            help = 'Flights whose tickets are canceled per UPDATE.',
+        )
+        parser.add_argument(
+            '--interval',
+            type = int,
+            default = 0,
+            metavar = 'SECONDS',
+            help = 'Sweep again every SECONDS seconds instead of exiting.',
+        )
+
+    def handle(self, *args, **options):
+        ticket_service = TicketService()
+
+        while True:
+            canceled = ticket_service.cancel_unpaid_tickets(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'Canceled {canceled} unpaid ticket(s).'))
+
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import csv
+import json
+import sys
+
+from main.service import ScheduleImportService
+
+class Command(BaseCommand):
+    '''Import a flight schedule from a CSV, JSON Lines or JSON file.
+
+    CSV files have one column per field (see ScheduleImportService),
+    fares are written as "class:seats:price;..." and transition airports
+    as "name:minutes[:note];...".
+    CSV and JSON Lines files are streamed, JSON files (one array) are loaded at once.
+    '''
+    help = 'Bulk import flights, their details, fares and transition airports from a schedule file.'
+
+    formats = ('csv', 'jsonl', 'json')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help = 'Schedule file, - reads from standard input.',
+        )
+        parser.add_argument(
+            '--format',
+            choices = self.formats,
+            help = 'File format, guessed from the extension by default.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type = int,
+            default = ScheduleImportService.batch_size,
+            help = 'Flights saved per transaction.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action = 'store_true',
+            help = 'Only check the file, do not save anything.',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or path.rpartition('.')[2].lower()
+        if format not in self.formats:
+            raise CommandError(f'Unknown format "{format}", use --format ({", ".join(self.formats)}).')
+
+        try:
+            file = sys.stdin if path == '-' else open(path, newline = '', encoding = 'utf-8-sig')
+        except OSError as error:
+            raise CommandError(error)
+
+        invalid = 0
+
+        def on_error(line, errors):
+            nonlocal invalid
+            invalid += 1
+            for field, messages in errors.items():
+                for message in messages:
+                    self.stderr.write(f'Line {line}: {field}: {message}')
+
+        try:
+            total = ScheduleImportService(options['batch_size']).import_rows(
+                self.read_rows(file, format),
+                dry_run = options['dry_run'],
+                on_error = on_error,
+            )
+        except (csv.Error, json.JSONDecodeError) as error:
+            raise CommandError(f'Cannot read {path}: {error}')
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+        action = 'would be imported' if options['dry_run'] else 'imported'
+        self.stdout.write(self.style.SUCCESS(f'{total} flight(s) {action}, {invalid} invalid row(s) skipped.'))
+
+    def read_rows(self, file, format : str):
+        '''Yield (line number, row) pairs.
+        '''
+        if format == 'csv':
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield reader.line_num, row
+        elif format == 'jsonl':
+            for line, text in enumerate(file, 1):
+                if text.strip():
+                    yield line, json.loads(text)
+        else:
+            for index, row in enumerate(json.load(file), 1):
+                yield index, row
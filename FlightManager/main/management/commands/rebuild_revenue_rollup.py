@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from main.service import RevenueRollupService
+
+class Command(BaseCommand):
+    '''Backfill (or rebuild) RevenueRollup rows from the Flight and Ticket tables.
+    '''
+    help = 'Rebuild the monthly revenue rollup used by the yearly report.'
+
+    def handle(self, *args, **options):
+        created = RevenueRollupService().rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt revenue rollup, {created} row(s) created.'))
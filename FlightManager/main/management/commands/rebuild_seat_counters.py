@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from main.service import SeatCounterService
+
+class Command(BaseCommand):
+    '''Rebuild (or only verify) FlightFare seat counters and FlightDetail totals from the Ticket table.
+    '''
+    help = 'Rebuild flight seat counters from tickets.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action = 'store_true',
+            help = 'Only report flights with wrong counters, do not fix them.',
+        )
+
+    def handle(self, *args, **options):
+        seat_counter_service = SeatCounterService()
+
+        mismatched = list(seat_counter_service.get_mismatched_queryset().values_list('flight_id', flat = True))
+
+        if options['verify']:
+            for flight_id in mismatched:
+                self.stdout.write(f'Flight {flight_id} has wrong seat counters.')
+
+            if mismatched:
+                self.stdout.write(self.style.ERROR(f'{len(mismatched)} flight(s) need rebuilding.'))
+            else:
+                self.stdout.write(self.style.SUCCESS('All seat counters are correct.'))
+            return
+
+        updated = seat_counter_service.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt seat counters of {updated} flight detail(s), {len(mismatched)} were wrong.'
+        ))
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+import time
+
+from main.routers import ReplicaRouter
+
+class Command(BaseCommand):
+    '''Copy the default SQLite database into the SQLite read replica.
+
+    Stands in for replication when the replica is a second SQLite file
+    (REPLICA_SQLITE_PATH, see settings). The copy uses SQLite's online backup,
+    so the site keeps running while it is made. Keep it running with --interval
+    to get a replica lagging at most that many seconds behind.
+    '''
+    help = 'Copy the default SQLite database into the SQLite read replica.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type = int,
+            default = 0,
+            metavar = 'SECONDS',
+            help = 'Copy again every SECONDS seconds instead of exiting.',
+        )
+
+    def handle(self, *args, **options):
+        alias = ReplicaRouter.replica_alias()
+        if alias is None:
+            raise CommandError(f'No {getattr(settings, "READ_REPLICA_DATABASE", "replica")} database, set REPLICA_SQLITE_PATH.')
+
+        source, target = connections[DEFAULT_DB_ALIAS], connections[alias]
+        if source.vendor != 'sqlite' or target.vendor != 'sqlite':
+            raise CommandError('Only SQLite replicas are copied, use the replication of the database server otherwise.')
+
+        while True:
+            start = time.perf_counter()
+            source.ensure_connection()
+            target.ensure_connection()
+            source.connection.backup(target.connection)
+            self.stdout.write(self.style.SUCCESS(
+                f'Copied {source.settings_dict["NAME"]} to {target.settings_dict["NAME"]} in {time.perf_counter() - start:.2f} s.'
+            ))
+
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
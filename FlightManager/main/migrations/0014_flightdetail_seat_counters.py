@@ -0,0 +1,59 @@
+# Generated by Django 4.0.6 on 2026-10-18 19:06
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_seat_counters(apps, schema_editor):
+    '''Fill the new counters from existing tickets.
+    '''
+    FlightDetail = apps.get_model('main', 'FlightDetail')
+    Ticket = apps.get_model('main', 'Ticket')
+
+    counters = {}
+    for name, prefix in (('First', 'first_class'), ('Economy', 'second_class')):
+        tickets = Ticket.objects.filter(
+            flight = OuterRef('flight'),
+            ticket_class__name = name,
+        ).order_by().values('flight')
+
+        counters[f'{prefix}_tickets'] = Coalesce(Subquery(
+            tickets.annotate(total = Count('id')).values('total')
+        ), 0)
+        counters[f'{prefix}_tickets_sold'] = Coalesce(Subquery(
+            tickets.filter(is_booked = True).annotate(total = Count('id')).values('total')
+        ), 0)
+
+    FlightDetail.objects.update(**counters)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_alter_ticket_options_alter_flight_arrival_airport_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flightdetail',
+            name='first_class_tickets',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='flightdetail',
+            name='first_class_tickets_sold',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='flightdetail',
+            name='second_class_tickets',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='flightdetail',
+            name='second_class_tickets_sold',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(populate_seat_counters, migrations.RunPython.noop),
+    ]
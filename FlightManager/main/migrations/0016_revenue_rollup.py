@@ -0,0 +1,77 @@
+# Generated by Django 4.0.6 on 2026-10-18 19:17
+
+from django.db import migrations, models
+from django.db.models import Count, DateField, Sum
+from django.db.models.functions import Coalesce, TruncMonth
+import django.db.models.deletion
+
+
+def populate_revenue_rollup(apps, schema_editor):
+    '''Fill the rollup from existing flights and paid tickets.
+    '''
+    Flight = apps.get_model('main', 'Flight')
+    Ticket = apps.get_model('main', 'Ticket')
+    RevenueRollup = apps.get_model('main', 'RevenueRollup')
+
+    flights = Flight.objects.annotate(
+        month = TruncMonth('date_time', output_field = DateField()),
+    ).values('month', 'departure_airport_id', 'arrival_airport_id').annotate(
+        total = Count('id'),
+    ).order_by()
+
+    tickets = Ticket.objects.filter(is_booked = True, flight__isnull = False).annotate(
+        month = TruncMonth('flight__date_time', output_field = DateField()),
+    ).values('month', 'flight__departure_airport_id', 'flight__arrival_airport_id', 'ticket_class_id').annotate(
+        sold = Count('id'),
+        total = Coalesce(Sum('price'), 0),
+    ).order_by()
+
+    RevenueRollup.objects.bulk_create([
+        RevenueRollup(
+            month = row['month'],
+            departure_airport_id = row['departure_airport_id'],
+            arrival_airport_id = row['arrival_airport_id'],
+            total_flights = row['total'],
+        ) for row in flights
+    ] + [
+        RevenueRollup(
+            month = row['month'],
+            departure_airport_id = row['flight__departure_airport_id'],
+            arrival_airport_id = row['flight__arrival_airport_id'],
+            ticket_class_id = row['ticket_class_id'],
+            total_tickets_sold = row['sold'],
+            revenue = row['total'],
+        ) for row in tickets
+    ], batch_size = 1000)
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_flight_ticket_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevenueRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('total_flights', models.IntegerField(default=0)),
+                ('total_tickets_sold', models.IntegerField(default=0)),
+                ('revenue', models.IntegerField(default=0)),
+                ('arrival_airport', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main.airport')),
+                ('departure_airport', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main.airport')),
+                ('ticket_class', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main.ticketclass')),
+            ],
+            options={
+                'ordering': ('month',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='revenuerollup',
+            index=models.Index(fields=['month', 'departure_airport', 'arrival_airport', 'ticket_class'], name='rollup_month_route_idx'),
+        ),
+        migrations.RunPython(populate_revenue_rollup, migrations.RunPython.noop),
+    ]
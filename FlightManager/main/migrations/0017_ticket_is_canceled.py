@@ -0,0 +1,35 @@
+# Generated by Django 4.0.6 on 2026-10-18 19:49
+
+from django.db import migrations, models
+from django.utils.timezone import now
+
+
+def cancel_unpaid_tickets(apps, schema_editor):
+    '''Cancel unpaid tickets of flights that already took off.
+    '''
+    Ticket = apps.get_model('main', 'Ticket')
+
+    Ticket.objects.filter(
+        is_booked = False,
+        flight__date_time__lte = now(),
+    ).update(is_canceled = True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_revenue_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='is_canceled',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(condition=models.Q(('is_booked', False), ('is_canceled', False)), fields=['flight'], name='ticket_unpaid_flight_idx'),
+        ),
+        migrations.RunPython(cancel_unpaid_tickets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,130 @@
+# Generated by Django 4.0.6 on 2026-10-18 19:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+
+def populate_fares(apps, schema_editor):
+    '''Move seats, prices and counters of the First and Economy columns
+    to one FlightFare per class, and their totals to FlightDetail.
+    '''
+    FlightDetail = apps.get_model('main', 'FlightDetail')
+    FlightFare = apps.get_model('main', 'FlightFare')
+    TicketClass = apps.get_model('main', 'TicketClass')
+
+    fields = ('seat_size', 'ticket_price', 'tickets', 'tickets_sold')
+    columns = ['flight_id']
+    prefixes = {}
+    for name, prefix in (('First', 'first_class'), ('Economy', 'second_class')):
+        ticket_class = TicketClass.objects.filter(name = name).order_by('id').first()
+        if ticket_class is None:
+            ticket_class = TicketClass.objects.create(name = name)
+        prefixes[prefix] = ticket_class.id
+        columns += [f'{prefix}_{field}' for field in fields]
+
+    fares = []
+    for row in FlightDetail.objects.filter(flight__isnull = False).values(*columns).iterator():
+        for prefix, ticket_class_id in prefixes.items():
+            seat_size, price, tickets, tickets_sold = (row[f'{prefix}_{field}'] for field in fields)
+            if seat_size is None and price is None and not tickets:
+                continue
+
+            fares.append(FlightFare(
+                flight_id = row['flight_id'],
+                ticket_class_id = ticket_class_id,
+                seat_size = seat_size or 0,
+                price = price,
+                tickets = tickets,
+                tickets_sold = tickets_sold,
+            ))
+
+        if len(fares) >= 5000:
+            FlightFare.objects.bulk_create(fares)
+            fares = []
+    FlightFare.objects.bulk_create(fares)
+
+    FlightDetail.objects.update(
+        seat_size = Coalesce(F('first_class_seat_size'), 0) + Coalesce(F('second_class_seat_size'), 0),
+        tickets = F('first_class_tickets') + F('second_class_tickets'),
+        tickets_sold = F('first_class_tickets_sold') + F('second_class_tickets_sold'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_ticket_is_canceled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flightdetail',
+            name='seat_size',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='flightdetail',
+            name='tickets',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='flightdetail',
+            name='tickets_sold',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='FlightFare',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seat_size', models.IntegerField(default=0)),
+                ('price', models.IntegerField(null=True)),
+                ('tickets', models.IntegerField(default=0)),
+                ('tickets_sold', models.IntegerField(default=0)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('flight', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fares', to='main.flight')),
+                ('ticket_class', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.ticketclass')),
+            ],
+            options={
+                'ordering': ('ticket_class_id',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='flightfare',
+            constraint=models.UniqueConstraint(fields=('flight', 'ticket_class'), name='fare_flight_class_unique'),
+        ),
+        migrations.RunPython(populate_fares, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='flightdetail',
+            name='first_class_seat_size',
+        ),
+        migrations.RemoveField(
+            model_name='flightdetail',
+            name='first_class_ticket_price',
+        ),
+        migrations.RemoveField(
+            model_name='flightdetail',
+            name='first_class_tickets',
+        ),
+        migrations.RemoveField(
+            model_name='flightdetail',
+            name='first_class_tickets_sold',
+        ),
+        migrations.RemoveField(
+            model_name='flightdetail',
+            name='second_class_seat_size',
+        ),
+        migrations.RemoveField(
+            model_name='flightdetail',
+            name='second_class_ticket_price',
+        ),
+        migrations.RemoveField(
+            model_name='flightdetail',
+            name='second_class_tickets',
+        ),
+        migrations.RemoveField(
+            model_name='flightdetail',
+            name='second_class_tickets_sold',
+        ),
+    ]
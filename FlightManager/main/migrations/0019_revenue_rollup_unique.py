@@ -0,0 +1,45 @@
+# Generated by Django 4.0.6 on 2026-10-18 20:21
+
+from django.db import migrations, models
+import django.db.models.expressions
+import django.db.models.functions.comparison
+
+
+def merge_duplicate_buckets(apps, schema_editor):
+    '''Sum rollup rows of the same bucket into one, before they are made unique.
+    '''
+    RevenueRollup = apps.get_model('main', 'RevenueRollup')
+    fields = ('total_flights', 'total_tickets_sold', 'revenue')
+    buckets = {}
+    duplicate_ids = []
+
+    for rollup in RevenueRollup.objects.order_by('id').iterator():
+        key = (rollup.month, rollup.departure_airport_id, rollup.arrival_airport_id, rollup.ticket_class_id)
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = rollup
+            continue
+
+        for field in fields:
+            setattr(bucket, field, getattr(bucket, field) + getattr(rollup, field))
+        bucket.merged = True
+        duplicate_ids.append(rollup.id)
+
+    for start in range(0, len(duplicate_ids), 500):
+        RevenueRollup.objects.filter(id__in = duplicate_ids[start:start + 500]).delete()
+    RevenueRollup.objects.bulk_update([bucket for bucket in buckets.values() if hasattr(bucket, 'merged')], fields, batch_size = 500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_flight_fares'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_buckets, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='revenuerollup',
+            constraint=models.UniqueConstraint(django.db.models.expressions.F('month'), django.db.models.functions.comparison.Coalesce('departure_airport', 0), django.db.models.functions.comparison.Coalesce('arrival_airport', 0), django.db.models.functions.comparison.Coalesce('ticket_class', 0), name='rollup_bucket_unique'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.6 on 2026-10-18 20:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0019_revenue_rollup_unique'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='ticket',
+            name='ticket_unpaid_flight_idx',
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(condition=models.Q(models.Q(('is_booked', False), ('is_booked__isnull', True), _connector='OR'), ('is_canceled', False)), fields=['flight'], name='ticket_unpaid_flight_idx'),
+        ),
+    ]
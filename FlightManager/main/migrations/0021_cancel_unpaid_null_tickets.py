@@ -0,0 +1,29 @@
+# Generated by Django 4.0.6 on 2026-10-18 21:10
+
+from django.db import migrations
+from django.db.models import Q
+from django.utils.timezone import now
+
+
+def cancel_unpaid_tickets(apps, schema_editor):
+    '''Cancel unpaid tickets of flights that already took off,
+    is_booked NULL included (0017 only canceled is_booked False).
+    '''
+    Ticket = apps.get_model('main', 'Ticket')
+
+    Ticket.objects.filter(
+        Q(is_booked = False) | Q(is_booked__isnull = True),
+        is_canceled = False,
+        flight__date_time__lte = now(),
+    ).update(is_canceled = True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0020_ticket_unpaid_null'),
+    ]
+
+    operations = [
+        migrations.RunPython(cancel_unpaid_tickets, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.utils.timezone import now
 
@@ -19,7 +21,8 @@ class Customer(models.Model):
         return 'Unamed Customer'
     
     def is_in_group(self, group_name : str) -> bool:
-        return self.user.groups.filter(name = group_name).exists()
+        from .service import RoleService
+        return RoleService().is_in_group(self.user, group_name)
 
 class Manager(Customer):
     def __str__(self):
@@ -42,23 +45,51 @@ class Airport(models.Model):
         '''
         ordering = ('-id',)
 
+class FlightQuerySet(models.QuerySet):
+    def with_inventory(self) -> 'FlightQuerySet':
+        '''Annotate seat inventory of every Flight in the same query,
+        so list pages do not touch FlightDetail or Ticket rows one by one.
+
+        Flight properties (total_seats, total_tickets, is_bookable, ...)
+        read these annotations when they are present.
+        '''
+        return self.annotate(
+            seats_count = Coalesce(F('flightdetail__seat_size'), 0),
+            tickets_count = Coalesce(F('flightdetail__tickets'), 0),
+            tickets_sold_count = Coalesce(F('flightdetail__tickets_sold'), 0),
+        ).annotate(
+            remaining_seats = F('seats_count') - F('tickets_count'),
+        )
+
 class Flight(models.Model):
     departure_airport = models.ForeignKey(Airport, null = True, on_delete = models.CASCADE, related_name = "departure_airport")
     arrival_airport = models.ForeignKey(Airport, null = True, on_delete = models.CASCADE, related_name = "arrival_airport")
     date_time = models.DateTimeField()
     date_created = models.DateTimeField(auto_now_add = True)
+
+    objects = FlightQuerySet.as_manager()
     
     def __str__(self) -> str:
         return f'Flight {self.id}'
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        '''Remember loaded values, so report rollups know what changed on save.
+        '''
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
     
     @property
     def total_seats(self) -> int:
         '''Return total seats of this Flight.
         '''
+        if hasattr(self, 'seats_count'):
+            return self.seats_count
+
         try:
-            result = self.flightdetail.first_class_seat_size + self.flightdetail.second_class_seat_size
-            return result
-        except TypeError:
+            return self.flightdetail.seat_size
+        except FlightDetail.DoesNotExist:
             return 0
 
     @property
@@ -67,18 +98,47 @@ class Flight(models.Model):
     
     @property
     def is_bookable(self) -> bool:
-        return not self.is_departed and self.total_tickets < self.total_seats
+        '''Not departed, not past the booking_cutoff Policy and with seats left.
+        '''
+        from .service import PolicyService
+
+        if self.is_departed or self.date_time <= now() + PolicyService().booking_cutoff():
+            return False
+
+        if hasattr(self, 'remaining_seats'):
+            return self.remaining_seats > 0
+
+        return self.total_tickets < self.total_seats
     
     @property
-    def total_tickets(self) -> bool:
-        return self.ticket_set.count()
+    def total_tickets(self) -> int:
+        '''Return total tickets booked (paid or not) of this Flight.
+        '''
+        if hasattr(self, 'tickets_count'):
+            return self.tickets_count
+
+        try:
+            return self.flightdetail.tickets
+        except FlightDetail.DoesNotExist:
+            return self.ticket_set.count()
 
     @property
     def total_tickets_sold(self) -> int:
-        return self.ticket_set.filter(is_booked = True).count()
+        '''Return total tickets paid of this Flight.
+        '''
+        if hasattr(self, 'tickets_sold_count'):
+            return self.tickets_sold_count
+
+        try:
+            return self.flightdetail.tickets_sold
+        except FlightDetail.DoesNotExist:
+            return self.ticket_set.filter(is_booked = True).count()
     
     @property
     def ticket_sold_percentage(self) -> float:
+        if hasattr(self, 'sold_percentage'):
+            return self.sold_percentage
+
         try:
             return self.total_tickets_sold * 100 / self.total_seats
         except ZeroDivisionError:
@@ -87,16 +147,27 @@ class Flight(models.Model):
     class Meta:
         '''Paginator requires explicitly ordering definition
         in order to sort Airports correctly.
+
+        Indexes match FlightFilter (route + date range),
+        upcoming flight lists and reports (date_time).
         '''
         ordering = ('date_time',)
+        indexes = [
+            models.Index(fields = ['departure_airport', 'arrival_airport', 'date_time'], name = 'flight_route_date_idx'),
+            models.Index(fields = ['date_time'], name = 'flight_date_idx'),
+        ]
 
 class FlightDetail(models.Model):
     flight = models.OneToOneField(Flight, null = True, blank = True, on_delete = models.CASCADE)
     flight_time =  models.IntegerField(null = True)
-    first_class_seat_size = models.IntegerField(null = True)
-    first_class_ticket_price = models.IntegerField(null = True)
-    second_class_seat_size = models.IntegerField(null = True)
-    second_class_ticket_price = models.IntegerField(null = True)
+
+    # Totals of its FlightFares, so seat inventory is one join away from Flight.
+    # Counters are maintained by signals on Ticket, rebuild them with
+    # `manage.py rebuild_seat_counters`.
+    seat_size = models.IntegerField(default = 0)
+    tickets = models.IntegerField(default = 0)
+    tickets_sold = models.IntegerField(default = 0)
+
     date_created = models.DateTimeField(auto_now_add = True)
 
     def __str__(self) -> str:
@@ -119,6 +190,67 @@ class TicketClass(models.Model):
     def __str__(self):
         return self.name
 
+class FlightFare(models.Model):
+    '''Seats and ticket price of one TicketClass on a Flight.
+    A class without a fare is not sold on that Flight.
+    '''
+    flight = models.ForeignKey(Flight, on_delete = models.CASCADE, related_name = 'fares')
+    ticket_class = models.ForeignKey(TicketClass, on_delete = models.CASCADE)
+    seat_size = models.IntegerField(default = 0)
+    price = models.IntegerField(null = True)
+
+    # Denormalized seat counters, maintained by signals on Ticket.
+    tickets = models.IntegerField(default = 0)
+    tickets_sold = models.IntegerField(default = 0)
+
+    date_created = models.DateTimeField(auto_now_add = True)
+
+    def __str__(self) -> str:
+        return f'{self.ticket_class} fare of {self.flight}'
+
+    @property
+    def ticket_class_name(self) -> str:
+        '''Name of its TicketClass, from the cached names instead of a query per fare.
+        '''
+        from .service import FareService
+        return FareService().get_ticket_class_names().get(self.ticket_class_id)
+
+    class Meta:
+        ordering = ('ticket_class_id',)
+        constraints = [
+            models.UniqueConstraint(fields = ['flight', 'ticket_class'], name = 'fare_flight_class_unique'),
+        ]
+
+'''is_booked of unpaid Tickets, same condition as the ticket_unpaid_flight_idx index.
+'''
+UNPAID = Q(is_booked = False) | Q(is_booked__isnull = True)
+
+class TicketQuerySet(models.QuerySet):
+    '''update() and bulk_update() send no signal: changing flight, ticket_class,
+    is_booked or price through them leaves seat counters and report rollups
+    behind, save each Ticket instead, or run `manage.py rebuild_seat_counters`
+    and `manage.py rebuild_revenue_rollup` afterwards. is_canceled is safe to
+    update, neither counters nor rollups depend on it.
+    '''
+
+    def canceled(self) -> 'TicketQuerySet':
+        return self.filter(is_canceled = True)
+
+    def active(self) -> 'TicketQuerySet':
+        '''Tickets paid, or unpaid and still payable.
+        '''
+        return self.filter(is_canceled = False)
+
+    def unpaid(self) -> 'TicketQuerySet':
+        '''Tickets not paid nor canceled, is_booked is NULL on some older Tickets.
+        '''
+        return self.filter(UNPAID, is_canceled = False)
+
+    def due_for_cancellation(self) -> 'TicketQuerySet':
+        '''Unpaid Tickets of departed flights, not canceled yet.
+        '''
+        return self.unpaid().filter(flight__date_time__lte = now())
+
 class Ticket(models.Model):
     customer = models.ForeignKey(Customer, null = True, on_delete = models.CASCADE)
     flight = models.ForeignKey(Flight, null = True, on_delete = models.CASCADE)
@@ -130,29 +262,97 @@ class Ticket(models.Model):
     identity_code = models.CharField(max_length = 200, null = True)
 
     is_booked = models.BooleanField(null = True, default = False)
+
+    # Set when the flight takes off and the Ticket is still unpaid,
+    # by `manage.py cancel_unpaid_tickets` (run it periodically).
+    is_canceled = models.BooleanField(default = False)
+
     price = models.IntegerField(null = True)
     date_created = models.DateTimeField(auto_now_add = True)
 
+    objects = TicketQuerySet.as_manager()
+
     def __str__(self) -> str:
         return f'{self.flight} ticket booked by {self.customer}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        '''Remember loaded values, so seat counters and report rollups know what changed on save.
+        '''
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        '''Save in the same transaction as the seat counters and report rollups
+        updated by signals, so either all of them are written or none.
+        '''
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            return super().delete(*args, **kwargs)
+
     @property
     def can_update(self) -> bool:
         '''Can only update Tickets with Flight non-departed and unpaid.
         '''
         return not self.flight.is_departed and not self.is_booked
 
-    @property
-    def is_canceled(self) -> bool:
-        '''Tickets are canceled automatically when flight taken off and still unpaid.
-        '''
-        return self.flight.is_departed and not self.is_booked
-
     class Meta:
         '''Paginator requires explicitly ordering definition
         in order to sort Tickets correctly.
+
+        Indexes match seat/sales counting per flight and class,
+        the ticket list of a customer, and the unpaid Tickets
+        the cancellation sweeper looks at (a partial index, it stays small).
         '''
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields = ['flight', 'ticket_class', 'is_booked'], name = 'ticket_flight_class_idx'),
+            models.Index(fields = ['customer', '-date_created'], name = 'ticket_customer_created_idx'),
+            models.Index(
+                fields = ['flight'],
+                condition = UNPAID & Q(is_canceled = False),
+                name = 'ticket_unpaid_flight_idx',
+            ),
+        ]
+
+class RevenueRollup(models.Model):
+    '''Monthly report totals per route and ticket class.
+
+    Maintained by signals on Flight and Ticket, rebuild them with
+    `manage.py rebuild_revenue_rollup`. Flights are counted in the rows
+    without ticket class, tickets and revenue in the rows with one.
+    There is one row per bucket, missing airports and class included
+    (NULLs are compared as 0 by the unique constraint).
+    '''
+    month = models.DateField()
+    departure_airport = models.ForeignKey(Airport, null = True, on_delete = models.CASCADE, related_name = '+')
+    arrival_airport = models.ForeignKey(Airport, null = True, on_delete = models.CASCADE, related_name = '+')
+    ticket_class = models.ForeignKey(TicketClass, null = True, on_delete = models.CASCADE, related_name = '+')
+    total_flights = models.IntegerField(default = 0)
+    total_tickets_sold = models.IntegerField(default = 0)
+    revenue = models.IntegerField(default = 0)
+
+    def __str__(self) -> str:
+        return f'Rollup of {self.month:%Y-%m} ({self.departure_airport_id} - {self.arrival_airport_id})'
+
+    class Meta:
+        ordering = ('month',)
+        indexes = [
+            models.Index(fields = ['month', 'departure_airport', 'arrival_airport', 'ticket_class'], name = 'rollup_month_route_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                'month',
+                Coalesce('departure_airport', 0),
+                Coalesce('arrival_airport', 0),
+                Coalesce('ticket_class', 0),
+                name = 'rollup_bucket_unique',
+            ),
+        ]
 
 class Reservation(models.Model):
     ticket = models.OneToOneField(Ticket, null = True, blank = True, on_delete = models.CASCADE)
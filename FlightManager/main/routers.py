@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+class ReplicaRouter:
+    '''Keep writes and migrations on the default database, with a read replica beside it.
+
+    Reads are only sent to the replica on purpose: FlightService search and
+    report querysets call read_alias() while a view marked with
+    ReplicaReadMixin handles a GET, see ReplicaRouter.reads. Everything else
+    (sessions, bookings, seat checks) reads the default database.
+
+    After a booking or payment, pin_primary keeps the user's reads on the
+    default database for READ_REPLICA_STICKINESS seconds, so they see their
+    own writes while the replica catches up.
+    '''
+
+    '''Whether the current request may read from the replica.
+    A ContextVar is local to each thread (and asyncio task).
+    '''
+    replica_reads = ContextVar('replica_reads', default = False)
+
+    '''Session key of the time until which the user reads from the default database.
+    '''
+    session_key = 'main:primary_until'
+
+    @classmethod
+    def replica_alias(cls) -> str:
+        '''Alias of the replica, None when it is not configured.
+        '''
+        alias = getattr(settings, 'READ_REPLICA_DATABASE', None)
+        return alias if alias and alias in connections.settings else None
+
+    @classmethod
+    def read_alias(cls) -> str:
+        '''Database the current request should read search and report rows from.
+        '''
+        if cls.replica_reads.get():
+            return cls.replica_alias() or DEFAULT_DB_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    @classmethod
+    @contextmanager
+    def reads(cls, request = None):
+        '''Let read_alias() return the replica in this block,
+        unless the session of request is pinned to the default database.
+        '''
+        token = cls.replica_reads.set(request is None or not cls.is_pinned(request))
+        try:
+            yield
+        finally:
+            cls.replica_reads.reset(token)
+
+    @classmethod
+    def pin_primary(cls, request) -> None:
+        '''Read from the default database for the next READ_REPLICA_STICKINESS seconds.
+        '''
+        request.session[cls.session_key] = time.time() + getattr(settings, 'READ_REPLICA_STICKINESS', 15)
+
+    @classmethod
+    def is_pinned(cls, request) -> bool:
+        session = getattr(request, 'session', None)
+        return session is not None and session.get(cls.session_key, 0) > time.time()
+
+    def db_for_read(self, model, **hints):
+        # Rows loaded from the replica load their relations from it too (Django's default).
+        return None
+
+    def db_for_write(self, model, **hints):
+        '''Always the default database, even for rows loaded from the replica.
+        '''
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        '''Rows of the default database and of its replica are the same rows.
+        '''
+        databases = {DEFAULT_DB_ALIAS, self.replica_alias()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name = None, **hints):
+        '''The replica gets its schema from the default database.
+        '''
+        if db == self.replica_alias():
+            return False
+        return None
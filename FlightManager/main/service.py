@@ -1,9 +1,25 @@
-from django.db.models import Sum, Count, Q
-from django.db.models.functions import Coalesce, TruncMonth
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from types import MappingProxyType
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, connection, transaction, IntegrityError, OperationalError
+from django.db.models import Sum, Count, Q, F, OuterRef, Subquery, DateField, FloatField
+from django.db.models.functions import Cast, Coalesce, NullIf, TruncMonth
 from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_datetime
+from django.utils.html import escape
+from django.utils.timezone import is_naive, localtime, make_aware, now
 
 from .dao import *
+from .itinerary import FlightGraph, FlightLeg
+from .typeahead import AirportIndex
 from .models import *
+from .routers import ReplicaRouter
 
 class AirportService:
     def __init__(self):
@@ -14,6 +30,237 @@ class AirportService:
         '''
         return self.airport_dao.all()
 
+class AirportCatalogService:
+    '''(id, name) of every Airport, for dropdowns.
+
+    The catalog is stored in Django's cache under a version, which is
+    replaced when an Airport is saved or deleted (see signals). Each process
+    also keeps the current version in memory, with its <option> block
+    rendered once and its typeahead AirportIndex.
+    '''
+    version_key = 'main:airports:version'
+
+    _version = None
+    _catalog = None
+    _options = None
+    _index = None
+    _index_version = None
+    _lock = threading.Lock()
+
+    def __init__(self) -> None:
+        self.airport_dao = Airport.objects
+        self.cache = cache
+
+    def catalog_key(self, version : int) -> str:
+        return f'main:airports:catalog:{version}'
+
+    def get_version(self) -> int:
+        version = self.cache.get(self.version_key)
+        if version is None:
+            self.cache.add(self.version_key, time.time_ns(), None)
+            version = self.cache.get(self.version_key)
+        return version
+
+    def load(self) -> None:
+        '''Make sure this process holds the current version of the catalog.
+        '''
+        version = self.get_version()
+        if version == AirportCatalogService._version:
+            return
+
+        key = self.catalog_key(version)
+        catalog = self.cache.get(key)
+        if catalog is None:
+            catalog = list(self.airport_dao.values_list('id', 'name'))
+            self.cache.set(key, catalog, None)
+
+        options = ''.join(
+            f'<option value="{airport_id}">{escape(name)}</option>' for airport_id, name in catalog
+        )
+
+        with AirportCatalogService._lock:
+            AirportCatalogService._version = version
+            AirportCatalogService._catalog = catalog
+            AirportCatalogService._options = options
+
+    def get_choices(self) -> list:
+        '''Get [(id, name)] of every Airport, in Airport ordering.
+        '''
+        self.load()
+        return AirportCatalogService._catalog
+
+    def get_options_html(self) -> str:
+        '''Get the <option> tags of every Airport (none selected).
+        '''
+        self.load()
+        return AirportCatalogService._options
+
+    def get_index(self) -> AirportIndex:
+        '''Get the typeahead index of the current catalog version.
+        '''
+        self.load()
+
+        with AirportCatalogService._lock:
+            if AirportCatalogService._index_version != AirportCatalogService._version:
+                AirportCatalogService._index = AirportIndex(AirportCatalogService._catalog)
+                AirportCatalogService._index_version = AirportCatalogService._version
+
+            return AirportCatalogService._index
+
+    def search(self, query : str, limit : int = 10) -> list:
+        '''Get [(id, name)] of the airports best matching a typed name.
+        '''
+        index = self.get_index()
+        with AirportCatalogService._lock:
+            return index.search(query, limit)
+
+    def get_name(self, airport_id : int) -> str:
+        return self.get_index().names.get(airport_id)
+
+    def invalidate(self, airport : Airport = None, deleted : bool = False) -> None:
+        '''Replace the catalog version. The typeahead index of this process
+        is updated in place for the given airport instead of being rebuilt.
+        '''
+        version = time.time_ns()
+        self.cache.set(self.version_key, version, None)
+
+        with AirportCatalogService._lock:
+            index = AirportCatalogService._index
+            if airport is None or index is None or AirportCatalogService._index_version != AirportCatalogService._version:
+                return
+
+            if deleted:
+                index.remove(airport.pk)
+            else:
+                index.add(airport.pk, airport.name)
+            AirportCatalogService._index_version = version
+
+class PolicySnapshot:
+    '''Applied Policies at one version, read-only, values converted to their datatype.
+    '''
+    __slots__ = ('version', 'values')
+
+    def __init__(self, version : int, values : dict) -> None:
+        self.version = version
+        self.values = MappingProxyType(dict(values))
+
+    def get(self, name : str, default = None):
+        return self.values.get(name, default)
+
+class PolicyService:
+    '''Registry of applied Policies, for booking rules.
+
+    Every process keeps a PolicySnapshot in memory. The applied Policies
+    are stored in Django's cache under a version, which is replaced when
+    a Policy is saved or deleted (see signals), and a process checks that
+    version at most every recheck_interval seconds. Lookups never query the database.
+    '''
+    version_key = 'main:policies:version'
+
+    MIN_CONNECTION_TIME = 'min_connection_time'
+    BOOKING_CUTOFF = 'booking_cutoff'
+    MAX_TICKETS_PER_CUSTOMER = 'max_tickets_per_customer'
+
+    '''Converters of Policy.value, by Policy.datatype.
+    '''
+    converters = {
+        'int' : int,
+        'integer' : int,
+        'bool' : bool,
+        'boolean' : bool,
+        'minutes' : lambda value: timedelta(minutes = value),
+        'hours' : lambda value: timedelta(hours = value),
+        'days' : lambda value: timedelta(days = value),
+    }
+
+    '''Seconds a process trusts its snapshot before checking the version again.
+    '''
+    recheck_interval = getattr(settings, 'POLICY_RECHECK_INTERVAL', 1)
+
+    _snapshot = None
+    _checked_at = 0
+    _lock = threading.Lock()
+
+    def __init__(self) -> None:
+        self.policy_dao = Policy.objects
+        self.cache = cache
+
+    def snapshot_key(self, version : int) -> str:
+        return f'main:policies:snapshot:{version}'
+
+    def get_version(self) -> int:
+        version = self.cache.get(self.version_key)
+        if version is None:
+            self.cache.add(self.version_key, time.time_ns(), None)
+            version = self.cache.get(self.version_key)
+        return version
+
+    def convert(self, datatype : str, value : int):
+        converter = self.converters.get((datatype or 'int').strip().lower(), int)
+        return converter(value)
+
+    def get_snapshot(self) -> PolicySnapshot:
+        '''Get the PolicySnapshot of this process, reloaded when the version changed.
+        '''
+        snapshot = PolicyService._snapshot
+        if snapshot is not None and time.monotonic() - PolicyService._checked_at < self.recheck_interval:
+            return snapshot
+
+        version = self.get_version()
+        if snapshot is None or snapshot.version != version:
+            key = self.snapshot_key(version)
+            policies = self.cache.get(key)
+            if policies is None:
+                policies = list(self.policy_dao.filter(
+                    is_applied = True,
+                    value__isnull = False,
+                ).values_list('name', 'datatype', 'value').order_by('id'))
+                self.cache.set(key, policies, None)
+
+            snapshot = PolicySnapshot(version, {
+                name : self.convert(datatype, value) for name, datatype, value in policies
+            })
+
+        with PolicyService._lock:
+            PolicyService._snapshot = snapshot
+            PolicyService._checked_at = time.monotonic()
+
+        return snapshot
+
+    def get(self, name : str, default = None):
+        return self.get_snapshot().get(name, default)
+
+    def get_duration(self, name : str, default : timedelta) -> timedelta:
+        '''Get a duration Policy, plain integers are minutes.
+        '''
+        value = self.get(name, default)
+        if isinstance(value, timedelta):
+            return value
+        return timedelta(minutes = value)
+
+    def min_connection_time(self) -> timedelta:
+        '''Minimum time between two legs of an itinerary.
+        '''
+        return self.get_duration(self.MIN_CONNECTION_TIME, ItineraryService.min_connection)
+
+    def booking_cutoff(self) -> timedelta:
+        '''Flights cannot be booked this long before their departure.
+        '''
+        return self.get_duration(self.BOOKING_CUTOFF, timedelta())
+
+    def max_tickets_per_customer(self) -> int:
+        '''Most Tickets a customer can hold on one flight, 0 for no limit.
+        '''
+        return int(self.get(self.MAX_TICKETS_PER_CUSTOMER, 0))
+
+    def invalidate(self) -> None:
+        '''Replace the version, this process reloads at once, others within recheck_interval.
+        '''
+        self.cache.set(self.version_key, time.time_ns(), None)
+
+        with PolicyService._lock:
+            PolicyService._snapshot = None
+
 class TicketService:
     def __init__(self):
         self.ticket_dao = Ticket.objects
@@ -21,10 +268,22 @@ class TicketService:
     def get_ticket(self, ticket_id : int) -> Ticket:
         '''Get ticket with the given ID, or return 404.
         '''
-        return get_object_or_404(self.ticket_dao, id = ticket_id)
+        return get_object_or_404(self.get_ticket_queryset(), id = ticket_id)
+
+    def get_ticket_queryset(self) -> QuerySet:
+        '''Tickets with everything the booking views need, in one query.
+        '''
+        related_fields = [
+            'ticket_class',
+            'flight__flightdetail',
+            'flight__departure_airport',
+            'flight__arrival_airport',
+        ]
+
+        return self.ticket_dao.select_related(*related_fields)
 
     def get_ticket_list_queryset(self, customer : Customer) -> QuerySet:
-        '''Load ticket list of a customer
+        '''Load ticket list of a customer, with its flights and classes in the same query.
         '''
         related_fields = [
             'flight',
@@ -33,57 +292,462 @@ class TicketService:
 
         return self.ticket_dao.filter(
             customer = customer
-        ).prefetch_related(*related_fields)
+        ).select_related(*related_fields)
+
+    def cancel_unpaid_tickets(self, batch_size : int = 1000) -> int:
+        '''Cancel unpaid Tickets of departed flights, batch_size flights per UPDATE.
+        Return the number of Tickets canceled, running it again cancels nothing new.
+
+        update() sends no signal, which is fine: canceling changes neither
+        seat counters (a canceled Ticket keeps its seat) nor revenue (unpaid).
+        '''
+        total = 0
+
+        while True:
+            flight_ids = list(self.ticket_dao.due_for_cancellation().values_list(
+                'flight_id', flat = True,
+            ).order_by().distinct()[:batch_size])
+            if not flight_ids:
+                return total
+
+            total += self.ticket_dao.filter(
+                flight_id__in = flight_ids,
+            ).unpaid().update(is_canceled = True)
+
+    def restore_canceled_tickets(self, flight_id : int) -> int:
+        '''Make canceled Tickets of a Flight payable again, when it is rescheduled to the future.
+        '''
+        return self.ticket_dao.filter(
+            flight_id = flight_id,
+            flight__date_time__gt = now(),
+        ).canceled().update(is_canceled = False)
+
+class FareService:
+    '''Seats and ticket prices of Flights, one FlightFare per TicketClass sold.
+
+    The fare table of a Flight, {ticket_class_id: (seat_size, price)}, is read
+    on every booking, so it is kept in Django's cache until its fares change
+    (see signals). Seat counters change with every ticket and are not cached.
+
+    TicketClass names are stored in Django's cache under a version, which is
+    replaced when a TicketClass is saved or deleted (see signals). Each process
+    keeps the names of the current version in memory.
+    '''
+    names_version_key = 'main:ticket_classes:version'
+
+    '''Seconds to keep a fare table.
+    '''
+    cache_timeout = 60 * 60
+
+    _names = None
+    _names_version = None
+    _lock = threading.Lock()
 
-class FlightService:
     def __init__(self) -> None:
-        self.flight_dao = Flight.objects
+        self.cache = cache
+        self.flight_fare_dao = FlightFare.objects
         self.flight_detail_dao = FlightDetail.objects
+        self.ticket_class_dao = TicketClass.objects
+
+    def cache_key(self, flight_id : int) -> str:
+        return f'main:fares:{flight_id}'
+
+    def names_key(self, version : int) -> str:
+        return f'main:ticket_classes:names:{version}'
+
+    def get_names_version(self) -> int:
+        version = self.cache.get(self.names_version_key)
+        if version is None:
+            self.cache.add(self.names_version_key, time.time_ns(), None)
+            version = self.cache.get(self.names_version_key)
+        return version
 
-    def total_flights(self, year : int) -> int:
-        '''Get total flights in a year.
+    def get_ticket_class_names(self) -> dict:
+        '''Get {id: name} of every TicketClass, ordered by id.
         '''
-        return self.flight_dao.filter(
-            date_time__year = year,
-            date_time__lt = now(),
-        ).count()
+        version = self.get_names_version()
+        if version == FareService._names_version:
+            return FareService._names
+
+        key = self.names_key(version)
+        names = self.cache.get(key)
+        if names is None:
+            names = dict(self.ticket_class_dao.order_by('id').values_list('id', 'name'))
+            self.cache.set(key, names, None)
 
-    def total_tickets_sold(self, year : int) -> int:
-        '''Get total tickets sold in a year.
+        with FareService._lock:
+            FareService._names = names
+            FareService._names_version = version
+
+        return names
+
+    def invalidate_ticket_class_names(self) -> None:
+        '''Replace the TicketClass names version, every process reloads on its next lookup.
         '''
-        return sum(self.flight_dao.filter(
-            date_time__year = year,
-            date_time__lt = now(),
-        ).annotate(
-            tickets_sold = Count(
-                'ticket__id',
-                filter = Q(ticket__is_booked = True),
-            )
-        ).values_list('tickets_sold', flat = True))
+        self.cache.set(self.names_version_key, time.time_ns(), None)
 
-    def total_revenue(self, year : int) -> int:
-        '''Get total revenue of a year.
+    def get_fare_table(self, flight_id : int) -> dict:
+        '''Get {ticket_class_id: (seat_size, price)} of a Flight.
         '''
-        return sum(self.flight_dao.filter(
-            date_time__year = year,
-            date_time__lt = now(),
-        ).annotate(
-            revenue = Coalesce(Sum(
-                'ticket__price',
-                filter = Q(ticket__is_booked = True),
-            ), 0)
-        ).values_list('revenue', flat = True))
+        key = self.cache_key(flight_id)
+        table = self.cache.get(key)
+
+        if table is None:
+            table = {
+                ticket_class_id : (seat_size, price)
+                for ticket_class_id, seat_size, price in self.flight_fare_dao.filter(
+                    flight_id = flight_id,
+                ).values_list('ticket_class_id', 'seat_size', 'price')
+            }
+            self.cache.set(key, table, self.cache_timeout)
+
+        return table
+
+    def get_price(self, flight_id : int, ticket_class_id : int) -> int:
+        '''Ticket price of a class on a Flight, None if the class is not sold on it.
+        '''
+        _, price = self.get_fare_table(flight_id).get(ticket_class_id, (0, None))
+        return price
+
+    def get_fare(self, flight_id : int, ticket_class_id : int) -> FlightFare:
+        '''Get the FlightFare of a class with its current seat counters, None if the class is not sold.
+        '''
+        return self.flight_fare_dao.filter(
+            flight_id = flight_id,
+            ticket_class_id = ticket_class_id,
+        ).first()
+
+    def get_fares(self, flight_ids) -> dict:
+        '''Get {flight_id: [FlightFare]} of many Flights in one query.
+        '''
+        fares = defaultdict(list)
+        for fare in self.flight_fare_dao.filter(flight_id__in = flight_ids):
+            fares[fare.flight_id].append(fare)
+        return dict(fares)
+
+    def set_fares(self, flight_id : int, fares : dict) -> None:
+        '''Save {ticket_class_id: (seat_size, price)} of a Flight in one transaction.
+        Classes left out keep their fare. A class given None is no longer sold:
+        its fare is deleted, unless tickets were booked in it meanwhile.
+        '''
+        with transaction.atomic():
+            existing = {fare.ticket_class_id : fare for fare in self.flight_fare_dao.filter(flight_id = flight_id)}
+            created = []
+            updated = []
+            removed = []
+
+            for ticket_class_id, values in fares.items():
+                fare = existing.get(ticket_class_id)
+                if values is None:
+                    if fare is not None:
+                        removed.append(ticket_class_id)
+                    continue
+
+                seat_size, price = values
+                if fare is None:
+                    created.append(FlightFare(
+                        flight_id = flight_id,
+                        ticket_class_id = ticket_class_id,
+                        seat_size = seat_size,
+                        price = price,
+                    ))
+                elif (fare.seat_size, fare.price) != (seat_size, price):
+                    fare.seat_size = seat_size
+                    fare.price = price
+                    updated.append(fare)
+
+            if not created and not updated and not removed:
+                return
+
+            self.flight_fare_dao.filter(
+                flight_id = flight_id,
+                ticket_class_id__in = removed,
+                tickets = 0,
+            ).delete()
+            self.flight_fare_dao.bulk_create(created)
+            self.flight_fare_dao.bulk_update(updated, ['seat_size', 'price'])
+            self.refresh_seat_size(flight_id)
+
+    def refresh_seat_size(self, flight_id : int) -> None:
+        '''Sum the seats of a Flight's fares into its FlightDetail and forget its fare table.
+        '''
+        self.invalidate(flight_id)
+
+        flight_detail = self.flight_detail_dao.filter(flight_id = flight_id).first()
+        if flight_detail is None:
+            return
+
+        flight_detail.seat_size = self.flight_fare_dao.filter(
+            flight_id = flight_id,
+        ).aggregate(total = Coalesce(Sum('seat_size'), 0))['total']
+        flight_detail.save(update_fields = ['seat_size'])
+
+    def invalidate(self, *flight_ids : int) -> None:
+        '''Forget cached fare tables of the given Flights.
+        '''
+        self.cache.delete_many([self.cache_key(flight_id) for flight_id in flight_ids])
+
+class SeatCounterService:
+    '''Maintain seat counters of FlightFare and their totals on FlightDetail.
+
+    A ticket state is a dict with flight_id, ticket_class_id and is_booked.
+    Tickets of a class not sold on their flight have no fare and are not counted.
+    Canceled Tickets keep their seat: their flight has departed, it is not sold again.
+
+    Counters move in the transaction of Ticket.save/delete (see signals),
+    Ticket updates made with QuerySet.update() are not counted, see TicketQuerySet.
+    '''
+
+    counter_fields = ('tickets', 'tickets_sold')
+
+    def __init__(self) -> None:
+        self.flight_detail_dao = FlightDetail.objects
+        self.flight_fare_dao = FlightFare.objects
+        self.ticket_dao = Ticket.objects
+
+    def apply(self, old_state : dict, new_state : dict) -> None:
+        '''Move a ticket from old_state to new_state (either can be None)
+        with one atomic UPDATE per affected fare and its flight.
+        '''
+        deltas = defaultdict(lambda: defaultdict(int))
+
+        for state, sign in ((old_state, -1), (new_state, 1)):
+            if state is None or state['flight_id'] is None or state['ticket_class_id'] is None:
+                continue
+
+            counters = deltas[(state['flight_id'], state['ticket_class_id'])]
+            counters['tickets'] += sign
+            if state['is_booked']:
+                counters['tickets_sold'] += sign
+
+        for (flight_id, ticket_class_id), counters in deltas.items():
+            fields = {field : F(field) + delta for field, delta in counters.items() if delta != 0}
+            if not fields:
+                continue
+
+            with transaction.atomic():
+                if self.flight_fare_dao.filter(flight_id = flight_id, ticket_class_id = ticket_class_id).update(**fields):
+                    self.flight_detail_dao.filter(flight_id = flight_id).update(**fields)
+
+    def expected_counters(self) -> dict:
+        '''FlightFare counter values computed from the Ticket table, as expressions.
+        '''
+        tickets = self.ticket_dao.filter(
+            flight = OuterRef('flight'),
+            ticket_class = OuterRef('ticket_class'),
+        ).order_by().values('flight')
+
+        return {
+            'tickets' : Coalesce(Subquery(
+                tickets.annotate(total = Count('id')).values('total')
+            ), 0),
+            'tickets_sold' : Coalesce(Subquery(
+                tickets.filter(is_booked = True).annotate(total = Count('id')).values('total')
+            ), 0),
+        }
+
+    def expected_totals(self) -> dict:
+        '''FlightDetail totals computed from its FlightFares, as expressions.
+        '''
+        fares = self.flight_fare_dao.filter(flight = OuterRef('flight')).order_by().values('flight')
+
+        return {
+            field : Coalesce(Subquery(fares.annotate(total = Sum(field)).values('total')), 0)
+            for field in ('seat_size',) + self.counter_fields
+        }
+
+    def rebuild(self) -> int:
+        '''Recompute every fare counter from the Ticket table, then the FlightDetail totals.
+        Return the number of FlightDetails.
+        '''
+        with transaction.atomic():
+            self.flight_fare_dao.update(**self.expected_counters())
+            return self.flight_detail_dao.update(**self.expected_totals())
+
+    def get_mismatched_queryset(self) -> QuerySet:
+        '''FlightDetails whose totals or fare counters differ from the Ticket table.
+        '''
+        counters = self.expected_counters()
+        fare_mismatch = Q()
+        for field in counters:
+            fare_mismatch |= ~Q(**{field : F(f'expected_{field}')})
+
+        mismatched_fares = self.flight_fare_dao.annotate(**{
+            f'expected_{field}' : expression for field, expression in counters.items()
+        }).filter(fare_mismatch).values('flight_id')
+
+        totals = self.expected_totals()
+        mismatch = Q(flight_id__in = mismatched_fares)
+        for field in totals:
+            mismatch |= ~Q(**{field : F(f'expected_{field}')})
+
+        return self.flight_detail_dao.annotate(**{
+            f'expected_{field}' : expression for field, expression in totals.items()
+        }).filter(mismatch)
+
+class ReservationResult:
+    '''Outcome of ReservationService.reserve.
+    '''
+    RESERVED = 'reserved'
+    SOLD_OUT = 'sold_out'
+    LIMIT_REACHED = 'limit_reached'
+
+    def __init__(self, status : str, ticket : Ticket = None) -> None:
+        self.status = status
+        self.ticket = ticket
+
+    @property
+    def is_reserved(self) -> bool:
+        return self.status == self.RESERVED
+
+    @property
+    def is_sold_out(self) -> bool:
+        return self.status == self.SOLD_OUT
+
+    @property
+    def is_limit_reached(self) -> bool:
+        return self.status == self.LIMIT_REACHED
+
+class ReservationService:
+    '''Book seats without overbooking.
+
+    The capacity check and the counter increment are one conditional UPDATE
+    on the FlightFare row of the class, so concurrent buyers are serialized
+    by the database row lock, then the Ticket is inserted in the same transaction.
+    The max_tickets_per_customer Policy is checked under that lock too.
+    '''
+
+    '''How many times to retry when the database is locked (SQLite).
+    '''
+    max_attempts = 20
+
+    '''OperationalError messages worth a retry: lock timeouts (SQLite)
+    and transactions killed by lock conflicts (PostgreSQL).
+    '''
+    lock_errors = ('locked', 'deadlock', 'could not serialize')
+
+    def __init__(self) -> None:
+        self.flight_detail_dao = FlightDetail.objects
+        self.flight_fare_dao = FlightFare.objects
+        self.ticket_dao = Ticket.objects
+        self.policy_service = PolicyService()
+
+        # Lock conflicts retried by this instance, see benchmark_concurrency.
+        self.retries = 0
+
+    @classmethod
+    def is_lock_error(cls, error : OperationalError) -> bool:
+        message = str(error).lower()
+        return any(lock_error in message for lock_error in cls.lock_errors)
+
+    def reserve(self, flight_id : int, ticket : Ticket) -> ReservationResult:
+        '''Save ticket on the given flight if its class still has seats.
+        Lock conflicts are retried, other database errors are raised at once.
+        '''
+        for attempt in range(self.max_attempts):
+            try:
+                return self._reserve(flight_id, ticket)
+            except OperationalError as error:
+                if attempt == self.max_attempts - 1 or not self.is_lock_error(error):
+                    raise
+
+                # The transaction was rolled back, the ticket is new again.
+                self.retries += 1
+                ticket.pk = None
+                ticket._state.adding = True
+                time.sleep(0.01 * (attempt + 1))
+
+    def _reserve(self, flight_id : int, ticket : Ticket) -> ReservationResult:
+        with transaction.atomic():
+            reserved = self.flight_fare_dao.filter(
+                flight_id = flight_id,
+                ticket_class_id = ticket.ticket_class_id,
+                tickets__lt = F('seat_size'),
+            ).update(tickets = F('tickets') + 1)
+
+            if not reserved:
+                return ReservationResult(ReservationResult.SOLD_OUT)
+
+            self.flight_detail_dao.filter(flight_id = flight_id).update(tickets = F('tickets') + 1)
+
+            # The seat is already counted, see signals.ticket_changed
+            ticket._seat_reserved = True
+
+            max_tickets = self.policy_service.max_tickets_per_customer()
+            if max_tickets and ticket.customer_id is not None and self.ticket_dao.filter(
+                flight_id = flight_id,
+                customer_id = ticket.customer_id,
+            ).active().count() >= max_tickets:
+                # Give the counted seat back.
+                transaction.set_rollback(True)
+                return ReservationResult(ReservationResult.LIMIT_REACHED)
+
+            ticket.flight_id = flight_id
+            ticket.save()
+
+        return ReservationResult(ReservationResult.RESERVED, ticket)
+
+class FlightService:
+    def __init__(self) -> None:
+        self.flight_dao = Flight.objects
+        self.flight_detail_dao = FlightDetail.objects
+
+    def yearly_summary(self, year : int) -> dict:
+        '''Get the monthly report of a year and its totals:
+        {'months', 'total_flights', 'total_tickets_sold', 'total_revenue', 'total_ratio'}.
+
+        Every month also has its 'ratio' of the yearly revenue. Totals are
+        summed from the monthly rows already in memory, not queried again.
+        '''
+        months = RevenueRollupService().get_yearly_report(year)
+
+        summary = {
+            'months' : months,
+            'total_flights' : sum(month['total_flights'] for month in months),
+            'total_tickets_sold' : sum(month['total_tickets_sold'] for month in months),
+            'total_revenue' : sum(month['revenue'] for month in months),
+        }
+
+        # Total ratio = 0 if no revenue made, 100 otherwise.
+        summary['total_ratio'] = (summary['total_revenue'] > 0) * 100
+
+        for month in months:
+            if summary['total_revenue'] == 0:
+                month['ratio'] = 0
+            else:
+                month['ratio'] = month['revenue'] * 100 / summary['total_revenue']
+
+        return summary
 
     def get_flight(self, flight_id : int) -> Flight:
-        '''Get flight and return 404 if not found.
+        '''Get flight (with its detail and airports) and return 404 if not found.
+        '''
+        return get_object_or_404(self.get_flight_queryset(), id = flight_id)
+
+    def get_flight_queryset(self) -> QuerySet:
+        '''Flights with detail and airports joined in.
         '''
-        return get_object_or_404(self.flight_dao, id = flight_id)
+        related_fields = [
+            'flightdetail',
+            'departure_airport',
+            'arrival_airport',
+        ]
+
+        return self.flight_dao.select_related(*related_fields)
     
     def get_flight_detail(self, flight_id : int) -> FlightDetail:
         '''Get flight detail.
         '''
-        flight = get_object_or_404(self.flight_dao, id = flight_id)
-        return get_object_or_404(self.flight_detail_dao, flight = flight)
+        return get_object_or_404(
+            self.flight_detail_dao.select_related('flight'),
+            flight_id = flight_id,
+        )
+
+    def get_read_queryset(self, queryset : QuerySet) -> QuerySet:
+        '''queryset on the database the current request reads search and report rows from,
+        the read replica inside ReplicaRouter.reads, the default database otherwise.
+        '''
+        return queryset.using(ReplicaRouter.read_alias())
 
     def get_flight_list_queryset(self) -> QuerySet:
         '''Get flight list queryset.
@@ -94,9 +758,9 @@ class FlightService:
             'arrival_airport',
         ]
 
-        return self.flight_dao.filter(
+        return self.get_read_queryset(self.flight_dao.filter(
             date_time__gt = now()
-        ).prefetch_related(*related_fields)
+        ).with_inventory().prefetch_related(*related_fields))
 
     def get_search_queryset(self, queryset : QuerySet) -> QuerySet:
         '''Get search queryset
@@ -107,28 +771,86 @@ class FlightService:
             'flightdetail',
         ]
 
-        return queryset.filter(
+        return self.get_read_queryset(queryset.filter(
             date_time__gt = now()
-        ).prefetch_related(*related_fields)
+        ).with_inventory().prefetch_related(*related_fields))
+
+    def get_cached_search_queryset(self, flight_ids : list) -> QuerySet:
+        '''Flights of a cached search result, with airports joined in.
+        Their inventory comes from the cache, see SearchCacheService.
+        '''
+        return self.get_read_queryset(self.flight_dao.filter(
+            id__in = flight_ids,
+        ).select_related('departure_airport', 'arrival_airport'))
 
     def get_general_report_queryset(self, queryset : QuerySet) -> QuerySet:
         '''Get general report queryset.
+
+        Seats and tickets sold come from the FlightDetail counters and
+        revenue and sold percentage are computed in the same query,
+        so a report page is one query whatever its size.
         '''
-        return queryset.filter(
+        return self.get_read_queryset(queryset).filter(
             date_time__lt = now()
-        ).prefetch_related(
-            'flightdetail'
-        ).annotate(
+        ).with_inventory().annotate(
             revenue = Coalesce(Sum(
                 'ticket__price',
                 filter = Q(ticket__is_booked = True),
-            ), 0)
-        ).order_by('date_time')
+            ), 0),
+            sold_percentage = Coalesce(
+                Cast('tickets_sold_count', FloatField()) * 100 / NullIf('seats_count', 0),
+                0.0,
+                output_field = FloatField(),
+            ),
+        ).order_by('date_time', 'id')
+
+    def get_flight_statistics(self, flights) -> dict:
+        '''Get {flight_id : {'seats', 'booked', 'empty', 'ratio', 'turnover'}}
+        of a Flight queryset or a list of Flight IDs, in one grouped query.
+
+        seats is the capacity, booked the paid Tickets, empty the seats
+        without any Ticket, ratio booked / seats and turnover the paid revenue.
+        '''
+        if not isinstance(flights, QuerySet):
+            flights = self.flight_dao.filter(id__in = list(flights))
+
+        rows = flights.with_inventory().annotate(
+            turnover = Coalesce(Sum(
+                'ticket__price',
+                filter = Q(ticket__is_booked = True),
+            ), 0),
+        ).values_list('id', 'seats_count', 'tickets_sold_count', 'remaining_seats', 'turnover').order_by()
+
+        return {
+            flight_id : {
+                'seats' : seats,
+                'booked' : booked,
+                'empty' : empty,
+                'ratio' : booked / seats if seats else 0,
+                'turnover' : turnover,
+            } for flight_id, seats, booked, empty, turnover in rows
+        }
+
+    def get_general_report_export_queryset(self, queryset : QuerySet) -> QuerySet:
+        '''Get general report rows as dicts, for exports.
+
+        Rows can be streamed with .iterator() without loading any model instance.
+        '''
+        return self.get_general_report_queryset(queryset).values(
+            'id',
+            'date_time',
+            'departure_airport__name',
+            'arrival_airport__name',
+            'seats_count',
+            'tickets_sold_count',
+            'revenue',
+            'sold_percentage',
+        )
 
     def get_yearly_report_queryset(self, queryset : QuerySet, year : int) -> QuerySet:
         '''Get yearly report queryset.
         '''
-        return queryset.filter(
+        return self.get_read_queryset(queryset).filter(
             date_time__year = year,
             date_time__lt = now(),
         ).annotate(
@@ -149,6 +871,1056 @@ class FlightService:
             ), 0)
         ).order_by('month')
 
+class RevenueRollupService:
+    '''Keep RevenueRollup rows in sync with Flights and paid Tickets.
+
+    Every change is applied as UPDATE ... SET field = field + delta,
+    so concurrent payments never overwrite each other. A bucket has one row
+    (see RevenueRollup), when two transactions create it at the same time
+    the second one gets an IntegrityError and updates the row instead.
+    '''
+
+    '''Flights being deleted by each thread, see get_deleting_flights.
+    '''
+    _local = threading.local()
+
+    def __init__(self) -> None:
+        self.rollup_dao = RevenueRollup.objects
+        self.flight_dao = Flight.objects
+        self.ticket_dao = Ticket.objects
+
+    @classmethod
+    def get_deleting_flights(cls) -> set:
+        '''IDs of the Flights the current thread is deleting, their tickets
+        were already subtracted and are skipped when deleted by cascade.
+
+        Filled by signals.flight_deleting and emptied once the Flight is gone,
+        or at the end of the request when the deletion failed.
+        '''
+        if not hasattr(cls._local, 'deleting_flights'):
+            cls._local.deleting_flights = set()
+        return cls._local.deleting_flights
+
+    def month_of(self, date_time : datetime) -> date:
+        '''First day of the month, in the same timezone as TruncMonth.
+        '''
+        return localtime(date_time).date().replace(day = 1)
+
+    def route_of(self, values : dict) -> tuple:
+        '''Get (month, departure_airport_id, arrival_airport_id) of Flight values.
+        '''
+        if values is None or values.get('date_time') is None:
+            return None
+
+        return (
+            self.month_of(values['date_time']),
+            values.get('departure_airport_id'),
+            values.get('arrival_airport_id'),
+        )
+
+    def add(self, route : tuple, ticket_class_id : int, **deltas : int) -> None:
+        '''Add deltas (total_flights, total_tickets_sold, revenue) to a bucket.
+        '''
+        deltas = {field : delta for field, delta in deltas.items() if delta}
+        if route is None or not deltas:
+            return
+
+        month, departure_airport_id, arrival_airport_id = route
+        lookup = {
+            'month' : month,
+            'departure_airport_id' : departure_airport_id,
+            'arrival_airport_id' : arrival_airport_id,
+            'ticket_class_id' : ticket_class_id,
+        }
+
+        fields = {field : F(field) + delta for field, delta in deltas.items()}
+
+        with transaction.atomic():
+            if self.rollup_dao.filter(**lookup).update(**fields):
+                return
+
+            try:
+                with transaction.atomic():
+                    self.rollup_dao.create(**lookup, **deltas)
+            except IntegrityError:
+                # Created by another transaction since the UPDATE.
+                self.rollup_dao.filter(**lookup).update(**fields)
+
+    def add_flights(self, flights : dict, buckets : dict = None) -> None:
+        '''Add total_flights to many buckets at once, flights maps routes to counts.
+
+        Flight buckets of a month are loaded in one query into buckets
+        ({month : {(departure_airport_id, arrival_airport_id) : id}}),
+        pass the same dict to every call of an import to load each month once.
+        Existing buckets get one UPDATE per distinct count, missing ones
+        are created with bulk_create.
+        '''
+        flights = {route : count for route, count in flights.items() if route is not None and count}
+        if not flights:
+            return
+
+        buckets = {} if buckets is None else buckets
+        existing = defaultdict(list)
+        missing = []
+
+        with transaction.atomic():
+            months = {month for month, _, _ in flights} - set(buckets)
+            for month in months:
+                buckets[month] = {}
+            for rollup_id, month, departure_airport_id, arrival_airport_id in self.rollup_dao.filter(
+                ticket_class = None,
+                month__in = months,
+            ).values_list('id', 'month', 'departure_airport_id', 'arrival_airport_id').order_by().iterator():
+                buckets[month][(departure_airport_id, arrival_airport_id)] = rollup_id
+
+            for (month, departure_airport_id, arrival_airport_id), count in flights.items():
+                rollup_id = buckets[month].get((departure_airport_id, arrival_airport_id))
+                if rollup_id is None:
+                    missing.append(RevenueRollup(
+                        month = month,
+                        departure_airport_id = departure_airport_id,
+                        arrival_airport_id = arrival_airport_id,
+                        total_flights = count,
+                    ))
+                else:
+                    existing[count].append(rollup_id)
+
+            for count, rollup_ids in existing.items():
+                self.rollup_dao.filter(id__in = rollup_ids).update(total_flights = F('total_flights') + count)
+
+            try:
+                with transaction.atomic():
+                    created = self.rollup_dao.bulk_create(missing)
+            except IntegrityError:
+                # Some buckets were created by another transaction meanwhile.
+                for rollup in missing:
+                    self.add((rollup.month, rollup.departure_airport_id, rollup.arrival_airport_id), None, total_flights = rollup.total_flights)
+                    buckets.pop(rollup.month, None)
+                created = []
+
+            for rollup in created:
+                if rollup.pk is None:
+                    # The database does not return ids, load the month again next time.
+                    buckets.pop(rollup.month, None)
+                else:
+                    buckets[rollup.month][(rollup.departure_airport_id, rollup.arrival_airport_id)] = rollup.pk
+
+    def move_flight(self, flight_id : int, old_route : tuple, new_route : tuple) -> None:
+        '''Move a Flight and its paid Tickets between buckets (either route can be None).
+        '''
+        if old_route == new_route:
+            return
+
+        tickets = []
+        if old_route is not None:
+            tickets = list(self.ticket_dao.filter(
+                flight_id = flight_id,
+                is_booked = True,
+            ).values('ticket_class_id').annotate(
+                sold = Count('id'),
+                total = Coalesce(Sum('price'), 0),
+            ).order_by())
+
+        for route, sign in ((old_route, -1), (new_route, 1)):
+            self.add(route, None, total_flights = sign)
+            for row in tickets:
+                self.add(
+                    route,
+                    row['ticket_class_id'],
+                    total_tickets_sold = sign * row['sold'],
+                    revenue = sign * row['total'],
+                )
+
+    def apply_ticket(self, old_state : dict, new_state : dict, flight : Flight = None) -> None:
+        '''Move a Ticket from old_state to new_state (either can be None).
+        Only paid Tickets count, flight is used instead of a query when given.
+        '''
+        deltas = defaultdict(lambda: defaultdict(int))
+
+        for state, sign in ((old_state, -1), (new_state, 1)):
+            if state is None or not state['is_booked'] or state['flight_id'] is None:
+                continue
+
+            if state['flight_id'] in self.get_deleting_flights():
+                continue
+
+            fields = deltas[(state['flight_id'], state['ticket_class_id'])]
+            fields['total_tickets_sold'] += sign
+            fields['revenue'] += sign * (state['price'] or 0)
+
+        for (flight_id, ticket_class_id), fields in deltas.items():
+            if not any(fields.values()):
+                continue
+
+            if flight is not None and flight.pk == flight_id:
+                values = flight.__dict__
+            else:
+                values = self.flight_dao.filter(pk = flight_id).values(
+                    'date_time', 'departure_airport_id', 'arrival_airport_id',
+                ).first()
+
+            self.add(self.route_of(values), ticket_class_id, **fields)
+
+    def rebuild(self) -> int:
+        '''Recompute every bucket from the Flight and Ticket tables.
+        '''
+        month = TruncMonth('date_time', output_field = DateField())
+        flights = self.flight_dao.annotate(
+            month = month,
+        ).values(
+            'month', 'departure_airport_id', 'arrival_airport_id',
+        ).annotate(
+            total = Count('id'),
+        ).order_by()
+
+        tickets = self.ticket_dao.filter(
+            is_booked = True,
+            flight__isnull = False,
+        ).annotate(
+            month = TruncMonth('flight__date_time', output_field = DateField()),
+        ).values(
+            'month', 'flight__departure_airport_id', 'flight__arrival_airport_id', 'ticket_class_id',
+        ).annotate(
+            sold = Count('id'),
+            total = Coalesce(Sum('price'), 0),
+        ).order_by()
+
+        rollups = {
+            (row['month'], row['departure_airport_id'], row['arrival_airport_id'], None) : RevenueRollup(
+                month = row['month'],
+                departure_airport_id = row['departure_airport_id'],
+                arrival_airport_id = row['arrival_airport_id'],
+                total_flights = row['total'],
+            ) for row in flights
+        }
+
+        # Paid Tickets without class share the bucket of their flights.
+        for row in tickets:
+            key = (row['month'], row['flight__departure_airport_id'], row['flight__arrival_airport_id'], row['ticket_class_id'])
+            rollup = rollups.setdefault(key, RevenueRollup(
+                month = key[0],
+                departure_airport_id = key[1],
+                arrival_airport_id = key[2],
+                ticket_class_id = key[3],
+            ))
+            rollup.total_tickets_sold = row['sold']
+            rollup.revenue = row['total']
+
+        rollups = list(rollups.values())
+
+        with transaction.atomic():
+            self.rollup_dao.all().delete()
+            self.rollup_dao.bulk_create(rollups, batch_size = 1000)
+
+        return len(rollups)
+
+    def get_yearly_report(self, year : int) -> list:
+        '''Get {'month', 'total_flights', 'total_tickets_sold', 'revenue'} per month
+        of departed flights.
+
+        Past months are read from the rollup, the current month is still
+        filling up with departures, so it is computed from the Flight table.
+        '''
+        current_month = self.month_of(now())
+
+        rows = self.rollup_dao.using(ReplicaRouter.read_alias()).filter(
+            month__year = year,
+            month__lt = current_month,
+        ).values('month').annotate(
+            flights = Sum('total_flights'),
+            tickets_sold = Sum('total_tickets_sold'),
+            total = Sum('revenue'),
+        ).filter(
+            Q(flights__gt = 0) | Q(tickets_sold__gt = 0)
+        ).order_by('month')
+
+        report = [
+            {
+                'month' : row['month'],
+                'total_flights' : row['flights'],
+                'total_tickets_sold' : row['tickets_sold'],
+                'revenue' : row['total'],
+            } for row in rows
+        ]
+
+        if year == current_month.year:
+            month_start = localtime(now()).replace(day = 1, hour = 0, minute = 0, second = 0, microsecond = 0)
+            live_rows = FlightService().get_yearly_report_queryset(
+                self.flight_dao.filter(date_time__gte = month_start),
+                year,
+            )
+            for row in live_rows:
+                report.append(dict(row, month = self.month_of(row['month'])))
+
+        return report
+
+class SearchCacheService:
+    '''Cache flight search results per route.
+
+    A result stores the matching flight IDs with their seat inventory.
+    Its key contains the version of the route it depends on: one version
+    per (departure, arrival) pair and one per side left blank in the
+    search, (departure, *), (*, arrival) and (*, *). A change on route
+    (departure, arrival) bumps those four versions, see signals.
+    '''
+
+    '''Seconds to keep a search result.
+    '''
+    cache_timeout = getattr(settings, 'SEARCH_CACHE_TIMEOUT', 5 * 60)
+
+    '''Searches matching more flights than this are not cached.
+    '''
+    max_results = 1000
+
+    '''Inventory fields of FlightQuerySet.with_inventory kept with each flight.
+    '''
+    inventory_fields = (
+        'seats_count',
+        'tickets_count',
+        'tickets_sold_count',
+        'remaining_seats',
+    )
+
+    metric_names = ('hits', 'misses', 'skipped', 'hit_us', 'miss_us')
+
+    def __init__(self) -> None:
+        self.cache = cache
+
+    def version_key(self, departure_airport_id : int, arrival_airport_id : int) -> str:
+        return f'main:search:version:{departure_airport_id or "*"}:{arrival_airport_id or "*"}'
+
+    def metric_key(self, name : str) -> str:
+        return f'main:search:metrics:{name}'
+
+    def normalize(self, cleaned_data : dict) -> tuple:
+        '''(departure_airport_id, arrival_airport_id, date from, date to) of FlightFilter data.
+        '''
+        departure_airport = cleaned_data.get('departure_airport')
+        arrival_airport = cleaned_data.get('arrival_airport')
+        date_range = cleaned_data.get('date_time')
+
+        return (
+            departure_airport.id if departure_airport else None,
+            arrival_airport.id if arrival_airport else None,
+            date_range.start.isoformat() if date_range and date_range.start else None,
+            date_range.stop.isoformat() if date_range and date_range.stop else None,
+        )
+
+    def result_key(self, params : tuple, using : str = DEFAULT_DB_ALIAS) -> str:
+        version_key = self.version_key(params[0], params[1])
+        version = self.cache.get(version_key)
+        if version is None:
+            version = time.time_ns()
+            self.cache.add(version_key, version, None)
+            version = self.cache.get(version_key, version)
+
+        return 'main:search:result:{}:{}:{}'.format(using, version, ':'.join(str(param or '') for param in params))
+
+    def get_rows(self, params : tuple, queryset : QuerySet) -> list:
+        '''Get [(id, date_time, inventory...)] of the search, from the cache or from queryset.
+        Returns None when the search matches too many flights to be cached.
+
+        Rows read from the replica are kept apart from rows of the default database,
+        so a user pinned to the default database after a booking never gets them.
+        They may still lag behind the version they are stored under: a write bumps
+        the version at once, the replica gets the write later. So they are kept
+        at most READ_REPLICA_STICKINESS seconds. Until then, users reading from
+        the replica may get a search without the write, as they would uncached.
+        That includes the writer for the rest of the timeout once their pin ends.
+        '''
+        start = time.perf_counter()
+        key = self.result_key(params, queryset.db)
+        rows = self.cache.get(key)
+
+        if rows is not None:
+            self.count('hits')
+            self.count('hit_us', int((time.perf_counter() - start) * 1000000))
+            return rows
+
+        rows = list(queryset.values_list('id', 'date_time', *self.inventory_fields)[:self.max_results + 1])
+        if len(rows) > self.max_results:
+            self.count('skipped')
+            return None
+
+        timeout = self.cache_timeout
+        if queryset.db != DEFAULT_DB_ALIAS:
+            timeout = min(timeout, getattr(settings, 'READ_REPLICA_STICKINESS', 15))
+
+        self.cache.set(key, rows, timeout)
+        self.count('misses')
+        self.count('miss_us', int((time.perf_counter() - start) * 1000000))
+
+        return rows
+
+    def invalidate_route(self, *routes : tuple) -> None:
+        '''Bump versions of every search depending on the given (departure, arrival) routes.
+        '''
+        version = time.time_ns()
+        keys = set()
+
+        for departure_airport_id, arrival_airport_id in routes:
+            keys.update([
+                self.version_key(departure_airport_id, arrival_airport_id),
+                self.version_key(departure_airport_id, None),
+                self.version_key(None, arrival_airport_id),
+                self.version_key(None, None),
+            ])
+
+        self.cache.set_many({key : version for key in keys}, None)
+
+    def invalidate_flights(self, *flight_ids : int, flight : Flight = None) -> None:
+        '''Bump versions of the routes of the given flights,
+        flight is used instead of a query when given.
+        '''
+        flight_ids = set(flight_id for flight_id in flight_ids if flight_id is not None)
+        flight_ids -= RevenueRollupService.get_deleting_flights()
+        routes = set()
+
+        if flight is not None and flight.pk in flight_ids:
+            flight_ids.discard(flight.pk)
+            routes.add((flight.departure_airport_id, flight.arrival_airport_id))
+
+        if flight_ids:
+            routes.update(Flight.objects.filter(
+                id__in = flight_ids,
+            ).values_list('departure_airport_id', 'arrival_airport_id'))
+
+        if routes:
+            self.invalidate_route(*routes)
+
+    def count(self, name : str, value : int = 1) -> None:
+        key = self.metric_key(name)
+        try:
+            self.cache.incr(key, value)
+        except ValueError:
+            self.cache.add(key, 0, None)
+            self.cache.incr(key, value)
+
+    def get_metrics(self) -> dict:
+        '''Hit rate and average lookup latency (milliseconds) of cached and computed results.
+        '''
+        values = self.cache.get_many([self.metric_key(name) for name in self.metric_names])
+        hits, misses, skipped, hit_us, miss_us = (values.get(self.metric_key(name), 0) for name in self.metric_names)
+        lookups = hits + misses + skipped
+
+        return {
+            'hits' : hits,
+            'misses' : misses,
+            'skipped' : skipped,
+            'hit_rate' : hits / lookups if lookups else 0,
+            'avg_hit_ms' : hit_us / hits / 1000 if hits else 0,
+            'avg_miss_ms' : miss_us / misses / 1000 if misses else 0,
+        }
+
+class ItineraryService:
+    '''Search connecting flights on an in-memory FlightGraph.
+
+    The graph is shared by every request of a process. Signals keep it
+    up to date with Flights saved or deleted in this process, and it is
+    rebuilt every graph_timeout seconds to pick up changes made by other
+    processes. Seats of the returned itineraries are checked in the database.
+
+    Searches run on the current graph without any lock: changes are made
+    on a copy (see FlightGraph.copy) which then replaces it under lock.
+    A graph older than graph_timeout is still searched while a background
+    thread rebuilds it, only the first search of a process waits for one.
+    '''
+
+    '''Seconds before the graph is rebuilt from the database.
+    '''
+    graph_timeout = getattr(settings, 'ITINERARY_GRAPH_TIMEOUT', 5 * 60)
+
+    '''Minimum time between the arrival of a leg and the departure of the next one,
+    unless the min_connection_time Policy is applied.
+    '''
+    min_connection = timedelta(minutes = getattr(settings, 'ITINERARY_MIN_CONNECTION', 45))
+
+    '''Maximum time between the first departure and the last arrival.
+    '''
+    max_duration = timedelta(hours = 48)
+
+    sort_keys = {
+        'arrival' : lambda itinerary: (itinerary.arrival, itinerary.price),
+        'price' : lambda itinerary: (itinerary.price, itinerary.arrival),
+        'duration' : lambda itinerary: (itinerary.duration, itinerary.price),
+    }
+
+    graph = None
+    graph_built_at = 0
+
+    '''Serializes changes of the graph.
+    '''
+    lock = threading.RLock()
+
+    '''Held while the graph is rebuilt, so only one thread rebuilds it.
+    '''
+    rebuild_lock = threading.Lock()
+
+    def __init__(self) -> None:
+        self.flight_dao = Flight.objects
+        self.flight_fare_dao = FlightFare.objects
+
+    def get_leg_queryset(self) -> QuerySet:
+        '''Upcoming flights with a known flight time, as FlightLeg rows.
+        '''
+        return self.flight_dao.filter(
+            date_time__gt = now(),
+            flightdetail__flight_time__isnull = False,
+        ).values(
+            'id',
+            'departure_airport_id',
+            'arrival_airport_id',
+            'date_time',
+            'flightdetail__flight_time',
+        ).order_by()
+
+    def get_leg_fares(self, flight_ids = None) -> dict:
+        '''Get {flight_id: [(seat_size, price, tickets)]} of upcoming flights, or of flight_ids.
+        '''
+        fare_dao = self.flight_fare_dao.filter(flight__date_time__gt = now())
+        if flight_ids is not None:
+            fare_dao = fare_dao.filter(flight_id__in = flight_ids)
+
+        fares = defaultdict(list)
+        for flight_id, *fare in fare_dao.values_list('flight_id', 'seat_size', 'price', 'tickets').order_by().iterator():
+            fares[flight_id].append(fare)
+        return fares
+
+    def make_leg(self, row : dict, fares : list) -> FlightLeg:
+        '''Build a FlightLeg, priced at its cheapest class with seats left.
+        '''
+        seats = 0
+        prices = []
+
+        for seat_size, price, tickets in fares:
+            seats_left = seat_size - tickets
+            if seats_left > 0:
+                seats += seats_left
+                if price is not None:
+                    prices.append(price)
+
+        return FlightLeg(
+            flight_id = row['id'],
+            departure_airport_id = row['departure_airport_id'],
+            arrival_airport_id = row['arrival_airport_id'],
+            departure = row['date_time'],
+            arrival = row['date_time'] + timedelta(minutes = row['flightdetail__flight_time']),
+            price = min(prices, default = 0),
+            seats = seats,
+        )
+
+    def get_graph(self) -> FlightGraph:
+        '''Current graph, do not change it (see refresh_flight).
+        '''
+        graph = ItineraryService.graph
+
+        if graph is None:
+            with ItineraryService.rebuild_lock:
+                if ItineraryService.graph is None:
+                    self.rebuild()
+            return ItineraryService.graph
+
+        if time.monotonic() - ItineraryService.graph_built_at > self.graph_timeout and ItineraryService.rebuild_lock.acquire(blocking = False):
+            threading.Thread(target = self.rebuild_in_background, daemon = True).start()
+
+        return graph
+
+    def rebuild_in_background(self) -> None:
+        '''Rebuild the graph then release rebuild_lock, acquired by get_graph.
+        '''
+        try:
+            self.rebuild()
+        finally:
+            ItineraryService.rebuild_lock.release()
+            connection.close()
+
+    def rebuild(self) -> FlightGraph:
+        '''Load every upcoming flight into a new graph.
+        '''
+        fares = self.get_leg_fares()
+        graph = FlightGraph(self.make_leg(row, fares[row['id']]) for row in self.get_leg_queryset().iterator())
+
+        with ItineraryService.lock:
+            ItineraryService.graph = graph
+            ItineraryService.graph_built_at = time.monotonic()
+
+        return graph
+
+    def refresh_flight(self, flight_id : int) -> None:
+        '''Reload one flight into the graph, if this process has one.
+        '''
+        if ItineraryService.graph is None:
+            return
+
+        row = self.get_leg_queryset().filter(id = flight_id).first()
+        leg = row and self.make_leg(row, self.get_leg_fares([flight_id])[flight_id])
+
+        with ItineraryService.lock:
+            graph = ItineraryService.graph.copy()
+            if leg is None:
+                graph.remove(flight_id)
+            else:
+                graph.add(leg)
+            ItineraryService.graph = graph
+
+    def remove_flight(self, flight_id : int) -> None:
+        with ItineraryService.lock:
+            if ItineraryService.graph is not None and flight_id in ItineraryService.graph.legs:
+                graph = ItineraryService.graph.copy()
+                graph.remove(flight_id)
+                ItineraryService.graph = graph
+
+    def search(self, origin_id : int, destination_id : int, date_from : date, date_to : date = None,
+            max_legs : int = 3, sort : str = 'arrival', limit : int = 10) -> list:
+        '''Find up to limit itineraries leaving between date_from and date_to (included),
+        sorted by 'arrival', 'price' or 'duration'.
+        '''
+        depart_after = max(now(), make_aware(datetime.combine(date_from, datetime.min.time())))
+        depart_before = make_aware(datetime.combine(date_to or date_from, datetime.max.time()))
+
+        itineraries = self.get_graph().search(
+            origin_id,
+            destination_id,
+            depart_after,
+            depart_before,
+            max_legs = max_legs,
+            min_connection = PolicyService().min_connection_time(),
+            max_duration = self.max_duration,
+        )
+
+        itineraries.sort(key = self.sort_keys[sort])
+
+        return self.check_seats(itineraries[:limit * 2])[:limit]
+
+    def check_seats(self, itineraries : list) -> list:
+        '''Drop itineraries with a flight sold out (or gone) since the graph was built,
+        in one query, and mark those flights as full in the graph.
+        '''
+        flight_ids = {flight_id for itinerary in itineraries for flight_id in itinerary.flight_ids}
+        if not flight_ids:
+            return []
+
+        available = set(self.flight_dao.filter(
+            id__in = flight_ids,
+            date_time__gt = now(),
+        ).with_inventory().filter(
+            remaining_seats__gt = 0,
+        ).values_list('id', flat = True))
+
+        full = flight_ids - available
+        graph = ItineraryService.graph
+        for flight_id in full:
+            # Legs are shared by every copy of the graph, a search sees either seat count.
+            leg = graph.legs.get(flight_id) if graph else None
+            if leg is not None:
+                leg.seats = 0
+
+        return [
+            itinerary for itinerary in itineraries
+            if not full.intersection(itinerary.flight_ids)
+        ]
+
+class ScheduleImportService:
+    '''Create Flights with their FlightDetail and TransitionAirports in bulk.
+
+    Rows are dicts, one per Flight (a CSV line or a JSON object):
+    departure_airport, arrival_airport (names), date_time, flight_time and
+    optionally fares and transition_airports. Fares are a list of
+    {ticket_class, seat_size, price} or "class:seats:price;..." in CSV files,
+    the first_class_* and second_class_* columns of older files are read as
+    the First and Economy fares. Transition airports are a list of
+    {airport, transition_time, note} or "name:minutes[:note];...".
+
+    Rows are checked with the rules of FlightForm, FlightDetailForm and
+    TransitionAirportForm, then saved batch by batch with bulk_create.
+    bulk_create skips signals, so details, fares, report rollups and cached
+    searches are handled here.
+    '''
+
+    '''Rows saved per transaction.
+    '''
+    batch_size = 2000
+
+    detail_fields = (
+        'flight_time',
+    )
+
+    '''Error messages of FlightDetailForm, for values below their minimum.
+    '''
+    detail_errors = {
+        'flight_time' : (1, 'Flight time cannot be negative or zero minutes.'),
+    }
+
+    '''TicketClass name of the fare columns of older files, by column prefix.
+    '''
+    legacy_fare_columns = {
+        'first_class' : 'First',
+        'second_class' : 'Economy',
+    }
+
+    def __init__(self, batch_size : int = None) -> None:
+        self.flight_dao = Flight.objects
+        self.flight_detail_dao = FlightDetail.objects
+        self.flight_fare_dao = FlightFare.objects
+        self.transition_airport_dao = TransitionAirport.objects
+        self.airport_dao = Airport.objects
+        self.ticket_class_dao = TicketClass.objects
+
+        self.batch_size = batch_size or self.batch_size
+        self.airport_ids = None
+        self.ambiguous_airports = set()
+        self.ticket_class_ids = None
+        self.rollup_buckets = {}
+
+    def load_airports(self) -> None:
+        '''Map every Airport name to its id, in one query.
+        '''
+        self.airport_ids = {}
+        self.ambiguous_airports = set()
+
+        for airport_id, name in self.airport_dao.values_list('id', 'name').order_by('id').iterator():
+            name = (name or '').strip()
+            if name in self.airport_ids:
+                self.ambiguous_airports.add(name)
+            self.airport_ids[name] = airport_id
+
+    def get_airport_id(self, name) -> int:
+        name = str(name or '').strip()
+        if not name:
+            raise ValidationError('This field is required.')
+        if name in self.ambiguous_airports:
+            raise ValidationError(f'Several airports are named "{name}".')
+        if name not in self.airport_ids:
+            raise ValidationError(f'Unknown airport "{name}".')
+        return self.airport_ids[name]
+
+    def load_ticket_classes(self) -> None:
+        '''Map every TicketClass name to its id, in one query.
+        '''
+        self.ticket_class_ids = {}
+        for ticket_class_id, name in self.ticket_class_dao.values_list('id', 'name').order_by('-id'):
+            self.ticket_class_ids[(name or '').strip()] = ticket_class_id
+
+    def get_ticket_class_id(self, name) -> int:
+        name = str(name or '').strip()
+        if not name:
+            raise ValidationError('Enter a ticket class.')
+        if name not in self.ticket_class_ids:
+            raise ValidationError(f'Unknown ticket class "{name}".')
+        return self.ticket_class_ids[name]
+
+    def get_integer(self, value) -> int:
+        if value is None or str(value).strip() == '':
+            raise ValidationError('This field is required.')
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise ValidationError('Enter a whole number.')
+        if not number.is_integer():
+            raise ValidationError('Enter a whole number.')
+        return int(number)
+
+    def get_date_time(self, value) -> datetime:
+        if value is None or str(value).strip() == '':
+            raise ValidationError('This field is required.')
+        try:
+            date_time = parse_datetime(str(value).strip())
+        except ValueError:
+            date_time = None
+        if date_time is None:
+            raise ValidationError('Enter a valid date/time.')
+        if is_naive(date_time):
+            date_time = make_aware(date_time)
+        return date_time
+
+    def get_transitions(self, value) -> list:
+        '''Transition airports of a row as dicts.
+        '''
+        if not value:
+            return []
+        if isinstance(value, list):
+            return value
+
+        transitions = []
+        for item in str(value).split(';'):
+            if not item.strip():
+                continue
+            airport, _, rest = item.partition(':')
+            transition_time, _, note = rest.partition(':')
+            transitions.append({
+                'airport' : airport,
+                'transition_time' : transition_time,
+                'note' : note.strip() or None,
+            })
+        return transitions
+
+    def get_fares(self, row : dict) -> list:
+        '''Fares of a row as ((seat field, price field), fare dict) pairs,
+        the fields being where their errors are reported.
+        '''
+        fares = []
+        value = row.get('fares')
+
+        if isinstance(value, list):
+            items = value
+        else:
+            items = []
+            for item in str(value or '').split(';'):
+                if not item.strip():
+                    continue
+                ticket_class, _, rest = item.partition(':')
+                seat_size, _, price = rest.partition(':')
+                items.append({
+                    'ticket_class' : ticket_class,
+                    'seat_size' : seat_size,
+                    'price' : price,
+                })
+
+        for index, fare in enumerate(items):
+            fares.append(((f'fares[{index}]',) * 2, fare))
+
+        for prefix, name in self.legacy_fare_columns.items():
+            if f'{prefix}_seat_size' in row or f'{prefix}_ticket_price' in row:
+                fares.append(((f'{prefix}_seat_size', f'{prefix}_ticket_price'), {
+                    'ticket_class' : name,
+                    'seat_size' : row.get(f'{prefix}_seat_size'),
+                    'price' : row.get(f'{prefix}_ticket_price'),
+                }))
+
+        return fares
+
+    def clean(self, row : dict) -> tuple:
+        '''Get (Flight, FlightDetail, [FlightFare], [TransitionAirport]) of a row, not saved yet.
+        Raise ValidationError with the errors of every field.
+        '''
+        if not isinstance(row, dict):
+            raise ValidationError({'row' : ['Expected one object per flight.']})
+
+        errors = {}
+        values = {}
+
+        for field in ('departure_airport', 'arrival_airport'):
+            try:
+                values[f'{field}_id'] = self.get_airport_id(row.get(field))
+            except ValidationError as error:
+                errors[field] = error.messages
+
+        try:
+            values['date_time'] = self.get_date_time(row.get('date_time'))
+        except ValidationError as error:
+            errors['date_time'] = error.messages
+
+        for field in self.detail_fields:
+            try:
+                values[field] = self.get_integer(row.get(field))
+            except ValidationError as error:
+                errors[field] = error.messages
+                continue
+
+            minimum, message = self.detail_errors[field]
+            if values[field] < minimum:
+                errors[field] = [message]
+
+        flight_fares = {}
+        for (seat_field, price_field), fare in self.get_fares(row):
+            if not isinstance(fare, dict):
+                errors[seat_field] = ['Expected a ticket class, seats and a price.']
+                continue
+
+            try:
+                ticket_class_id = self.get_ticket_class_id(fare.get('ticket_class'))
+            except ValidationError as error:
+                errors[seat_field] = error.messages
+                continue
+
+            name = str(fare.get('ticket_class')).strip()
+            if ticket_class_id in flight_fares:
+                errors[seat_field] = [f'{name} class has several fares.']
+                continue
+
+            try:
+                seat_size = self.get_integer(fare.get('seat_size'))
+                if seat_size < 0:
+                    raise ValidationError(f'{name} class seats cannot be a negative.')
+            except ValidationError as error:
+                errors[seat_field] = error.messages
+                continue
+
+            try:
+                price = self.get_integer(fare.get('price'))
+                if price < 0:
+                    raise ValidationError(f'{name} class ticket price cannot be negative.')
+            except ValidationError as error:
+                errors[price_field] = error.messages
+                continue
+
+            flight_fares[ticket_class_id] = FlightFare(
+                ticket_class_id = ticket_class_id,
+                seat_size = seat_size,
+                price = price,
+            )
+
+        if 'departure_airport_id' in values and values.get('departure_airport_id') == values.get('arrival_airport_id'):
+            errors['departure_airport'] = errors['arrival_airport'] = ['Departure and Arrival Airport must not be the same.']
+
+        route_airport_ids = {values.get('departure_airport_id'), values.get('arrival_airport_id')}
+        transition_airports = []
+        for index, transition in enumerate(self.get_transitions(row.get('transition_airports'))):
+            field = f'transition_airports[{index}]'
+            if not isinstance(transition, dict):
+                errors[field] = ['Expected an airport and a transition time.']
+                continue
+
+            try:
+                airport_id = self.get_airport_id(transition.get('airport'))
+                transition_time = self.get_integer(transition.get('transition_time'))
+            except ValidationError as error:
+                errors[field] = error.messages
+                continue
+
+            if transition_time <= 0:
+                errors[field] = ['Transition time cannot be negative or zero minutes!']
+            elif airport_id in route_airport_ids:
+                errors[field] = ['This airport existed in flight route, please double-check.']
+            else:
+                route_airport_ids.add(airport_id)
+                transition_airports.append(TransitionAirport(
+                    airport_id = airport_id,
+                    transition_time = transition_time,
+                    note = transition.get('note') or None,
+                ))
+
+        if errors:
+            raise ValidationError(errors)
+
+        flight = Flight(
+            departure_airport_id = values['departure_airport_id'],
+            arrival_airport_id = values['arrival_airport_id'],
+            date_time = values['date_time'],
+        )
+        flight_detail = FlightDetail(
+            seat_size = sum(fare.seat_size for fare in flight_fares.values()),
+            **{field : values[field] for field in self.detail_fields},
+        )
+
+        return flight, flight_detail, list(flight_fares.values()), transition_airports
+
+    def import_rows(self, rows, dry_run : bool = False, on_error = None) -> int:
+        '''Import (line, row) pairs, return the number of Flights created
+        (or that would be created with dry_run).
+
+        Invalid rows are skipped, on_error(line, errors) is called for each of them.
+        '''
+        if self.airport_ids is None:
+            self.load_airports()
+        if self.ticket_class_ids is None:
+            self.load_ticket_classes()
+
+        total = 0
+        batch = []
+
+        for line, row in rows:
+            try:
+                batch.append(self.clean(row))
+            except ValidationError as error:
+                if on_error is not None:
+                    on_error(line, error.message_dict)
+                continue
+
+            if len(batch) >= self.batch_size:
+                total += len(batch) if dry_run else self.save_batch(batch)
+                batch = []
+
+        if batch:
+            total += len(batch) if dry_run else self.save_batch(batch)
+
+        if total and not dry_run and ItineraryService.graph is not None:
+            ItineraryService().rebuild()
+
+        return total
+
+    def save_batch(self, batch : list) -> int:
+        '''Save a batch of cleaned rows in one transaction.
+        '''
+        rollup_service = RevenueRollupService()
+        flights = [flight for flight, _, _, _ in batch]
+
+        with transaction.atomic():
+            self.flight_dao.bulk_create(flights)
+
+            flight_details = []
+            flight_fares = []
+            transition_airports = []
+            for flight, flight_detail, fares, transitions in batch:
+                flight_detail.flight = flight
+                flight_details.append(flight_detail)
+                for flight_fare in fares:
+                    flight_fare.flight = flight
+                    flight_fares.append(flight_fare)
+                for transition_airport in transitions:
+                    transition_airport.flight = flight
+                    transition_airports.append(transition_airport)
+
+            self.flight_detail_dao.bulk_create(flight_details)
+            self.flight_fare_dao.bulk_create(flight_fares)
+            self.transition_airport_dao.bulk_create(transition_airports)
+
+            routes = defaultdict(int)
+            for flight in flights:
+                routes[rollup_service.route_of(flight.__dict__)] += 1
+            rollup_service.add_flights(routes, self.rollup_buckets)
+
+        SearchCacheService().invalidate_route(*{route[1:] for route in routes})
+
+        return len(flights)
+
+class RoleService:
+    '''Resolve the customer profile and groups of a User.
+
+    Roles are cached on the User object for the current request
+    and in Django's cache across requests, see signals for invalidation.
+    '''
+
+    '''Seconds to keep roles in the cache.
+    '''
+    cache_timeout = 60 * 60
+
+    def __init__(self) -> None:
+        self.cache = cache
+
+    def cache_key(self, user_id : int) -> str:
+        return f'main:roles:{user_id}'
+
+    def get_roles(self, user : User) -> dict:
+        '''Get {'customer_id', 'groups'} of the user.
+        '''
+        if hasattr(user, '_roles'):
+            return user._roles
+
+        key = self.cache_key(user.id)
+        roles = self.cache.get(key)
+
+        if roles is None:
+            roles = {
+                'customer_id' : Customer.objects.filter(user_id = user.id).values_list('id', flat = True).first(),
+                'groups' : frozenset(user.groups.values_list('name', flat = True)),
+            }
+            self.cache.set(key, roles, self.cache_timeout)
+
+        user._roles = roles
+        return roles
+
+    def get_customer_id(self, user : User) -> int:
+        return self.get_roles(user)['customer_id']
+
+    def is_in_group(self, user : User, group_name : str) -> bool:
+        return group_name in self.get_roles(user)['groups']
+
+    def invalidate(self, *user_ids : int) -> None:
+        '''Forget cached roles of the given users.
+        '''
+        self.cache.delete_many([self.cache_key(user_id) for user_id in user_ids])
+
 class CustomerService:
     def __init__(self):
         self.customer_dao = CustomerDAO()
@@ -1,5 +1,9 @@
-from django.db import IntegrityError
-from django.db.models.signals import post_save
+import django
+from django.conf import settings
+from django.db import IntegrityError, connections
+from django.core.signals import request_finished, request_started
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, pre_save, post_delete, pre_delete, m2m_changed
 from django.contrib.auth.models import User, Group, Permission
 
 from .models import *
@@ -69,6 +73,28 @@ def populate_models(sender, **kwargs):
     second_class_object = TicketClass.objects.get_or_create(name = 'Economy')
     print(f'Created {second_class_object}')
 
+def configure_connection(sender, connection, **kwargs):
+    '''Apply SQLITE_PRAGMAS to every new SQLite connection, see settings.
+    '''
+    if connection.vendor != 'sqlite':
+        return
+
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+def check_connections(sender, **kwargs):
+    '''Close persistent connections with CONN_HEALTH_CHECKS that became unusable
+    (database restarted, idle connection dropped), so the request opens new ones.
+    Django 4.1+ runs this check itself.
+    '''
+    if django.VERSION >= (4, 1):
+        return
+
+    for connection in connections.all():
+        if connection.connection is not None and connection.settings_dict.get('CONN_HEALTH_CHECKS') and not connection.is_usable():
+            connection.close()
+
 def customer_profile(sender, instance, created, **kwargs):
     '''Create a Customer profile when a new User is created.
     '''
@@ -93,5 +119,216 @@ def flight_detail(sender, instance, created, **kwargs):
 
         new_flight_detail.save()
 
+def flight_state(values : dict) -> dict:
+    '''Extract fields that report rollups depend on.
+    '''
+    return {
+        'date_time' : values.get('date_time'),
+        'departure_airport_id' : values.get('departure_airport_id'),
+        'arrival_airport_id' : values.get('arrival_airport_id'),
+    }
+
+def flight_load_state(sender, instance, **kwargs):
+    '''Load the stored state of a Flight not fetched through the ORM.
+    '''
+    if instance.pk is not None and not hasattr(instance, '_loaded_values'):
+        instance._loaded_values = Flight.objects.filter(
+            pk = instance.pk
+        ).values('date_time', 'departure_airport_id', 'arrival_airport_id').first()
+
+def flight_changed(sender, instance, created, **kwargs):
+    '''Update report rollups, the itinerary graph and cached searches
+    after a Flight is created, rescheduled or rerouted.
+    '''
+    rollup_service = RevenueRollupService()
+    new_state = flight_state(instance.__dict__)
+
+    old_route = None
+    if not created:
+        old_route = rollup_service.route_of(getattr(instance, '_loaded_values', None))
+
+    rollup_service.move_flight(instance.pk, old_route, rollup_service.route_of(new_state))
+
+    routes = {(new_state['departure_airport_id'], new_state['arrival_airport_id'])}
+    old_state = getattr(instance, '_loaded_values', None)
+    if not created and old_state is not None:
+        routes.add((old_state.get('departure_airport_id'), old_state.get('arrival_airport_id')))
+    SearchCacheService().invalidate_route(*routes)
+
+    if not created and old_state is not None and old_state.get('date_time') != new_state['date_time'] and not instance.is_departed:
+        TicketService().restore_canceled_tickets(instance.pk)
+
+    instance._loaded_values = new_state
+
+    ItineraryService().refresh_flight(instance.pk)
+
+def flight_deleting(sender, instance, **kwargs):
+    '''Subtract a Flight and its paid Tickets from report rollups before it is deleted.
+    '''
+    rollup_service = RevenueRollupService()
+    old_route = rollup_service.route_of(getattr(instance, '_loaded_values', None) or instance.__dict__)
+    rollup_service.move_flight(instance.pk, old_route, None)
+
+    SearchCacheService().invalidate_route((instance.departure_airport_id, instance.arrival_airport_id))
+
+    # Its Tickets are deleted by cascade, they are already subtracted.
+    RevenueRollupService.get_deleting_flights().add(instance.pk)
+
+def flight_deleted(sender, instance, **kwargs):
+    RevenueRollupService.get_deleting_flights().discard(instance.pk)
+    ItineraryService().remove_flight(instance.pk)
+    FareService().invalidate(instance.pk)
+
+def request_done(sender, **kwargs):
+    '''Forget Flights whose deletion failed (rolled back before post_delete),
+    so later changes of their Tickets update report rollups again.
+    '''
+    RevenueRollupService.get_deleting_flights().clear()
+
+def flight_detail_changed(sender, instance, **kwargs):
+    '''Reload a Flight in the itinerary graph and drop cached searches of its route
+    after its flight time, seats or prices change.
+    '''
+    if instance.flight_id is not None:
+        ItineraryService().refresh_flight(instance.flight_id)
+
+        flight = instance.flight if FlightDetail.flight.is_cached(instance) else None
+        SearchCacheService().invalidate_flights(instance.flight_id, flight = flight)
+
+def flight_fare_changed(sender, instance, **kwargs):
+    '''Update the seat total of a Flight after one of its fares is saved or deleted
+    outside of FareService (admin, shell).
+    '''
+    if instance.flight_id in RevenueRollupService.get_deleting_flights():
+        return
+
+    FareService().refresh_seat_size(instance.flight_id)
+
+def ticket_state(values : dict) -> dict:
+    '''Extract fields that seat counters and report rollups depend on.
+    '''
+    return {
+        'flight_id' : values.get('flight_id'),
+        'ticket_class_id' : values.get('ticket_class_id'),
+        'is_booked' : values.get('is_booked'),
+        'price' : values.get('price'),
+    }
+
+def ticket_load_state(sender, instance, **kwargs):
+    '''Load the stored state of a Ticket not fetched through the ORM.
+    '''
+    if instance.pk is not None and not hasattr(instance, '_loaded_values'):
+        instance._loaded_values = Ticket.objects.filter(
+            pk = instance.pk
+        ).values('flight_id', 'ticket_class_id', 'is_booked', 'price').first()
+
+def ticket_changed(sender, instance, created, **kwargs):
+    '''Update seat counters, report rollups and cached searches
+    after a Ticket is created or changed.
+    '''
+    new_state = ticket_state(instance.__dict__)
+
+    old_state = None
+    if not created and getattr(instance, '_loaded_values', None) is not None:
+        old_state = ticket_state(instance._loaded_values)
+
+    if created and getattr(instance, '_seat_reserved', False):
+        # ReservationService already counted the seat, only count the payment.
+        old_state = dict(new_state, is_booked = False)
+        instance._seat_reserved = False
+
+    SeatCounterService().apply(old_state, new_state)
+
+    flight = instance.flight if Ticket.flight.is_cached(instance) else None
+    RevenueRollupService().apply_ticket(old_state, new_state, flight)
+
+    if created or old_state != new_state:
+        SearchCacheService().invalidate_flights(
+            new_state['flight_id'],
+            old_state and old_state['flight_id'],
+            flight = flight,
+        )
+
+    instance._loaded_values = new_state
+
+def ticket_deleted(sender, instance, **kwargs):
+    '''Update seat counters, report rollups and cached searches
+    after a Ticket is deleted.
+    '''
+    old_state = ticket_state(getattr(instance, '_loaded_values', None) or instance.__dict__)
+
+    # Tickets deleted by cascade with their Flight: its fares and FlightDetail go with it.
+    if old_state['flight_id'] not in RevenueRollupService.get_deleting_flights():
+        SeatCounterService().apply(old_state, None)
+    RevenueRollupService().apply_ticket(old_state, None)
+    SearchCacheService().invalidate_flights(old_state['flight_id'])
+
+def ticket_class_changed(sender, instance, **kwargs):
+    '''Forget cached TicketClass names.
+    '''
+    FareService().invalidate_ticket_class_names()
+
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''Forget cached roles when a User joins or leaves a Group.
+    '''
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if not reverse:
+        user_ids = [instance.pk]
+    elif action == 'pre_clear':
+        user_ids = list(instance.user_set.values_list('id', flat = True))
+    else:
+        user_ids = list(pk_set)
+
+    RoleService().invalidate(*user_ids)
+
+def group_deleted(sender, instance, **kwargs):
+    '''Forget cached roles of the members of a deleted Group.
+    '''
+    RoleService().invalidate(*instance.user_set.values_list('id', flat = True))
+
+def airport_changed(sender, instance, **kwargs):
+    '''Replace the airport catalog used by dropdowns and typeahead.
+    '''
+    AirportCatalogService().invalidate(instance)
+
+def airport_deleted(sender, instance, **kwargs):
+    AirportCatalogService().invalidate(instance, deleted = True)
+
+def policy_changed(sender, instance, **kwargs):
+    '''Make every process reload the applied Policies.
+    '''
+    PolicyService().invalidate()
+
+def customer_changed(sender, instance, **kwargs):
+    '''Forget cached roles when a Customer profile is created or deleted.
+    '''
+    if instance.user_id is not None:
+        RoleService().invalidate(instance.user_id)
+
+connection_created.connect(configure_connection)
+request_started.connect(check_connections)
+request_finished.connect(request_done)
 post_save.connect(customer_profile, sender = User)
-post_save.connect(flight_detail, sender = Flight)
\ No newline at end of file
+post_save.connect(flight_detail, sender = Flight)
+pre_save.connect(flight_load_state, sender = Flight)
+post_save.connect(flight_changed, sender = Flight)
+pre_delete.connect(flight_deleting, sender = Flight)
+post_delete.connect(flight_deleted, sender = Flight)
+post_save.connect(flight_detail_changed, sender = FlightDetail)
+post_save.connect(flight_fare_changed, sender = FlightFare)
+post_delete.connect(flight_fare_changed, sender = FlightFare)
+pre_save.connect(ticket_load_state, sender = Ticket)
+post_save.connect(ticket_changed, sender = Ticket)
+post_delete.connect(ticket_deleted, sender = Ticket)
+post_save.connect(ticket_class_changed, sender = TicketClass)
+m2m_changed.connect(user_groups_changed, sender = User.groups.through)
+pre_delete.connect(group_deleted, sender = Group)
+post_save.connect(customer_changed, sender = Customer)
+post_delete.connect(customer_changed, sender = Customer)
+post_delete.connect(ticket_class_changed, sender = TicketClass)
+post_save.connect(airport_changed, sender = Airport)
+post_delete.connect(airport_deleted, sender = Airport)
+post_save.connect(policy_changed, sender = Policy)
+post_delete.connect(policy_changed, sender = Policy)
@@ -1,3 +1,1353 @@
-from django.test import TestCase
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import connection, transaction, IntegrityError, OperationalError
+from django.db.models import QuerySet
+from django.db.models.sql import DeleteQuery
+from django.contrib.auth.models import Group, User
+from django.http import Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.timezone import make_aware, now
+from django.views import View
+
+from datetime import date, datetime, timedelta
+from io import StringIO
+from xml.etree import ElementTree
+from unittest import mock
+import base64
+import csv
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from .dao import AirportDAO, TransitionAirportDAO
+from .itinerary import FlightGraph, FlightLeg
+from .routers import ReplicaRouter
+from .signals import check_connections
+from .typeahead import AirportIndex
+from .utils import ChartService, CursorPage, GraphPlotting, CursorPaginationMixin, PrimaryAfterWriteMixin
+from .views import ExportFlightReportGeneralView
+from .wrapper import FlightStatisticWrapper
+from .forms import FlightDetailForm, FlightTicketForm
+from .models import *
+from .service import *
 
 # Create your tests here.
+
+class FlightFixtureMixin:
+    '''Builders of the ticket classes, airports, flights and customers the tests below share.
+    '''
+
+    def create_ticket_classes(self) -> None:
+        '''Set self.first_class and self.economy_class, the classes created after migrations.
+        '''
+        self.first_class, _ = TicketClass.objects.get_or_create(name = 'First')
+        self.economy_class, _ = TicketClass.objects.get_or_create(name = 'Economy')
+
+    def create_airports(self, *names : str) -> list:
+        return [Airport.objects.create(name = name) for name in names or ('Departure', 'Arrival')]
+
+    def create_flight(self, departure : Airport = None, arrival : Airport = None, date_time = None,
+            fares : dict = None, flight_time : int = 60) -> Flight:
+        '''Create a Flight, tomorrow between two new airports unless given,
+        with fares {TicketClass: (seat_size, price)}.
+        '''
+        if departure is None or arrival is None:
+            departure, arrival = self.create_airports()
+
+        flight = Flight.objects.create(
+            departure_airport = departure,
+            arrival_airport = arrival,
+            date_time = date_time or now() + timedelta(days = 1),
+        )
+        FlightDetail.objects.filter(flight = flight).update(flight_time = flight_time)
+
+        if fares:
+            FareService().set_fares(flight.id, {ticket_class.id : fare for ticket_class, fare in fares.items()})
+        return flight
+
+    def create_customer(self, username : str = 'buyer') -> Customer:
+        return User.objects.create_user(username, f'{username}@example.com', 'password').customer
+
+class FlightInventoryTest(FlightFixtureMixin, TestCase):
+    '''Flight lists read seats and tickets from annotations, not one query per flight.
+    '''
+
+    def setUp(self) -> None:
+        self.create_ticket_classes()
+        departure, arrival = self.create_airports()
+
+        self.flights = [
+            self.create_flight(departure, arrival, now() + timedelta(days = days), fares = {self.economy_class : (2, 50)})
+            for days in (1, 2, 3)
+        ]
+        for is_booked in (True, False):
+            Ticket.objects.create(flight = self.flights[0], ticket_class = self.economy_class, price = 50, is_booked = is_booked)
+
+    def get_inventory(self, flight : Flight) -> tuple:
+        return (flight.total_seats, flight.total_tickets, flight.total_tickets_sold, flight.is_bookable)
+
+    def test_annotations_match_properties(self) -> None:
+        for flight in Flight.objects.with_inventory():
+            with self.subTest(flight = flight.id):
+                self.assertEqual(self.get_inventory(flight), self.get_inventory(Flight.objects.get(pk = flight.pk)))
+
+    def test_flight_list_queries(self) -> None:
+        # The flight, its detail, departure and arrival airports.
+        with self.assertNumQueries(4):
+            flights = list(FlightService().get_flight_list_queryset().order_by('date_time'))
+
+        PolicyService().get_snapshot()
+        with self.assertNumQueries(0):
+            inventories = [self.get_inventory(flight) for flight in flights]
+
+        self.assertEqual(inventories, [(2, 2, 1, False), (2, 0, 0, True), (2, 0, 0, True)])
+
+class ReservationServiceTest(FlightFixtureMixin, TransactionTestCase):
+    '''Concurrent bookings must never overbook a class.
+    '''
+
+    '''Seats of each class in the test flight.
+    '''
+    seats = 20
+
+    '''Concurrent buyers, more than the seats.
+    '''
+    buyers = 60
+
+    def setUp(self) -> None:
+        self.create_ticket_classes()
+        self.customer = self.create_customer()
+        self.flight = self.create_flight(fares = {
+            self.first_class : (self.seats, 100),
+            self.economy_class : (self.seats, 50),
+        })
+
+    def test_sold_out(self) -> None:
+        FlightFare.objects.filter(flight = self.flight, ticket_class = self.first_class).update(seat_size = 1)
+        reservation_service = ReservationService()
+
+        first = reservation_service.reserve(self.flight.id, Ticket(customer = self.customer, ticket_class = self.first_class))
+        second = reservation_service.reserve(self.flight.id, Ticket(customer = self.customer, ticket_class = self.first_class))
+
+        self.assertTrue(first.is_reserved)
+        self.assertIsNotNone(first.ticket.pk)
+        self.assertTrue(second.is_sold_out)
+        self.assertIsNone(second.ticket)
+        self.assertEqual(Ticket.objects.count(), 1)
+
+    def test_max_tickets_per_customer(self) -> None:
+        self.addCleanup(PolicyService().invalidate)
+        Policy.objects.create(name = PolicyService.MAX_TICKETS_PER_CUSTOMER, datatype = 'int', value = 2, is_applied = True)
+        reservation_service = ReservationService()
+
+        results = [
+            reservation_service.reserve(self.flight.id, Ticket(customer = self.customer, ticket_class = self.first_class))
+            for _ in range(3)
+        ]
+
+        self.assertEqual([result.status for result in results], [
+            ReservationResult.RESERVED,
+            ReservationResult.RESERVED,
+            ReservationResult.LIMIT_REACHED,
+        ])
+        self.assertEqual(FlightFare.objects.get(flight = self.flight, ticket_class = self.first_class).tickets, 2)
+
+    def test_any_ticket_class(self) -> None:
+        self.addCleanup(FareService().invalidate_ticket_class_names)
+        business_class = TicketClass.objects.create(name = 'Business')
+        fare_service = FareService()
+        fare_service.set_fares(self.flight.id, {business_class.id : (2, 250)})
+
+        with self.assertNumQueries(1):
+            self.assertEqual(fare_service.get_price(self.flight.id, business_class.id), 250)
+        with self.assertNumQueries(0):
+            self.assertEqual(fare_service.get_price(self.flight.id, self.first_class.id), 100)
+
+        results = [
+            ReservationService().reserve(self.flight.id, Ticket(customer = self.customer, ticket_class = business_class))
+            for _ in range(3)
+        ]
+
+        self.assertEqual([result.is_reserved for result in results], [True, True, False])
+        flight_detail = FlightDetail.objects.get(flight = self.flight)
+        self.assertEqual((flight_detail.seat_size, flight_detail.tickets), (self.seats * 2 + 2, 2))
+        self.assertFalse(SeatCounterService().get_mismatched_queryset().exists())
+
+    def test_retries_lock_errors_only(self) -> None:
+        reservation_service = ReservationService()
+        locked = OperationalError('database is locked')
+
+        with mock.patch.object(reservation_service, '_reserve', side_effect = [
+            locked,
+            locked,
+            ReservationResult(ReservationResult.RESERVED),
+        ]) as patched:
+            self.assertTrue(reservation_service.reserve(self.flight.id, Ticket(ticket_class = self.first_class)).is_reserved)
+            self.assertEqual(patched.call_count, 3)
+            self.assertEqual(reservation_service.retries, 2)
+
+        with mock.patch.object(reservation_service, '_reserve', side_effect = OperationalError('no such table: main_flightfare')) as patched:
+            with self.assertRaises(OperationalError):
+                reservation_service.reserve(self.flight.id, Ticket(ticket_class = self.first_class))
+            self.assertEqual(patched.call_count, 1)
+            self.assertEqual(reservation_service.retries, 2)
+
+    def test_concurrent_bookings_do_not_overbook(self) -> None:
+        barrier = threading.Barrier(self.buyers)
+        results = []
+        errors = []
+
+        def book() -> None:
+            try:
+                barrier.wait()
+                ticket = Ticket(customer_id = self.customer.id, ticket_class_id = self.first_class.id, price = 100)
+                results.append(ReservationService().reserve(self.flight.id, ticket))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target = book) for _ in range(self.buyers)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), self.buyers)
+        self.assertEqual(sum(result.is_reserved for result in results), self.seats)
+        self.assertEqual(sum(result.is_sold_out for result in results), self.buyers - self.seats)
+
+        self.assertEqual(FlightFare.objects.get(flight = self.flight, ticket_class = self.first_class).tickets, self.seats)
+        self.assertEqual(FlightDetail.objects.get(flight = self.flight).tickets, self.seats)
+        self.assertEqual(self.flight.ticket_set.filter(ticket_class = self.first_class).count(), self.seats)
+
+        # Throughput guard: 60 bookings should take well under a few seconds.
+        self.assertLess(elapsed, 10)
+
+class FareServiceTest(FlightFixtureMixin, TestCase):
+    '''Fares edited by managers, and TicketClass names shared through the cache.
+    '''
+
+    def setUp(self) -> None:
+        self.addCleanup(FareService().invalidate_ticket_class_names)
+        self.create_ticket_classes()
+        self.customer = self.create_customer()
+        self.flight = self.create_flight(fares = {self.first_class : (1, 100), self.economy_class : (10, 50)})
+
+    def detail_form(self, **fares) -> FlightDetailForm:
+        data = {'flight_time' : 60}
+        for ticket_class in (self.first_class, self.economy_class):
+            seat_size, price = fares.get(ticket_class.name, ('', ''))
+            data[f'seat_size_{ticket_class.id}'] = seat_size
+            data[f'price_{ticket_class.id}'] = price
+        return FlightDetailForm(data, instance = FlightDetail.objects.get(flight = self.flight))
+
+    def test_blank_class_is_not_sold(self) -> None:
+        form = self.detail_form(First = (1, 100))
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+
+        self.assertEqual(FareService().get_fare_table(self.flight.id), {self.first_class.id : (1, 100)})
+        self.assertEqual(FlightDetail.objects.get(flight = self.flight).seat_size, 1)
+        self.assertEqual(list(FlightTicketForm(flight = self.flight).fields['ticket_class'].queryset), [self.first_class])
+
+    def test_blank_class_with_tickets(self) -> None:
+        ReservationService().reserve(self.flight.id, Ticket(customer = self.customer, ticket_class = self.economy_class))
+
+        form = self.detail_form(First = (1, 100))
+        self.assertFalse(form.is_valid())
+        self.assertIn(f'seat_size_{self.economy_class.id}', form.errors)
+
+        # A fare booked after the form was validated is kept.
+        FareService().set_fares(self.flight.id, {self.economy_class.id : None})
+        self.assertIsNotNone(FareService().get_fare(self.flight.id, self.economy_class.id))
+
+    def test_booking_while_editing(self) -> None:
+        form = self.detail_form(First = (1, 100), Economy = (20, 50))
+        self.assertTrue(form.is_valid(), form.errors)
+
+        ReservationService().reserve(self.flight.id, Ticket(customer = self.customer, ticket_class = self.economy_class))
+        form.save()
+
+        flight_detail = FlightDetail.objects.get(flight = self.flight)
+        self.assertEqual((flight_detail.seat_size, flight_detail.tickets), (21, 1))
+        self.assertFalse(SeatCounterService().get_mismatched_queryset().exists())
+
+    def test_sold_out_class_is_not_offered(self) -> None:
+        ticket = ReservationService().reserve(self.flight.id, Ticket(customer = self.customer, ticket_class = self.first_class)).ticket
+
+        self.assertEqual(list(FlightTicketForm(flight = self.flight).fields['ticket_class'].queryset), [self.economy_class])
+        self.assertCountEqual(
+            FlightTicketForm(flight = self.flight, instance = ticket).fields['ticket_class'].queryset,
+            [self.first_class, self.economy_class],
+        )
+
+    def test_ticket_class_names(self) -> None:
+        fare_service = FareService()
+        names = fare_service.get_ticket_class_names()
+        self.assertEqual(names[self.first_class.id], 'First')
+
+        with self.assertNumQueries(0):
+            fare_service.get_ticket_class_names()
+
+        # Another process finds the names in the cache.
+        FareService._names_version = None
+        with self.assertNumQueries(0):
+            self.assertEqual(fare_service.get_ticket_class_names(), names)
+
+        business_class = TicketClass.objects.create(name = 'Business')
+        self.assertEqual(fare_service.get_ticket_class_names()[business_class.id], 'Business')
+
+        business_class.delete()
+        self.assertNotIn(business_class.id, fare_service.get_ticket_class_names())
+
+class SeatCounterServiceTest(FlightFixtureMixin, TestCase):
+    '''Seat counters follow Tickets created, paid, reclassed, moved and deleted.
+    '''
+
+    def setUp(self) -> None:
+        self.create_ticket_classes()
+        departure, arrival = self.create_airports()
+
+        self.flights = [
+            self.create_flight(departure, arrival, now() + timedelta(days = days), fares = {
+                self.first_class : (10, 100),
+                self.economy_class : (10, 50),
+            })
+            for days in (1, 2)
+        ]
+
+    def assertCounters(self, flight : Flight, ticket_class : TicketClass, tickets : int, tickets_sold : int) -> None:
+        fare = FlightFare.objects.get(flight = flight, ticket_class = ticket_class)
+        self.assertEqual((fare.tickets, fare.tickets_sold), (tickets, tickets_sold))
+        self.assertFalse(SeatCounterService().get_mismatched_queryset().exists())
+
+    def test_ticket_lifecycle(self) -> None:
+        flight, other_flight = self.flights
+        ticket = Ticket.objects.create(flight = flight, ticket_class = self.first_class, price = 100)
+        self.assertCounters(flight, self.first_class, 1, 0)
+
+        ticket.is_booked = True
+        ticket.save()
+        self.assertCounters(flight, self.first_class, 1, 1)
+
+        ticket.ticket_class = self.economy_class
+        ticket.save()
+        self.assertCounters(flight, self.first_class, 0, 0)
+        self.assertCounters(flight, self.economy_class, 1, 1)
+
+        ticket.flight = other_flight
+        ticket.save()
+        self.assertCounters(flight, self.economy_class, 0, 0)
+        self.assertCounters(other_flight, self.economy_class, 1, 1)
+        self.assertEqual(FlightDetail.objects.get(flight = other_flight).tickets_sold, 1)
+
+        ticket.delete()
+        self.assertCounters(other_flight, self.economy_class, 0, 0)
+        self.assertEqual(FlightDetail.objects.get(flight = other_flight).tickets_sold, 0)
+
+    def test_failed_counter_update_rolls_back_ticket(self) -> None:
+        flight = self.flights[0]
+
+        with mock.patch.object(SeatCounterService, 'apply', side_effect = OperationalError('disk I/O error')):
+            with self.assertRaises(OperationalError):
+                Ticket.objects.create(flight = flight, ticket_class = self.first_class, price = 100)
+
+        self.assertFalse(Ticket.objects.exists())
+        self.assertCounters(flight, self.first_class, 0, 0)
+
+class FlightStatisticsTest(FlightFixtureMixin, TestCase):
+    '''seats is the capacity, booked the paid Tickets, empty the seats without any Ticket.
+    '''
+
+    def setUp(self) -> None:
+        self.create_ticket_classes()
+        departure, arrival = self.create_airports()
+
+        self.flight = self.create_flight(departure, arrival, fares = {self.first_class : (10, 100), self.economy_class : (10, 50)})
+        for ticket_class, price, is_booked in ((self.first_class, 100, True), (self.economy_class, 50, True), (self.economy_class, 50, False)):
+            Ticket.objects.create(flight = self.flight, ticket_class = ticket_class, price = price, is_booked = is_booked)
+
+        # A Flight whose FlightDetail is missing, its paid Ticket still makes turnover.
+        self.bare_flight = self.create_flight(departure, arrival, now() + timedelta(days = 2))
+        FlightDetail.objects.filter(flight = self.bare_flight).delete()
+        Ticket.objects.create(flight = self.bare_flight, ticket_class = self.economy_class, price = 70, is_booked = True)
+
+    def test_get_flight_statistics(self) -> None:
+        with self.assertNumQueries(1):
+            statistics = FlightService().get_flight_statistics(Flight.objects.all())
+
+        self.assertEqual(statistics[self.flight.id], {'seats' : 20, 'booked' : 2, 'empty' : 17, 'ratio' : 0.1, 'turnover' : 150})
+        self.assertEqual(statistics[self.bare_flight.id], {'seats' : 0, 'booked' : 0, 'empty' : 0, 'ratio' : 0, 'turnover' : 70})
+        self.assertEqual(FlightService().get_flight_statistics([self.flight.id]).keys(), {self.flight.id})
+
+    def test_wrapper(self) -> None:
+        flights = list(Flight.objects.order_by('id'))
+        with self.assertNumQueries(1):
+            wrappers = FlightStatisticWrapper.wrap_many(flights)
+
+        wrapper = wrappers[self.flight.id]
+        self.assertEqual(
+            (wrapper.numberOfAllSeat(), wrapper.numberOfBookedSeat(), wrapper.numberOfEmptySeat(), wrapper.ratio(), wrapper.turnover()),
+            (20, 2, 17, 0.1, 150),
+        )
+
+        wrapper = FlightStatisticWrapper(self.bare_flight)
+        self.assertEqual(
+            (wrapper.numberOfAllSeat(), wrapper.numberOfBookedSeat(), wrapper.numberOfEmptySeat(), wrapper.ratio(), wrapper.turnover()),
+            (0, 0, 0, 0, 70),
+        )
+
+class GeneralReportTest(FlightFixtureMixin, TestCase):
+    '''The general report of departed flights, on the page and exported.
+    '''
+
+    def setUp(self) -> None:
+        self.create_ticket_classes()
+        departure, arrival = self.create_airports()
+
+        self.flights = [
+            self.create_flight(departure, arrival, now() - timedelta(days = days), fares = {self.economy_class : (10, 50)})
+            for days in (3, 2, 1)
+        ]
+        for is_booked in (True, True, False):
+            Ticket.objects.create(flight = self.flights[0], ticket_class = self.economy_class, price = 50, is_booked = is_booked)
+
+        # Upcoming flights are not reported.
+        self.create_flight(departure, arrival)
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def test_report_queryset(self) -> None:
+        with self.assertNumQueries(1):
+            flights = list(FlightService().get_general_report_queryset(Flight.objects.all()))
+
+        self.assertEqual([flight.id for flight in flights], [flight.id for flight in self.flights])
+        flight = flights[0]
+        self.assertEqual(
+            (flight.total_seats, flight.total_tickets_sold, flight.revenue, flight.ticket_sold_percentage),
+            (10, 2, 100, 20.0),
+        )
+
+    def test_report_page_queries(self) -> None:
+        '''A report page takes as many queries with more flights on it.
+        '''
+        def count_queries() -> int:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('report.general'))
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        queries = count_queries()
+        for days in range(4, 9):
+            self.create_flight(*self.create_airports(f'Departure {days}', f'Arrival {days}'), now() - timedelta(days = days))
+
+        self.assertEqual(count_queries(), queries)
+
+    def test_csv_export(self) -> None:
+        response = self.client.get(reverse('report.general.export'))
+
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], list(ExportFlightReportGeneralView.columns))
+        self.assertEqual(len(rows), 1 + len(self.flights))
+        self.assertEqual(rows[1][4:], ['10', '2', '100', '20.0'])
+
+    def test_jsonl_export_and_invalid_format(self) -> None:
+        response = self.client.get(reverse('report.general.export'), {'format' : 'jsonl'})
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([line['flight'] for line in lines], [flight.id for flight in self.flights])
+
+        self.assertEqual(self.client.get(reverse('report.general.export'), {'format' : 'xlsx'}).status_code, 400)
+
+class YearlyReportTest(FlightFixtureMixin, TestCase):
+    '''Monthly rows of a year, and their totals and ratios summed in Python.
+    '''
+
+    def setUp(self) -> None:
+        self.create_ticket_classes()
+        departure, arrival = self.create_airports()
+        self.year = now().year - 1
+
+        for month, day, prices in ((1, 15, (100, 50)), (1, 20, ()), (3, 10, (50,))):
+            flight = self.create_flight(departure, arrival, make_aware(datetime(self.year, month, day, 12)))
+            for price in prices:
+                Ticket.objects.create(flight = flight, ticket_class = self.economy_class, price = price, is_booked = True)
+            Ticket.objects.create(flight = flight, ticket_class = self.economy_class, price = 500, is_booked = False)
+
+    def test_yearly_summary(self) -> None:
+        with self.assertNumQueries(1):
+            summary = FlightService().yearly_summary(self.year)
+
+        self.assertEqual(
+            [(month['month'].month, month['total_flights'], month['total_tickets_sold'], month['revenue'], month['ratio']) for month in summary['months']],
+            [(1, 2, 2, 150, 75.0), (3, 1, 1, 50, 25.0)],
+        )
+        self.assertEqual(
+            (summary['total_flights'], summary['total_tickets_sold'], summary['total_revenue'], summary['total_ratio']),
+            (3, 3, 200, 100),
+        )
+
+    def test_empty_year(self) -> None:
+        summary = FlightService().yearly_summary(self.year - 1)
+
+        self.assertEqual(summary['months'], [])
+        self.assertEqual((summary['total_revenue'], summary['total_ratio']), (0, 0))
+
+class ChartServiceTest(TestCase):
+    '''Report charts are served from signed URLs, rendered once per process.
+    '''
+
+    def setUp(self) -> None:
+        ChartService._charts.clear()
+        self.addCleanup(ChartService._charts.clear)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+        self.url = ChartService().get_bar_chart_url(['January', 'February'], [3, 5], 'Flight Graph', 'Month', 'Flights')
+
+    def test_chart_view(self) -> None:
+        with mock.patch.object(ChartService, 'render', autospec = True, side_effect = ChartService.render) as render:
+            response = self.client.get(self.url)
+            self.client.get(self.url)
+
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'Flight Graph', response.content)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH = response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_tampered_url(self) -> None:
+        self.assertEqual(self.client.get(self.url[:-2] + 'xx').status_code, 404)
+
+    def test_least_recently_used_chart_is_evicted(self) -> None:
+        chart_service = ChartService()
+        specs = [chart_service.load_spec(chart_service.get_bar_chart_url(['A'], [i], f'Chart {i}', 'x', 'y').rsplit('/', 1)[-1]) for i in range(3)]
+
+        with mock.patch.object(ChartService, 'max_entries', 2):
+            for spec in (specs[0], specs[1], specs[0], specs[2]):
+                chart_service.get_chart(spec)
+
+        self.assertEqual(set(ChartService._charts), {chart_service.chart_key(specs[0]), chart_service.chart_key(specs[2])})
+
+    def test_yearly_report_links_charts(self) -> None:
+        response = self.client.get(reverse('report.yearly'))
+
+        self.assertTrue(response.context['flight_graph'].startswith('/report/chart/'))
+        self.assertEqual(self.client.get(response.context['revenue_graph']).status_code, 200)
+
+class SearchCacheTest(FlightFixtureMixin, TestCase):
+    '''Flight searches are cached per route, and only the routes a change touches are invalidated.
+    '''
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.create_ticket_classes()
+
+        self.airports = self.create_airports('Origin', 'Destination', 'Elsewhere')
+        self.flight = self.create_flight(self.airports[0], self.airports[1], fares = {self.economy_class : (10, 50)})
+        self.other_flight = self.create_flight(self.airports[0], self.airports[2], fares = {self.economy_class : (10, 50)})
+
+    def search(self, departure : Airport = None, arrival : Airport = None) -> dict:
+        '''{flight_id : remaining_seats} found by the search page.
+        '''
+        params = {'departure_airport' : departure and departure.id, 'arrival_airport' : arrival and arrival.id}
+        response = self.client.get(reverse('flight.search'), {name : value for name, value in params.items() if value})
+        return {flight.id : flight.remaining_seats for flight in response.context['page_obj']}
+
+    def get_lookups(self) -> tuple:
+        metrics = SearchCacheService().get_metrics()
+        return metrics['hits'], metrics['misses']
+
+    def book(self, flight : Flight) -> None:
+        Ticket.objects.create(flight = flight, ticket_class = self.economy_class, price = 50)
+
+    def test_hit_and_route_invalidation(self) -> None:
+        route = self.airports[0], self.airports[1]
+
+        self.assertEqual(self.search(*route), {self.flight.id : 10})
+        self.assertEqual(self.search(*route), {self.flight.id : 10})
+        self.assertEqual(self.get_lookups(), (1, 1))
+
+        # Another route changed, this search is still cached.
+        self.book(self.other_flight)
+        self.search(*route)
+        self.assertEqual(self.get_lookups(), (2, 1))
+
+        self.book(self.flight)
+        self.assertEqual(self.search(*route), {self.flight.id : 9})
+        self.assertEqual(self.get_lookups(), (2, 2))
+
+    def test_partial_route_invalidation(self) -> None:
+        self.assertEqual(self.search(self.airports[0]), {self.flight.id : 10, self.other_flight.id : 10})
+        self.assertEqual(self.search(arrival = self.airports[2]), {self.other_flight.id : 10})
+
+        # (Origin, *) and (*, Elsewhere) depend on the route of other_flight.
+        self.book(self.other_flight)
+        self.assertEqual(self.search(self.airports[0])[self.other_flight.id], 9)
+        self.assertEqual(self.search(arrival = self.airports[2]), {self.other_flight.id : 9})
+        self.assertEqual(self.get_lookups(), (0, 4))
+
+    def test_rescheduled_flight_leaves_both_routes(self) -> None:
+        route = self.airports[0], self.airports[1]
+        self.search(*route)
+
+        self.flight.arrival_airport = self.airports[2]
+        self.flight.save()
+
+        self.assertEqual(self.search(*route), {})
+        self.assertEqual(self.search(self.airports[0], self.airports[2]), {self.flight.id : 10, self.other_flight.id : 10})
+
+class TicketCancellationTest(FlightFixtureMixin, TestCase):
+    '''Unpaid Tickets, older ones with is_booked NULL included, are canceled once
+    their flight departed, and payable again when it is rescheduled.
+    '''
+
+    def setUp(self) -> None:
+        self.create_ticket_classes()
+        departure, arrival = self.create_airports()
+
+        self.departed = self.create_flight(departure, arrival, now() - timedelta(hours = 1))
+        self.upcoming = self.create_flight(departure, arrival)
+
+        def ticket(flight : Flight, is_booked : bool) -> Ticket:
+            return Ticket.objects.create(flight = flight, ticket_class = self.economy_class, price = 50, is_booked = is_booked)
+
+        self.unpaid = ticket(self.departed, False)
+        self.legacy_unpaid = ticket(self.departed, None)
+        self.paid = ticket(self.departed, True)
+        self.upcoming_unpaid = ticket(self.upcoming, False)
+
+    def test_due_for_cancellation(self) -> None:
+        self.assertEqual(
+            set(Ticket.objects.due_for_cancellation().values_list('id', flat = True)),
+            {self.unpaid.id, self.legacy_unpaid.id},
+        )
+        self.assertEqual(Ticket.objects.unpaid().count(), 3)
+
+    def test_sweeper_command(self) -> None:
+        out = StringIO()
+        call_command('cancel_unpaid_tickets', batch_size = 1, stdout = out)
+        self.assertIn('Canceled 2 unpaid ticket(s).', out.getvalue())
+
+        self.assertEqual(
+            set(Ticket.objects.canceled().values_list('id', flat = True)),
+            {self.unpaid.id, self.legacy_unpaid.id},
+        )
+        self.assertFalse(Ticket.objects.due_for_cancellation().exists())
+
+        out = StringIO()
+        call_command('cancel_unpaid_tickets', stdout = out)
+        self.assertIn('Canceled 0 unpaid ticket(s).', out.getvalue())
+
+    def test_restore_on_reschedule(self) -> None:
+        TicketService().cancel_unpaid_tickets()
+
+        self.departed.date_time = now() + timedelta(days = 2)
+        self.departed.save()
+
+        self.assertFalse(Ticket.objects.canceled().exists())
+        self.assertEqual(TicketService().restore_canceled_tickets(self.departed.id), 0)
+
+class RevenueRollupServiceTest(FlightFixtureMixin, TestCase):
+    '''Report rollups follow Flights and paid Tickets, and match a rebuild.
+    '''
+
+    def setUp(self) -> None:
+        self.create_ticket_classes()
+        self.airports = self.create_airports(*(f'Airport {i}' for i in range(3)))
+        self.flights = [
+            self.create_flight(self.airports[0], self.airports[1], now() - timedelta(days = 40)),
+            self.create_flight(self.airports[1], self.airports[2], now() + timedelta(days = 40)),
+        ]
+
+    def get_buckets(self) -> dict:
+        '''{(month, departure, arrival, class) : (flights, tickets sold, revenue)} of non-empty rows.
+        '''
+        return {
+            row[:4] : row[4:]
+            for row in RevenueRollup.objects.values_list(
+                'month', 'departure_airport_id', 'arrival_airport_id', 'ticket_class_id',
+                'total_flights', 'total_tickets_sold', 'revenue',
+            )
+            if any(row[4:])
+        }
+
+    def assertMatchesRebuild(self) -> dict:
+        buckets = self.get_buckets()
+        RevenueRollupService().rebuild()
+        self.assertEqual(buckets, self.get_buckets())
+        return buckets
+
+    def test_flight_and_ticket_changes(self) -> None:
+        flight, other_flight = self.flights
+        self.assertEqual(len(self.assertMatchesRebuild()), 2)
+
+        ticket = Ticket.objects.create(flight = flight, ticket_class = self.economy_class, price = 50)
+        ticket.is_booked = True
+        ticket.save()
+        self.assertEqual(sum(sold for _, sold, _ in self.assertMatchesRebuild().values()), 1)
+
+        ticket.flight = other_flight
+        ticket.price = 70
+        ticket.save()
+        self.assertMatchesRebuild()
+
+        other_flight.departure_airport = self.airports[0]
+        other_flight.date_time = now() + timedelta(days = 80)
+        other_flight.save()
+        self.assertMatchesRebuild()
+
+        ticket.delete()
+        self.assertEqual(sum(revenue for _, _, revenue in self.assertMatchesRebuild().values()), 0)
+
+        other_flight.delete()
+        self.assertEqual(len(self.assertMatchesRebuild()), 1)
+        self.assertEqual(RevenueRollupService.get_deleting_flights(), set())
+
+    def test_failed_flight_deletion(self) -> None:
+        flight = self.flights[0]
+        Ticket.objects.create(flight = flight, ticket_class = self.economy_class, price = 50, is_booked = True)
+
+        # Fails after pre_delete signals, before post_delete ones.
+        with mock.patch.object(DeleteQuery, 'delete_batch', side_effect = OperationalError('disk I/O error')):
+            with self.assertRaises(OperationalError), transaction.atomic():
+                flight.delete()
+
+        self.assertEqual(RevenueRollupService.get_deleting_flights(), {flight.pk})
+        request_finished.send(sender = self.__class__)
+        self.assertEqual(RevenueRollupService.get_deleting_flights(), set())
+
+        Ticket.objects.create(flight = flight, ticket_class = self.economy_class, price = 30, is_booked = True)
+        self.assertEqual(sum(revenue for _, _, revenue in self.assertMatchesRebuild().values()), 80)
+
+    def test_concurrent_bucket_creation(self) -> None:
+        route = (date(2020, 1, 1), None, self.airports[0].id)
+        RevenueRollupService().add(route, self.economy_class.id, total_tickets_sold = 1, revenue = 10)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            RevenueRollup.objects.create(month = route[0], arrival_airport = self.airports[0], ticket_class = self.economy_class)
+
+        update = QuerySet.update
+        calls = []
+
+        def racing_update(queryset, **kwargs):
+            # The first UPDATE does not see the row created by the other transaction yet.
+            calls.append(kwargs)
+            return 0 if len(calls) == 1 else update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', racing_update):
+            RevenueRollupService().add(route, self.economy_class.id, total_tickets_sold = 2, revenue = 20)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(list(RevenueRollup.objects.filter(month = route[0]).values_list('total_tickets_sold', 'revenue')), [(3, 30)])
+
+class TicketOwnerTest(FlightFixtureMixin, TestCase):
+    '''Only the owner of a Ticket and managers can see, change, pay or cancel it.
+    '''
+
+    def setUp(self) -> None:
+        self.create_ticket_classes()
+        flight = self.create_flight(fares = {self.economy_class : (10, 50)})
+
+        self.owner = self.create_customer('owner').user
+        self.ticket = Ticket.objects.create(flight = flight, ticket_class = self.economy_class, customer = self.owner.customer, price = 50)
+        self.orphan_ticket = Ticket.objects.create(flight = flight, ticket_class = self.economy_class, price = 50)
+
+    def get_status_codes(self, username : str, ticket : Ticket) -> list:
+        '''Status codes of the detail, update, delete and payment pages of ticket.
+        '''
+        self.client.force_login(User.objects.get(username = username))
+
+        return [
+            self.client.get(reverse(name, kwargs = {'pk' : ticket.pk})).status_code
+            for name in ('flight.reservation.detail', 'flight.reservation.update', 'flight.reservation.delete', 'flight.reservation.payment')
+        ]
+
+    def test_owner_and_other_customer(self) -> None:
+        self.create_customer('other')
+
+        self.assertEqual(self.get_status_codes('owner', self.ticket), [200] * 4)
+        self.assertEqual(self.get_status_codes('other', self.ticket), [403] * 4)
+        self.assertEqual(self.get_status_codes('other', self.orphan_ticket), [403] * 4)
+
+    def test_user_without_profile(self) -> None:
+        self.create_customer('staff').delete()
+
+        self.assertEqual(self.get_status_codes('staff', self.orphan_ticket), [403] * 4)
+        self.assertEqual(self.get_status_codes('staff', self.ticket), [403] * 4)
+
+        response = self.client.get(reverse('flight.reservation.list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['object_list']), [])
+
+        response = self.client.post(reverse('flight.reservation.create', kwargs = {'pk' : self.ticket.flight_id}), {
+            'name' : 'Staff',
+            'phone' : '0123456789',
+            'identity_code' : '0123456789',
+            'ticket_class' : self.ticket.ticket_class_id,
+        })
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Ticket.objects.count(), 2)
+
+    def test_owner_ticket_list(self) -> None:
+        self.client.force_login(self.owner)
+
+        response = self.client.get(reverse('flight.reservation.list'))
+        self.assertEqual(list(response.context['object_list']), [self.ticket])
+
+    def test_manager_until_removed_from_group(self) -> None:
+        manager = self.create_customer('manager').user
+        manager_group = Group.objects.get(name = 'Manager')
+        manager_group.user_set.add(manager)
+
+        self.assertEqual(self.get_status_codes('manager', self.ticket), [200] * 4)
+        self.assertEqual(self.get_status_codes('manager', self.orphan_ticket), [200] * 4)
+
+        manager_group.user_set.remove(manager)
+        self.assertEqual(self.get_status_codes('manager', self.ticket), [403] * 4)
+
+class CursorPaginationTest(FlightFixtureMixin, TestCase):
+    '''Keyset pages cover every row once, in order, even with ties on date_time.
+    '''
+
+    page_size = 3
+
+    def setUp(self) -> None:
+        departure, arrival = self.create_airports()
+        date_time = now() + timedelta(days = 1)
+
+        # Three flights share each date_time, only id breaks the ties.
+        for hours in (0, 0, 0, 1, 1, 1, 2):
+            self.create_flight(departure, arrival, date_time + timedelta(hours = hours))
+
+        self.expected_ids = list(Flight.objects.order_by('date_time', 'id').values_list('id', flat = True))
+
+    def get_page(self, cursor : str = None) -> CursorPage:
+        view = CursorPaginationMixin()
+        view.cursor_ordering = ('date_time', 'id')
+        view.request = RequestFactory().get('/flight/', {'cursor' : cursor} if cursor else {})
+
+        _, page, _, _ = view.paginate_queryset(Flight.objects.all(), self.page_size)
+        return page
+
+    def test_next_and_previous(self) -> None:
+        pages = [self.get_page()]
+        while pages[-1].has_next():
+            pages.append(self.get_page(pages[-1].next_cursor))
+
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual([flight.id for page in pages for flight in page], self.expected_ids)
+        self.assertFalse(pages[0].has_previous())
+        self.assertFalse(pages[-1].has_next())
+
+        # Walk back from the last page.
+        page = pages[-1]
+        for expected_page in reversed(pages[:-1]):
+            page = self.get_page(page.previous_cursor)
+            self.assertEqual([flight.id for flight in page], [flight.id for flight in expected_page])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_tampered_cursor(self) -> None:
+        next_cursor = self.get_page().next_cursor
+        payloads = [
+            next_cursor[:-4],
+            'not a cursor',
+            base64.urlsafe_b64encode(b'["sideways", ["2030-01-01T00:00:00Z", "1"]]').decode(),
+            base64.urlsafe_b64encode(b'["next", ["not a date", "1"]]').decode(),
+            base64.urlsafe_b64encode(b'["next", ["2030-01-01T00:00:00Z"]]').decode(),
+        ]
+
+        for payload in payloads:
+            with self.subTest(payload = payload), self.assertRaises(Http404):
+                self.get_page(payload)
+
+class FlightGraphTest(SimpleTestCase):
+    '''Connections must respect the minimum connection time, seats and hop limit.
+    '''
+
+    def leg(self, flight_id : int, departure_airport_id : int, arrival_airport_id : int,
+            hour : float, minutes : int = 60, price : int = 100, seats : int = 10) -> FlightLeg:
+        departure = self.start + timedelta(hours = hour)
+        return FlightLeg(flight_id, departure_airport_id, arrival_airport_id, departure,
+            departure + timedelta(minutes = minutes), price, seats)
+
+    def setUp(self) -> None:
+        self.start = now().replace(microsecond = 0) + timedelta(days = 1)
+        self.graph = FlightGraph([
+            self.leg(1, 'A', 'B', 0),
+            self.leg(2, 'B', 'C', 1.5),              # 30 minutes after leg 1 lands
+            self.leg(3, 'B', 'C', 3, price = 50),
+            self.leg(4, 'C', 'D', 5),
+            self.leg(5, 'A', 'C', 8, price = 500),
+        ])
+
+    def search(self, destination_id : str, **kwargs) -> list:
+        itineraries = self.graph.search('A', destination_id, self.start, self.start + timedelta(hours = 12), **kwargs)
+        return sorted(itinerary.flight_ids for itinerary in itineraries)
+
+    def test_connections(self):
+        self.assertEqual(self.search('C'), [[1, 3], [5]])
+
+    def test_hop_limit(self):
+        self.assertEqual(self.search('D'), [[1, 3, 4]])
+        self.assertEqual(self.search('D', max_legs = 2), [])
+
+    def test_incremental_update(self):
+        self.graph.add(self.leg(3, 'B', 'C', 3, seats = 0))
+        self.assertEqual(self.search('C'), [[5]])
+
+        self.graph.remove(5)
+        self.assertEqual(self.search('C'), [])
+
+    def test_copy_leaves_original_unchanged(self):
+        graph = self.graph.copy()
+        graph.remove(5)
+        graph.add(self.leg(6, 'A', 'C', 9))
+
+        self.assertEqual(self.search('C'), [[1, 3], [5]])
+        self.assertEqual(sorted(itinerary.flight_ids for itinerary in graph.search('A', 'C', self.start, self.start + timedelta(hours = 12))), [[1, 3], [6]])
+
+class ItineraryServiceTest(FlightFixtureMixin, TestCase):
+    '''Searches run on a snapshot of the graph, without waiting for its writers.
+    '''
+
+    def setUp(self) -> None:
+        self.addCleanup(setattr, ItineraryService, 'graph', None)
+        self.create_ticket_classes()
+        self.airports = self.create_airports('Origin', 'Destination')
+        self.flight = self.create_flight(*self.airports, fares = {self.economy_class : (10, 50)})
+
+    def search(self) -> list:
+        itineraries = ItineraryService().search(self.airports[0].id, self.airports[1].id, (now() + timedelta(days = 1)).date())
+        return [itinerary.flight_ids for itinerary in itineraries]
+
+    def test_search_does_not_wait_for_writers(self) -> None:
+        self.assertEqual(self.search(), [[self.flight.id]])
+
+        locked = threading.Event()
+        release = threading.Event()
+
+        def write() -> None:
+            with ItineraryService.lock:
+                locked.set()
+                release.wait(5)
+
+        writer = threading.Thread(target = write)
+        writer.start()
+        locked.wait(5)
+
+        start = time.perf_counter()
+        try:
+            self.assertEqual(self.search(), [[self.flight.id]])
+        finally:
+            release.set()
+            writer.join()
+        self.assertLess(time.perf_counter() - start, 2)
+
+    def test_refresh_replaces_graph(self) -> None:
+        self.search()
+        graph = ItineraryService.graph
+
+        self.flight.delete()
+
+        self.assertIsNot(ItineraryService.graph, graph)
+        self.assertEqual(len(graph), 1)
+        self.assertEqual(len(ItineraryService.graph), 0)
+
+class GraphPlottingTest(SimpleTestCase):
+    '''The SVG backend draws charts without importing matplotlib.
+    '''
+
+    def render(self, labels : list, values : list, title : str = 'Revenue Graph') -> ElementTree.Element:
+        svg = GraphPlotting(labels, values, title, 'svg').render_bar_plot('Month', 'Revenue')
+        return ElementTree.fromstring(svg)
+
+    def test_svg_bar_plot(self) -> None:
+        root = self.render(['January', 'February', 'March'], [100, 250, 0], title = 'Revenue <&> Graph')
+
+        namespace = '{http://www.w3.org/2000/svg}'
+        bars = [rect for rect in root.iter(f'{namespace}rect') if rect.get('fill') == GraphPlotting.bar_color]
+        self.assertEqual(len(bars), 3)
+        self.assertEqual(bars[2].get('height'), '0.0')
+        self.assertLess(float(bars[0].get('height')), float(bars[1].get('height')))
+        self.assertIn('Revenue <&> Graph', [text.text for text in root.iter(f'{namespace}text')])
+
+    def test_empty_and_negative_values(self) -> None:
+        self.render([], [])
+        self.render(['January'], [0])
+        self.render(['January', 'February'], [-30, None])
+
+    def test_tick_step(self) -> None:
+        graph = GraphPlotting([], [], '')
+        self.assertEqual([graph.tick_step(span) for span in (0, 7, 100, 900)], [1, 2, 20, 200])
+
+    def test_matplotlib_backend(self) -> None:
+        graph = GraphPlotting(['January'], [1], 'Graph', 'matplotlib')
+        self.assertEqual(graph.format, 'png')
+        self.assertTrue(graph.render_bar_plot('Month', 'Flights').startswith(b'\x89PNG'))
+
+    def test_matplotlib_not_imported(self) -> None:
+        code = (
+            'import sys, django; django.setup(); import main.urls; from main.utils import GraphPlotting; '
+            'GraphPlotting(["January"], [1], "Graph").get_bar_plot("Month", "Flights"); '
+            'print("matplotlib" in sys.modules)'
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', code],
+            cwd = settings.BASE_DIR,
+            env = dict(os.environ, DJANGO_SETTINGS_MODULE = 'FlightManager.settings'),
+            capture_output = True,
+            text = True,
+        )
+        self.assertEqual(result.stdout.strip(), 'False', result.stderr)
+
+class AirportIndexTest(SimpleTestCase):
+    '''Typeahead must match name and word prefixes first, then similar names.
+    '''
+
+    def setUp(self) -> None:
+        self.index = AirportIndex([
+            (1, 'Tan Son Nhat International'),
+            (2, 'Noi Bai International'),
+            (3, 'São Paulo Guarulhos'),
+            (4, 'Da Nang'),
+        ])
+
+    def ids(self, query : str, limit : int = 10) -> list:
+        return [airport_id for airport_id, _ in self.index.search(query, limit)]
+
+    def test_prefixes(self):
+        self.assertEqual(self.ids('noi'), [2])
+        self.assertEqual(self.ids('intern', limit = 1), [2])
+        self.assertEqual(self.ids('nhat inter', limit = 1), [1])
+        self.assertEqual(self.ids('sao'), [3])
+
+    def test_similar(self):
+        self.assertEqual(self.ids('guarulos'), [3])
+        self.assertEqual(self.ids('xyz'), [])
+
+    def test_incremental_update(self):
+        self.index.add(4, 'Cam Ranh')
+        self.assertEqual(self.ids('cam'), [4])
+        self.assertEqual(self.ids('da nang'), [])
+
+        self.index.remove(4)
+        self.assertEqual(self.ids('cam'), [])
+
+class AirportCatalogTest(TestCase):
+    '''Airport dropdowns are served from a versioned catalog, replaced when an Airport changes.
+    '''
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.addCleanup(cache.clear)
+        AirportCatalogService._version = None
+
+        self.first = Airport.objects.create(name = 'Tan Son Nhat')
+        self.second = Airport.objects.create(name = 'Noi Bai & Co')
+        self.service = AirportCatalogService()
+
+    def test_choices_and_options(self) -> None:
+        self.assertEqual(self.service.get_choices(), [(self.second.id, 'Noi Bai & Co'), (self.first.id, 'Tan Son Nhat')])
+        self.assertEqual(
+            self.service.get_options_html(),
+            f'<option value="{self.second.id}">Noi Bai &amp; Co</option>'
+            f'<option value="{self.first.id}">Tan Son Nhat</option>',
+        )
+
+        with self.assertNumQueries(0):
+            self.service.get_choices()
+            self.service.get_options_html()
+            self.service.search('tan')
+
+    def test_invalidation_on_save_and_delete(self) -> None:
+        self.service.get_choices()
+
+        self.first.name = 'Da Nang'
+        self.first.save()
+        self.assertIn((self.first.id, 'Da Nang'), self.service.get_choices())
+        self.assertEqual(self.service.get_name(self.first.id), 'Da Nang')
+        self.assertEqual(self.service.search('da')[0][0], self.first.id)
+
+        third = Airport.objects.create(name = 'Cam Ranh')
+        self.assertEqual(self.service.get_choices()[0], (third.id, 'Cam Ranh'))
+
+        third_id = third.id
+        third.delete()
+        self.assertNotIn(third_id, dict(self.service.get_choices()))
+        self.assertIsNone(self.service.get_name(third_id))
+
+    def test_other_process_reloads_from_cache(self) -> None:
+        choices = self.service.get_choices()
+
+        # A fresh process has no catalog in memory but finds it in the cache.
+        AirportCatalogService._version = None
+        with self.assertNumQueries(0):
+            self.assertEqual(self.service.get_choices(), choices)
+
+        # A change made by another process only replaces the cached version.
+        Airport.objects.filter(id = self.first.id).update(name = 'Phu Quoc')
+        self.assertEqual(dict(self.service.get_choices())[self.first.id], 'Tan Son Nhat')
+        self.service.cache.set(AirportCatalogService.version_key, time.time_ns(), None)
+        self.assertEqual(dict(self.service.get_choices())[self.first.id], 'Phu Quoc')
+
+class PolicyServiceTest(TestCase):
+    '''Applied Policies are read from an in-memory snapshot, converted to their datatype.
+    '''
+
+    def setUp(self) -> None:
+        PolicyService().invalidate()
+        self.addCleanup(PolicyService().invalidate)
+        self.service = PolicyService()
+
+    def test_snapshot_conversion(self) -> None:
+        Policy.objects.create(name = PolicyService.MIN_CONNECTION_TIME, datatype = 'Minutes', value = 45, is_applied = True)
+        Policy.objects.create(name = PolicyService.BOOKING_CUTOFF, datatype = 'hours', value = 2, is_applied = True)
+        Policy.objects.create(name = PolicyService.MAX_TICKETS_PER_CUSTOMER, datatype = None, value = 3, is_applied = True)
+        Policy.objects.create(name = 'allow_overbooking', datatype = 'bool', value = 0, is_applied = True)
+        Policy.objects.create(name = 'not_applied', datatype = 'int', value = 1, is_applied = False)
+        Policy.objects.create(name = 'no_value', datatype = 'int', value = None, is_applied = True)
+
+        snapshot = self.service.get_snapshot()
+        self.assertEqual(dict(snapshot.values), {
+            PolicyService.MIN_CONNECTION_TIME : timedelta(minutes = 45),
+            PolicyService.BOOKING_CUTOFF : timedelta(hours = 2),
+            PolicyService.MAX_TICKETS_PER_CUSTOMER : 3,
+            'allow_overbooking' : False,
+        })
+        with self.assertRaises(TypeError):
+            snapshot.values['not_applied'] = 1
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.service.min_connection_time(), timedelta(minutes = 45))
+            self.assertEqual(self.service.booking_cutoff(), timedelta(hours = 2))
+            self.assertEqual(self.service.max_tickets_per_customer(), 3)
+
+    def test_defaults_and_durations(self) -> None:
+        self.assertEqual(self.service.min_connection_time(), ItineraryService.min_connection)
+        self.assertEqual(self.service.booking_cutoff(), timedelta())
+        self.assertEqual(self.service.max_tickets_per_customer(), 0)
+
+        # Durations stored as plain integers are minutes.
+        Policy.objects.create(name = PolicyService.BOOKING_CUTOFF, datatype = 'int', value = 30, is_applied = True)
+        self.assertEqual(self.service.booking_cutoff(), timedelta(minutes = 30))
+
+    def test_invalidation_on_save_and_delete(self) -> None:
+        self.assertIsNone(self.service.get('max_bags'))
+
+        policy = Policy.objects.create(name = 'max_bags', datatype = 'int', value = 2, is_applied = True)
+        self.assertEqual(self.service.get('max_bags'), 2)
+
+        policy.is_applied = False
+        policy.save()
+        self.assertIsNone(self.service.get('max_bags'))
+
+        policy.is_applied = True
+        policy.save()
+        policy.delete()
+        self.assertEqual(self.service.get('max_bags', 1), 1)
+
+    def test_recheck_interval(self) -> None:
+        self.service.get_snapshot()
+
+        # Another process applies a Policy: this one notices only after recheck_interval.
+        Policy.objects.bulk_create([Policy(name = 'max_bags', datatype = 'int', value = 2, is_applied = True)])
+        self.service.cache.set(PolicyService.version_key, time.time_ns(), None)
+
+        with mock.patch.object(PolicyService, 'recheck_interval', 60):
+            with self.assertNumQueries(0):
+                self.assertIsNone(self.service.get('max_bags'))
+
+        with mock.patch.object(PolicyService, 'recheck_interval', 0):
+            self.assertEqual(self.service.get('max_bags'), 2)
+
+class ReplicaRouterTest(SimpleTestCase):
+    '''Search and report reads go to the replica, unless the user just booked.
+    '''
+
+    def setUp(self) -> None:
+        self.router = ReplicaRouter()
+        self.request = RequestFactory().get('/flight/search/')
+        self.request.session = {}
+
+        patcher = mock.patch.object(ReplicaRouter, 'replica_alias', return_value = 'replica')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads(self):
+        self.assertEqual(ReplicaRouter.read_alias(), 'default')
+
+        with ReplicaRouter.reads(self.request):
+            self.assertEqual(ReplicaRouter.read_alias(), 'replica')
+            self.assertEqual(FlightService().get_search_queryset(Flight.objects.all()).db, 'replica')
+
+        self.assertEqual(ReplicaRouter.read_alias(), 'default')
+
+    def test_pinned_after_write(self):
+        ReplicaRouter.pin_primary(self.request)
+
+        with ReplicaRouter.reads(self.request):
+            self.assertEqual(ReplicaRouter.read_alias(), 'default')
+
+        self.request.session[ReplicaRouter.session_key] = time.time() - 1
+        with ReplicaRouter.reads(self.request):
+            self.assertEqual(ReplicaRouter.read_alias(), 'replica')
+
+    def test_pinned_after_successful_post_only(self):
+        class WriteView(PrimaryAfterWriteMixin, View):
+            def post(self, request, *args, **kwargs):
+                if request.POST.get('valid'):
+                    return HttpResponseRedirect('/ticket/')
+                return HttpResponse('Invalid form')
+
+        request = RequestFactory().post('/ticket/create/')
+        request.session = {}
+        self.assertEqual(WriteView.as_view()(request).status_code, 200)
+        self.assertFalse(ReplicaRouter.is_pinned(request))
+
+        request = RequestFactory().post('/ticket/create/', {'valid' : '1'})
+        request.session = {}
+        self.assertEqual(WriteView.as_view()(request).status_code, 302)
+        self.assertTrue(ReplicaRouter.is_pinned(request))
+
+    @override_settings(READ_REPLICA_STICKINESS = 3)
+    def test_replica_rows_cached_for_stickiness(self):
+        search_cache_service = SearchCacheService()
+        queryset = mock.MagicMock(db = 'replica')
+        queryset.values_list.return_value = [(1, now(), 10, 0, 0, 10)]
+
+        with mock.patch.object(search_cache_service.cache, 'set') as cache_set:
+            search_cache_service.get_rows((1, 2, None, None), queryset)
+
+        key, rows, timeout = cache_set.call_args.args
+        self.assertIn(':replica:', key)
+        self.assertEqual(timeout, 3)
+
+    def test_writes_and_migrations(self):
+        self.assertEqual(self.router.db_for_write(Ticket), 'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'main'))
+        self.assertIsNone(self.router.allow_migrate('default', 'main'))
+
+class ConnectionHealthTest(TestCase):
+    '''Persistent connections with CONN_HEALTH_CHECKS are checked when a request starts.
+    '''
+
+    def check(self, health_checks : bool, usable : bool) -> bool:
+        '''Whether check_connections closed the default connection.
+        '''
+        with mock.patch.dict(connection.settings_dict, {'CONN_HEALTH_CHECKS' : health_checks}), \
+                mock.patch.object(connection, 'is_usable', return_value = usable), \
+                mock.patch.object(connection, 'close') as close:
+            check_connections(sender = None)
+        return close.called
+
+    def test_unusable_connection_is_closed(self):
+        self.assertTrue(self.check(health_checks = True, usable = False))
+        self.assertFalse(self.check(health_checks = True, usable = True))
+        self.assertFalse(self.check(health_checks = False, usable = False))
+
+class ScheduleImportServiceTest(FlightFixtureMixin, TestCase):
+    '''Imported flights get their details, transitions and rollups,
+    invalid rows are rejected with the form rules.
+    '''
+
+    def setUp(self) -> None:
+        self.create_airports('Departure', 'Arrival', 'Transit')
+
+        self.row = {
+            'departure_airport' : 'Departure',
+            'arrival_airport' : 'Arrival',
+            'date_time' : '2030-01-15 10:00',
+            'flight_time' : '90',
+            'first_class_seat_size' : '10',
+            'first_class_ticket_price' : '300',
+            'second_class_seat_size' : '50',
+            'second_class_ticket_price' : '100',
+            'transition_airports' : 'Transit:30:fuel stop',
+        }
+
+    def test_import(self):
+        total = ScheduleImportService(batch_size = 2).import_rows(enumerate([self.row] * 3, 1))
+
+        self.assertEqual(total, 3)
+        self.assertEqual(FlightDetail.objects.filter(flight_time = 90, seat_size = 60).count(), 3)
+        self.assertEqual(FlightFare.objects.filter(ticket_class__name = 'Economy', seat_size = 50, price = 100).count(), 3)
+        self.assertEqual(TransitionAirport.objects.filter(airport__name = 'Transit', transition_time = 30).count(), 3)
+        self.assertEqual(RevenueRollup.objects.get(ticket_class = None).total_flights, 3)
+
+    def test_invalid_rows(self):
+        errors = {}
+        row = dict(self.row, arrival_airport = 'Departure', flight_time = '0', transition_airports = 'Nowhere:10')
+
+        total = ScheduleImportService().import_rows([(1, row)], on_error = errors.__setitem__)
+
+        self.assertEqual(total, 0)
+        self.assertEqual(set(errors[1]), {'departure_airport', 'arrival_airport', 'flight_time', 'transition_airports[0]'})
+        self.assertFalse(Flight.objects.exists())
+
+class BulkDAOTest(FlightFixtureMixin, TestCase):
+    '''Bulk DAO operations must not make a query per row.
+    '''
+
+    def setUp(self) -> None:
+        self.airport_dao = AirportDAO()
+        self.transition_airport_dao = TransitionAirportDAO()
+
+    def test_bulk_create_and_update(self):
+        with self.assertNumQueries(1):
+            airports = self.airport_dao.bulk_create([Airport(name = f'Airport {i}') for i in range(50)])
+
+        for airport in airports:
+            airport.name = airport.name.upper()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.airport_dao.bulk_update(airports, ['name']), 50)
+
+        with self.assertNumQueries(1):
+            found = self.airport_dao.find_many([airport.pk for airport in airports[:10]])
+        self.assertEqual(set(found), {airport.pk for airport in airports[:10]})
+        self.assertEqual(found[airports[0].pk].name, 'AIRPORT 0')
+
+        self.assertEqual(len(list(self.airport_dao.stream_all(chunk_size = 7))), 50)
+
+    def test_delete(self):
+        transition_airport = self.transition_airport_dao.create(TransitionAirport(transition_time = 30))
+
+        with self.assertNumQueries(1):
+            self.transition_airport_dao.delete(transition_airport.pk)
+
+        self.assertFalse(TransitionAirport.objects.exists())
+        with self.assertRaises(TransitionAirport.DoesNotExist):
+            self.transition_airport_dao.delete(transition_airport.pk)
+
+    def test_delete_with_signals(self):
+        self.create_ticket_classes()
+        customer = self.create_customer()
+        flight = self.create_flight(fares = {self.economy_class : (10, 50)})
+        tickets = [Ticket.objects.create(flight = flight, ticket_class = self.economy_class, customer = customer, price = 50) for _ in range(3)]
+
+        # Load, cascade to Reservation, delete, then signals: seat counters and the route of cached searches.
+        with self.assertNumQueries(8):
+            self.assertEqual(TicketDAO().delete(tickets[0].pk), 1)
+        self.assertEqual(FlightDetail.objects.get(flight = flight).tickets, 2)
+
+        # Flight, FlightDetail, FlightFare and the 2 Tickets, whatever the number of Tickets.
+        with self.assertNumQueries(13):
+            self.assertEqual(FlightDAO().delete(flight.pk), 5)
+        self.assertFalse(Ticket.objects.exists())
@@ -0,0 +1,128 @@
+from collections import Counter, defaultdict
+import heapq
+import re
+import unicodedata
+
+class AirportIndex:
+    '''Prefix and trigram index of Airport names, for typeahead.
+
+    Every prefix (up to max_prefix characters) of the whole name and of
+    each of its words maps to the matching airports, so a prefix lookup
+    is one dict access. Queries without enough prefix matches fall back
+    to trigram similarity, which tolerates typos and infixes.
+    '''
+
+    '''Longest prefix stored, longer queries are checked against the names.
+    '''
+    max_prefix = 12
+
+    '''Minimum share of the query trigrams a fuzzy match must have.
+    '''
+    min_similarity = 0.3
+
+    def __init__(self, airports = ()) -> None:
+        self.names = {}
+        self.keys = {}
+        self.prefixes = defaultdict(set)
+        self.trigrams = defaultdict(set)
+
+        for airport_id, name in airports:
+            self.add(airport_id, name)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @staticmethod
+    def normalize(text : str) -> str:
+        '''Lowercase, without accents and punctuation.
+        '''
+        text = unicodedata.normalize('NFKD', text or '')
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+        return ' '.join(re.split(r'\W+', text.casefold())).strip()
+
+    @staticmethod
+    def trigrams_of(key : str) -> set:
+        padded = f'  {key} '
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def prefixes_of(self, key : str) -> set:
+        prefixes = set()
+        for term in {key, *key.split()}:
+            prefixes.update(term[:length] for length in range(1, min(len(term), self.max_prefix) + 1))
+        return prefixes
+
+    def add(self, airport_id : int, name : str) -> None:
+        '''Add or rename an airport.
+        '''
+        self.remove(airport_id)
+
+        key = self.normalize(name)
+        self.names[airport_id] = name
+        self.keys[airport_id] = key
+
+        for prefix in self.prefixes_of(key):
+            self.prefixes[prefix].add(airport_id)
+        for trigram in self.trigrams_of(key):
+            self.trigrams[trigram].add(airport_id)
+
+    def remove(self, airport_id : int) -> None:
+        key = self.keys.pop(airport_id, None)
+        if key is None:
+            return
+        del self.names[airport_id]
+
+        for index, entries in ((self.prefixes, self.prefixes_of(key)), (self.trigrams, self.trigrams_of(key))):
+            for entry in entries:
+                index[entry].discard(airport_id)
+                if not index[entry]:
+                    del index[entry]
+
+    def search(self, query : str, limit : int = 10) -> list:
+        '''Get [(id, name)] of the best matches: names starting with the query,
+        then names with a word starting with each word of the query, then similar names.
+        '''
+        query = self.normalize(query)
+        if not query or limit <= 0:
+            return []
+
+        matches = set.intersection(*(
+            self.prefixes.get(word[:self.max_prefix], set()) for word in query.split()
+        ))
+        matches |= self.prefixes.get(query[:self.max_prefix], set())
+
+        if any(len(word) > self.max_prefix for word in query.split()) or len(query) > self.max_prefix:
+            matches = {airport_id for airport_id in matches if self.is_match(self.keys[airport_id], query)}
+
+        ranked = heapq.nsmallest(limit, matches, key = lambda airport_id: (
+            not self.keys[airport_id].startswith(query),
+            self.keys[airport_id],
+        ))
+
+        if len(ranked) < limit:
+            ranked += self.similar(query, limit - len(ranked), exclude = matches)
+
+        return [(airport_id, self.names[airport_id]) for airport_id in ranked]
+
+    def is_match(self, key : str, query : str) -> bool:
+        if key.startswith(query):
+            return True
+        words = key.split()
+        return all(any(word.startswith(term) for word in words) for term in query.split())
+
+    def similar(self, query : str, limit : int, exclude : set = frozenset()) -> list:
+        '''Airports sharing the most trigrams with the query.
+        '''
+        query_trigrams = self.trigrams_of(query)
+
+        # Counter.update counts in C, much faster than a Python loop here.
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self.trigrams.get(trigram, ()))
+
+        minimum = self.min_similarity * len(query_trigrams)
+        candidates = [
+            airport_id for airport_id, count in shared.items()
+            if count >= minimum and airport_id not in exclude
+        ]
+
+        return heapq.nsmallest(limit, candidates, key = lambda airport_id: (-shared[airport_id], self.keys[airport_id]))
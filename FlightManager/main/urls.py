@@ -20,6 +20,7 @@ urlpatterns = [
     path('airport/create/', views.CreateAirportView.as_view(), name = 'airport.create'),
     path('airport/update/<str:pk>/', views.UpdateAirportView.as_view(), name = 'airport.update'),
     path('airport/delete/<str:pk>/', views.DeleteAirportView.as_view(), name = 'airport.delete'),
+    path('airport/typeahead', views.AirportTypeaheadView.as_view(), name = 'airport.typeahead'),
 
     # Flight
     path('flight/', views.ListFlightView.as_view(), name = 'flight.list'),
@@ -33,6 +34,8 @@ urlpatterns = [
 
     # Flight search (Filter)
     path('flight/search', views.FlightSearchView.as_view(), name = 'flight.search'),
+    path('flight/search/metrics', views.SearchCacheMetricsView.as_view(), name = 'flight.search.metrics'),
+    path('flight/itinerary', views.ItinerarySearchView.as_view(), name = 'flight.itinerary'),
 
     # Transition Airport
     path("flight/detail/<str:pk>/transition/create", views.CreateTransitionAirportView.as_view(), name = 'flight.transition.create'),
@@ -49,5 +52,7 @@ urlpatterns = [
 
     # Report
     path('report/general', views.ListFlightReportGeneralView.as_view(), name = 'report.general'),
+    path('report/general/export', views.ExportFlightReportGeneralView.as_view(), name = 'report.general.export'),
     path('report/yearly', views.ListFlightReportYearlyView.as_view(), name = 'report.yearly'),
+    path('report/chart/<str:token>', views.ReportChartView.as_view(), name = 'report.chart'),
 ]
\ No newline at end of file
@@ -1,46 +1,482 @@
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import Http404
+from django.urls import reverse
+from django.utils.timezone import localtime
 from django.views import View
+from collections import OrderedDict
+from datetime import datetime
 from io import BytesIO
+from xml.sax.saxutils import escape
 
-import matplotlib.pyplot as plt
 import base64
+import binascii
+import csv
+import hashlib
+import json
+import math
+import threading
+
+from .routers import ReplicaRouter
+from .service import RoleService
 
 class GraphPlotting:
     '''Supports graph plotting
+
+    Backend is settings.CHART_BACKEND: 'svg' (pure Python, the default)
+    or 'matplotlib' (PNG, matplotlib is only imported when used).
+    '''
+
+    '''Image format produced by each backend.
     '''
+    formats = {
+        'svg' : 'svg',
+        'matplotlib' : 'png',
+    }
 
-    def __init__(self, x, y, title):
+    '''Bar color, same as matplotlib's default.
+    '''
+    bar_color = '#1f77b4'
+
+    def __init__(self, x, y, title, backend : str = None):
         self.x = x
         self.y = y
         self.title = title
+        self.backend = backend or getattr(settings, 'CHART_BACKEND', 'svg')
 
-    def get_graph(self):
-        buffer = BytesIO()
-        plt.savefig(buffer, format = 'png')
-        
-        buffer.seek(0)
-        image_png = buffer.getvalue()
-        
-        self.graph = base64.b64encode(image_png)
-        self.graph = self.graph.decode('utf-8')
+    @property
+    def format(self) -> str:
+        return self.formats[self.backend]
 
-        buffer.close()
-    
-    def get_bar_plot(self, x_label : str, y_label : str):
-        plt.switch_backend('AGG')
+    def render_bar_plot(self, x_label : str, y_label : str) -> bytes:
+        '''Render a bar plot and return the image bytes (in self.format).
+        '''
+        if self.backend == 'svg':
+            return self.render_svg_bar_plot(x_label, y_label).encode('utf-8')
 
-        plt.figure(figsize = (10, 5))
-        plt.title(self.title)
+        return self.render_matplotlib_bar_plot(x_label, y_label)
+
+    def render_matplotlib_bar_plot(self, x_label : str, y_label : str) -> bytes:
+        '''Uses a standalone Figure instead of pyplot, so no figure
+        is left registered in pyplot's global state after rendering.
+        '''
+        from matplotlib.figure import Figure
+
+        figure = Figure(figsize = (10, 5))
+        axes = figure.subplots()
+        axes.set_title(self.title)
         
         x_int = [i for i in range(len(self.x))]
 
-        plt.bar(x_int, self.y)
-        plt.xticks(x_int, self.x)
-        plt.xlabel(x_label)
-        plt.ylabel(y_label)
+        axes.bar(x_int, self.y)
+        axes.set_xticks(x_int)
+        axes.set_xticklabels(self.x)
+        axes.set_xlabel(x_label)
+        axes.set_ylabel(y_label)
+
+        buffer = BytesIO()
+        try:
+            figure.savefig(buffer, format = 'png')
+            return buffer.getvalue()
+        finally:
+            buffer.close()
+            figure.clear()
+
+    def tick_step(self, span : float) -> float:
+        '''Round step (1, 2 or 5 times a power of ten) giving about 5 ticks.
+        '''
+        if span <= 0:
+            return 1
+
+        raw_step = span / 5
+        magnitude = 10 ** math.floor(math.log10(raw_step))
+        for multiplier in (1, 2, 5, 10):
+            if raw_step <= multiplier * magnitude:
+                return multiplier * magnitude
+
+    def render_svg_bar_plot(self, x_label : str, y_label : str) -> str:
+        '''Render a bar plot as an SVG document, without matplotlib.
+        '''
+        width, height = 1000, 500
+        left, right, top, bottom = 80, 20, 50, 60
+        plot_width = width - left - right
+        plot_height = height - top - bottom
+
+        values = [float(value or 0) for value in self.y]
+        step = self.tick_step(max([0.0] + values) - min([0.0] + values))
+        low = math.floor(min([0.0] + values) / step) * step
+        high = math.ceil(max([0.0] + values) / step) * step
+        if high == low:
+            high = low + step
+
+        def y_of(value : float) -> float:
+            return top + plot_height * (high - value) / (high - low)
+
+        parts = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+            f'viewBox="0 0 {width} {height}" font-family="sans-serif" font-size="12">',
+            f'<rect width="{width}" height="{height}" fill="white"/>',
+            f'<text x="{left + plot_width / 2}" y="{top / 2 + 6}" text-anchor="middle" font-size="16">{escape(str(self.title))}</text>',
+        ]
 
-        self.get_graph()
+        # Y axis ticks and grid lines
+        for i in range(round((high - low) / step) + 1):
+            value = round(low + i * step, 10)
+            y = y_of(value)
+            parts.append(f'<line x1="{left}" y1="{y:.1f}" x2="{left + plot_width}" y2="{y:.1f}" stroke="#e0e0e0"/>')
+            parts.append(f'<text x="{left - 8}" y="{y + 4:.1f}" text-anchor="end">{value:g}</text>')
+
+        # Bars and their labels
+        band = plot_width / max(len(values), 1)
+        for i, (label, value) in enumerate(zip(self.x, values)):
+            x = left + band * i
+            bar_top = y_of(max(value, 0))
+            bar_height = abs(y_of(value) - y_of(0))
+            parts.append(
+                f'<rect x="{x + band * 0.1:.1f}" y="{bar_top:.1f}" width="{band * 0.8:.1f}" '
+                f'height="{bar_height:.1f}" fill="{self.bar_color}"><title>{escape(str(label))}: {value:g}</title></rect>'
+            )
+            parts.append(f'<text x="{x + band / 2:.1f}" y="{top + plot_height + 18}" text-anchor="middle">{escape(str(label))}</text>')
+
+        # Axes and their labels
+        parts += [
+            f'<line x1="{left}" y1="{top}" x2="{left}" y2="{top + plot_height}" stroke="black"/>',
+            f'<line x1="{left}" y1="{y_of(0):.1f}" x2="{left + plot_width}" y2="{y_of(0):.1f}" stroke="black"/>',
+            f'<text x="{left + plot_width / 2}" y="{height - 15}" text-anchor="middle">{escape(x_label)}</text>',
+            f'<text x="20" y="{top + plot_height / 2}" text-anchor="middle" '
+            f'transform="rotate(-90 20 {top + plot_height / 2})">{escape(y_label)}</text>',
+            '</svg>',
+        ]
+
+        return '\n'.join(parts)
+    
+    def get_bar_plot(self, x_label : str, y_label : str):
+        '''Render a bar plot as base64 (in self.format), for inline images.
+        '''
+        self.graph = base64.b64encode(self.render_bar_plot(x_label, y_label)).decode('utf-8')
         return self.graph
 
+class ChartService:
+    '''Render report charts on their own URL and keep them in a LRU cache.
+
+    The chart spec (title, labels, values, ...) is signed into the URL,
+    so any worker can render it and nobody can ask for arbitrary charts.
+    The signature has no timestamp, the same chart always has the same URL.
+    Rendered bytes are keyed by a hash of the spec, which is also the ETag.
+    '''
+
+    '''Rendered charts kept per process.
+    '''
+    max_entries = getattr(settings, 'CHART_CACHE_SIZE', 128)
+
+    content_types = {
+        'png' : 'image/png',
+        'svg' : 'image/svg+xml',
+    }
+
+    salt = 'main.charts'
+
+    _charts = OrderedDict()
+    _lock = threading.Lock()
+
+    def get_bar_chart_url(self, labels, values, title : str, x_label : str, y_label : str) -> str:
+        '''Get the URL of a bar chart, it is rendered when the browser asks for it.
+        '''
+        spec = {
+            'kind' : 'bar',
+            'backend' : getattr(settings, 'CHART_BACKEND', 'svg'),
+            'title' : title,
+            'labels' : list(labels),
+            'values' : list(values),
+            'x_label' : x_label,
+            'y_label' : y_label,
+        }
+        token = signing.Signer(salt = self.salt).sign_object(spec, compress = True)
+
+        return reverse('report.chart', kwargs = {'token' : token})
+
+    def load_spec(self, token : str) -> dict:
+        try:
+            return signing.Signer(salt = self.salt).unsign_object(token)
+        except signing.BadSignature:
+            raise Http404('Invalid chart.')
+
+    def chart_key(self, spec : dict) -> str:
+        return hashlib.sha256(json.dumps(spec, sort_keys = True).encode()).hexdigest()
+
+    def content_type(self, spec : dict) -> str:
+        return self.content_types[GraphPlotting.formats[spec['backend']]]
+
+    def get_chart(self, spec : dict) -> bytes:
+        '''Get chart bytes from the cache, render them on a miss.
+        '''
+        key = self.chart_key(spec)
+
+        with self._lock:
+            if key in self._charts:
+                self._charts.move_to_end(key)
+                return self._charts[key]
+
+        chart = self.render(spec)
+
+        with self._lock:
+            self._charts[key] = chart
+            self._charts.move_to_end(key)
+            while len(self._charts) > self.max_entries:
+                self._charts.popitem(last = False)
+
+        return chart
+
+    def render(self, spec : dict) -> bytes:
+        return GraphPlotting(
+            spec['labels'],
+            spec['values'],
+            spec['title'],
+            spec['backend'],
+        ).render_bar_plot(spec['x_label'], spec['y_label'])
+
+class ReportExportService:
+    '''Stream report rows as CSV or JSON Lines.
+
+    Rows are read with .iterator(), one chunk at a time, and written
+    as soon as they are read, so memory does not grow with the report.
+    '''
+
+    content_types = {
+        'csv' : 'text/csv',
+        'jsonl' : 'application/x-ndjson',
+    }
+
+    '''Rows fetched from the database at a time.
+    '''
+    chunk_size = getattr(settings, 'REPORT_EXPORT_CHUNK_SIZE', 2000)
+
+    class Echo:
+        '''File-like object returning what is written, for csv.writer.
+        '''
+        def write(self, value : str) -> str:
+            return value
+
+    def content_type(self, export_format : str) -> str:
+        return self.content_types[export_format]
+
+    def get_value(self, value):
+        if isinstance(value, datetime):
+            return localtime(value).isoformat()
+        if isinstance(value, float):
+            return round(value, 2)
+        return value
+
+    def get_rows(self, queryset, columns : dict):
+        '''Yield rows as lists of values, columns maps headers to row keys.
+        '''
+        for row in queryset.iterator(chunk_size = self.chunk_size):
+            yield [self.get_value(row[key]) for key in columns.values()]
+
+    def stream(self, queryset, columns : dict, export_format : str):
+        '''Yield the export line by line.
+        '''
+        headers = list(columns)
+
+        if export_format == 'csv':
+            writer = csv.writer(self.Echo())
+            yield writer.writerow(headers)
+            for values in self.get_rows(queryset, columns):
+                yield writer.writerow(values)
+        else:
+            for values in self.get_rows(queryset, columns):
+                yield json.dumps(dict(zip(headers, values)), cls = DjangoJSONEncoder) + '\n'
+
+class SingleObjectCacheMixin:
+    '''Memoize get_object() for the rest of the request.
+
+    test_func, get_form_kwargs, get/post... all call get_object(),
+    this mixin makes sure only the first call hits the database.
+    '''
+
+    def get_object(self, queryset = None):
+        if queryset is not None:
+            return super().get_object(queryset)
+
+        if not hasattr(self, '_cached_object'):
+            self._cached_object = super().get_object()
+
+        return self._cached_object
+
+class FlightObjectMixin:
+    '''Resolve the Flight in the URL (kwarg `pk`) once per request.
+
+    Views using this mixin must set self.flight_service.
+    '''
+
+    def get_flight(self):
+        if not hasattr(self, '_cached_flight'):
+            self._cached_flight = self.flight_service.get_flight(
+                flight_id = self.kwargs.get('pk')
+            )
+
+        return self._cached_flight
+
+class TicketOwnerMixin:
+    '''Authorization helpers for booking views, backed by cached roles.
+    '''
+
+    def get_customer_id(self) -> int:
+        return RoleService().get_customer_id(self.request.user)
+
+    def is_owner_or_manager(self, ticket) -> bool:
+        '''Ticket owner and managers can access a ticket.
+        Users without a Customer profile own no ticket, not even those without a customer.
+        '''
+        customer_id = self.get_customer_id()
+        if customer_id is not None and ticket.customer_id == customer_id:
+            return True
+        return RoleService().is_in_group(self.request.user, 'Manager')
+
+class ReplicaReadMixin:
+    '''Let GET requests of the view read search and report rows from the read replica.
+
+    Only FlightService querysets built during the request go to the replica,
+    see ReplicaRouter. Users who just booked or paid keep reading from the
+    default database, see PrimaryAfterWriteMixin.
+    '''
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+
+        with ReplicaRouter.reads(request):
+            return super().dispatch(request, *args, **kwargs)
+
+class PrimaryAfterWriteMixin:
+    '''Pin the user's reads to the default database after a successful POST
+    of the view, so the next searches show their booking even if the replica
+    lags behind. A POST is successful when it redirects: an invalid form is
+    rendered again and wrote nothing.
+    '''
+
+    def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+
+        if request.method == 'POST' and 300 <= response.status_code < 400:
+            ReplicaRouter.pin_primary(request)
+
+        return response
+
+class CursorPage:
+    '''A page of a keyset (cursor) paginated list.
+
+    Behaves like django.core.paginator.Page in templates (iteration, truth),
+    with opaque tokens instead of page numbers.
+    '''
+    is_cursor = True
+
+    def __init__(self, object_list : list, next_cursor : str, previous_cursor : str) -> None:
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self) -> int:
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    def has_other_pages(self) -> bool:
+        return self.has_next() or self.has_previous()
+
+class CursorPaginationMixin:
+    '''Keyset pagination for ListView/FilterView.
+
+    Pages are fetched with `WHERE (ordering) > (last row) LIMIT n`
+    on cursor_ordering, so page N costs the same as page 1 and no COUNT(*) is run.
+    cursor_ordering must be unique, e.g. ('date_time', 'id').
+    '''
+    cursor_ordering = None
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.cursor_ordering or not getattr(settings, 'CURSOR_PAGINATION', True):
+            return super().paginate_queryset(queryset, page_size)
+
+        token = self.request.GET.get(self.cursor_query_param)
+        direction, values = self.decode_cursor(queryset.model, token) if token else ('next', None)
+        backwards = direction == 'previous'
+
+        ordering = self.cursor_ordering
+        if backwards:
+            ordering = [self.reverse_field(field) for field in ordering]
+
+        queryset = queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self.keyset_filter(ordering, values))
+
+        rows = list(queryset[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+
+        if backwards:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+
+        page = CursorPage(
+            rows,
+            self.encode_cursor('next', rows[-1]) if rows and has_next else None,
+            self.encode_cursor('previous', rows[0]) if rows and has_previous else None,
+        )
+
+        return (None, page, page.object_list, page.has_other_pages())
+
+    def reverse_field(self, field : str) -> str:
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    def keyset_filter(self, ordering : list, values : list) -> Q:
+        '''Rows strictly after `values` in `ordering`.
+        '''
+        condition = Q()
+        equal = {}
+
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}' : value})
+            equal[name] = value
+
+        return condition
+
+    def encode_cursor(self, direction : str, row) -> str:
+        # value_to_string keeps full datetime precision, unlike DjangoJSONEncoder.
+        values = [row._meta.get_field(field.lstrip('-')).value_to_string(row) for field in self.cursor_ordering]
+        payload = json.dumps([direction, values])
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def decode_cursor(self, model, token : str) -> tuple:
+        try:
+            direction, values = json.loads(base64.urlsafe_b64decode(token.encode()))
+            fields = [model._meta.get_field(field.lstrip('-')) for field in self.cursor_ordering]
+            values = [field.to_python(value) for field, value in zip(fields, values)]
+        except (ValueError, TypeError, binascii.Error, ValidationError):
+            raise Http404('Invalid cursor.')
+
+        if direction not in ('next', 'previous') or len(values) != len(fields):
+            raise Http404('Invalid cursor.')
+
+        return direction, values
+
 class PaginatedFilterView(View):
     '''A custom Filter View supports Pagination,
     which just parse the querystring back to context.
@@ -55,6 +491,8 @@ class PaginatedFilterView(View):
             querystring = self.request.GET.copy()
             if self.request.GET.get('page'):
                 del querystring['page']
+            if self.request.GET.get('cursor'):
+                del querystring['cursor']
             
             context['querystring'] = querystring.urlencode()
         
@@ -1,6 +1,6 @@
 # Typical imports inside views.py
 from django.shortcuts import render, redirect
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
 
 # Messages
 from django.contrib import messages
@@ -13,18 +13,19 @@ from django.contrib.auth import authenticate, login, logout
 # Decorators
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.decorators import method_decorator
 from .decorators import unauthenticated_user
 from django.views.decorators.http import require_http_methods
 
 # For class-based view
 from django.views import View
-from django.views.generic import ListView, CreateView, UpdateView, DeleteView, DetailView
+from django.views.generic import ListView, CreateView, UpdateView, DeleteView, DetailView, TemplateView
 
 # For filtered view
 from django_filters.views import FilterView
 from .filters import *
-from .utils import PaginatedFilterView, GraphPlotting
+from .utils import PaginatedFilterView, ChartService, ReportExportService, SingleObjectCacheMixin, FlightObjectMixin, TicketOwnerMixin, CursorPaginationMixin, ReplicaReadMixin, PrimaryAfterWriteMixin
 
 # For models
 from .models import *
@@ -166,18 +167,38 @@ def auth_logout(request):
 class HomepageView(View):
     '''HomepageView, expressed as an OOP class.
     '''
-    def __init__(self) -> None:
-        self.airport_service = AirportService()
-
     def get(self, request) -> HttpResponse:
-        '''Render homepage, with (of course) airports list.
+        '''Render homepage, with (of course) the flight search form.
         '''
         context = {
-            'airports' : self.airport_service.get_airport_list_queryset(),
+            'form' : FlightFilter().form,
         }
 
         return render(request, 'main/dashboard/dashboard.html', context = context)
 
+class AirportTypeaheadView(View):
+    '''AirportTypeaheadView, airports matching a typed name, as JSON.
+    '''
+
+    '''Maximum airports to be returned
+    '''
+    max_limit = 20
+
+    def __init__(self) -> None:
+        self.airport_catalog_service = AirportCatalogService()
+
+    def get(self, request) -> JsonResponse:
+        try:
+            limit = min(int(request.GET.get('limit', 10)), self.max_limit)
+        except ValueError:
+            limit = 10
+
+        airports = self.airport_catalog_service.search(request.GET.get('q', ''), limit)
+
+        return JsonResponse({
+            'results' : [{'id' : airport_id, 'name' : name} for airport_id, name in airports],
+        })
+
 class ProfileView(LoginRequiredMixin, View):
     '''ProfileView, expressed as an OOP class.
     '''
@@ -303,7 +324,7 @@ class UpdatePasswordView(LoginRequiredMixin, View):
 
 # Airports
 
-class ListAirportView(LoginRequiredMixin, PermissionRequiredMixin, ListView):
+class ListAirportView(LoginRequiredMixin, PermissionRequiredMixin, CursorPaginationMixin, ListView):
     '''ListAirport view, expressed as an OOP class.
     '''
 
@@ -319,6 +340,10 @@ class ListAirportView(LoginRequiredMixin, PermissionRequiredMixin, ListView):
     '''
     paginate_by = 10
 
+    '''Keyset used for cursor pagination.
+    '''
+    cursor_ordering = ('-id',)
+
     '''HTML template used in ListAirportView
     '''
     template_name = 'main/airport/list.html'
@@ -430,7 +455,7 @@ class DeleteAirportView(LoginRequiredMixin, SuccessMessageMixin, DeleteView):
 
 # Flights
 
-class ListFlightView(ListView):
+class ListFlightView(ReplicaReadMixin, CursorPaginationMixin, ListView):
     '''ListFlightView, expressed as an OOP class.
     '''
 
@@ -446,6 +471,10 @@ class ListFlightView(ListView):
     '''
     paginate_by = 10
 
+    '''Keyset used for cursor pagination.
+    '''
+    cursor_ordering = ('date_time', 'id')
+
     def __init__(self) -> None:
         self.flight_service = FlightService()
 
@@ -467,11 +496,20 @@ class DetailFlightView(DetailView):
     '''
     template_name = 'main/flight/detail/view.html'
 
+    def __init__(self) -> None:
+        self.flight_service = FlightService()
+
+    def get_queryset(self):
+        '''Load detail and airports with the flight.
+        '''
+        return self.flight_service.get_flight_queryset()
+
     def get_context_data(self, **kwargs):
         '''Preventing n + 1 query on transition_airport
         '''
         context = super().get_context_data(**kwargs)
-        context['transition_airport_list'] = self.get_object().transitionairport_set.all().select_related('airport')
+        context['transition_airport_list'] = self.object.transitionairport_set.all().select_related('airport')
+        context['fare_list'] = self.object.fares.all()
         return context
 
 class CreateFlightView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessageMixin, CreateView):
@@ -623,7 +661,7 @@ class UpdateFlightDetailView(LoginRequiredMixin, PermissionRequiredMixin, Succes
 
 # Transition Airport
 
-class CreateTransitionAirportView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessageMixin, CreateView):
+class CreateTransitionAirportView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessageMixin, FlightObjectMixin, CreateView):
     '''CreateTransitionAirportView, expressed as an OOP class.
     '''
 
@@ -660,9 +698,7 @@ class CreateTransitionAirportView(LoginRequiredMixin, PermissionRequiredMixin, S
         '''
         kwargs = super().get_form_kwargs()
         
-        flight = self.flight_service.get_flight(
-            flight_id = self.kwargs.get('pk')
-        )
+        flight = self.get_flight()
 
         kwargs['route_airports'] = [flight.departure_airport, flight.arrival_airport]
         for transition_airport in flight.transitionairport_set.all().prefetch_related('airport'):
@@ -676,18 +712,14 @@ class CreateTransitionAirportView(LoginRequiredMixin, PermissionRequiredMixin, S
         '''
         context = super().get_context_data(**kwargs)
 
-        context['flight'] = self.flight_service.get_flight(
-            flight_id = self.kwargs.get('pk')
-        )
+        context['flight'] = self.get_flight()
 
         return context
 
     def form_valid(self, form) -> HttpResponse:
         '''Automatically set Flight to the Flight requested (aka Flight ID in the URL).
         '''
-        form.instance.flight = self.flight_service.get_flight(
-            flight_id = self.kwargs.get('pk')
-        )
+        form.instance.flight = self.get_flight()
 
         return super().form_valid(form)
     
@@ -696,7 +728,7 @@ class CreateTransitionAirportView(LoginRequiredMixin, PermissionRequiredMixin, S
             'pk' : self.kwargs.get('pk')
         })
 
-class UpdateTransitionAirportView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessageMixin, UpdateView):
+class UpdateTransitionAirportView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessageMixin, SingleObjectCacheMixin, UpdateView):
     '''UpdateTransitionAirportView, expressed as an OOP class.
     '''
 
@@ -727,6 +759,14 @@ class UpdateTransitionAirportView(LoginRequiredMixin, PermissionRequiredMixin, S
     def __init__(self) -> None:
         self.login_url = reverse('auth.signin')
 
+    def get_queryset(self):
+        '''Load the flight route with the transition airport.
+        '''
+        return TransitionAirport.objects.select_related(
+            'flight__departure_airport',
+            'flight__arrival_airport',
+        )
+
     def get_form_kwargs(self):
         '''Parsing list of airports for form validation.
         '''
@@ -735,7 +775,7 @@ class UpdateTransitionAirportView(LoginRequiredMixin, PermissionRequiredMixin, S
         flight = self.get_object().flight
 
         kwargs['route_airports'] = [flight.departure_airport, flight.arrival_airport]
-        for transition_airport in flight.transitionairport_set.all():
+        for transition_airport in flight.transitionairport_set.all().select_related('airport'):
             kwargs['route_airports'].append(transition_airport.airport)
 
         return kwargs
@@ -774,11 +814,11 @@ class DeleteTransitionAirportView(LoginRequiredMixin, PermissionRequiredMixin, S
     
     def get_success_url(self) -> str:
         return reverse(self.success_url, kwargs = {
-            'pk' : self.object.flight.id
+            'pk' : self.object.flight_id
         })
 
 # Search (Filter)
-class FlightSearchView(PaginatedFilterView, FilterView):
+class FlightSearchView(ReplicaReadMixin, PaginatedFilterView, CursorPaginationMixin, FilterView):
     '''FlightSearchView, expressed as an OOP class.
     '''
 
@@ -798,8 +838,14 @@ class FlightSearchView(PaginatedFilterView, FilterView):
     '''
     paginate_by = 10
 
+    '''Keyset used for cursor pagination.
+    '''
+    cursor_ordering = ('date_time', 'id')
+
     def __init__(self):
         self.flight_service = FlightService()
+        self.search_cache_service = SearchCacheService()
+        self.inventory = None
 
     def get_queryset(self):
         '''Prevent n + 1 and not including took-off flights in search result.
@@ -808,9 +854,108 @@ class FlightSearchView(PaginatedFilterView, FilterView):
         queryset = self.flight_service.get_search_queryset(queryset)
         return queryset
 
+    def get(self, request, *args, **kwargs):
+        '''Same as FilterView.get, with results read through SearchCacheService.
+        '''
+        self.filterset = self.get_filterset(self.get_filterset_class())
+
+        if not self.filterset.is_bound or self.filterset.is_valid():
+            self.object_list = self.get_cached_queryset()
+        else:
+            self.object_list = self.filterset.queryset.none()
+
+        context = self.get_context_data(filter = self.filterset, object_list = self.object_list)
+        return self.render_to_response(context)
+
+    def get_cached_queryset(self):
+        '''Only the flights of the cached result are loaded, by primary key.
+        '''
+        cleaned_data = self.filterset.form.cleaned_data if self.filterset.is_bound else {}
+        params = self.search_cache_service.normalize(cleaned_data)
+
+        rows = self.search_cache_service.get_rows(params, self.filterset.qs)
+        if rows is None:
+            return self.filterset.qs
+
+        # Cached flights may have taken off since.
+        current_time = now()
+        self.inventory = {row[0] : row[2:] for row in rows if row[1] > current_time}
+
+        return self.flight_service.get_cached_search_queryset(list(self.inventory))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+
+        # Same attributes as FlightQuerySet.with_inventory, from the cache.
+        if self.inventory is not None:
+            for flight in context['object_list']:
+                for field, value in zip(SearchCacheService.inventory_fields, self.inventory[flight.id]):
+                    setattr(flight, field, value)
+
+        return context
+
+class ItinerarySearchView(View):
+    '''ItinerarySearchView, finds direct and connecting flights.
+    '''
+
+    '''HTML template used in ItinerarySearchView
+    '''
+    template_name = 'main/flight/itinerary.html'
+
+    '''Maximum itineraries to be displayed
+    '''
+    limit = 10
+
+    def __init__(self) -> None:
+        self.itinerary_service = ItineraryService()
+        self.airport_service = AirportService()
+
+    def get(self, request) -> HttpResponse:
+        form = ItinerarySearchForm(request.GET or None)
+        itineraries = None
+
+        if form.is_valid():
+            itineraries = self.itinerary_service.search(
+                form.cleaned_data['departure_airport'].id,
+                form.cleaned_data['arrival_airport'].id,
+                form.cleaned_data['date'],
+                max_legs = form.cleaned_data['max_stops'] + 1,
+                sort = form.cleaned_data['sort'],
+                limit = self.limit,
+            )
+
+            # Airports of every leg, in one query.
+            airport_ids = {
+                airport_id
+                for itinerary in itineraries for leg in itinerary.legs
+                for airport_id in (leg.departure_airport_id, leg.arrival_airport_id)
+            }
+            airports = self.airport_service.get_airport_list_queryset().in_bulk(airport_ids)
+
+            # Legs belong to the shared graph, describe them without touching them.
+            itineraries = [
+                {
+                    'itinerary' : itinerary,
+                    'legs' : [
+                        {
+                            'leg' : leg,
+                            'departure_airport' : airports.get(leg.departure_airport_id),
+                            'arrival_airport' : airports.get(leg.arrival_airport_id),
+                        } for leg in itinerary.legs
+                    ],
+                } for itinerary in itineraries
+            ]
+
+        context = {
+            'form' : form,
+            'itineraries' : itineraries,
+        }
+
+        return render(request, self.template_name, context)
+
 # Booking
 
-class ListFlightTicketView(LoginRequiredMixin, ListView):
+class ListFlightTicketView(LoginRequiredMixin, TicketOwnerMixin, CursorPaginationMixin, ListView):
     '''ListFlightTicketView, expressed as an OOP class.
     '''
 
@@ -826,19 +971,28 @@ class ListFlightTicketView(LoginRequiredMixin, ListView):
     '''
     paginate_by = 10
 
+    '''Keyset used for cursor pagination.
+    '''
+    cursor_ordering = ('-date_created', 'id')
+
     def __init__(self) -> None:
         self.login_url = reverse('auth.signin')
         self.ticket_service = TicketService()
 
     def get_queryset(self):
-        '''Users should only see reservations made by them.
+        '''Users should only see reservations made by them,
+        users without a Customer profile have none.
         '''
+        customer_id = self.get_customer_id()
         queryset = self.ticket_service.get_ticket_list_queryset(
-            customer = self.request.user.customer
+            customer = customer_id
         )
+
+        if customer_id is None:
+            return queryset.none()
         return queryset
 
-class DetailFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
+class DetailFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, TicketOwnerMixin, SingleObjectCacheMixin, DetailView):
     '''DetailFlightTicketView, expressed as an OOP class.
     '''
 
@@ -850,22 +1004,19 @@ class DetailFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, DetailView
     '''
     template_name = 'main/flight/booking/detail.html'
 
+    def get_queryset(self):
+        return self.ticket_service.get_ticket_queryset()
+
     def test_func(self) -> bool:
         '''User can only view his own tickets, except managers.
         '''
-        current_customer = self.request.user.customer
-        ticket_customer = self.get_object().customer
-
-        if current_customer == ticket_customer:
-            return True
-        if current_customer.is_in_group('Manager'):
-            return True
-        return False
+        return self.is_owner_or_manager(self.get_object())
 
     def __init__(self) -> None:
         self.login_url = reverse('auth.signin')
+        self.ticket_service = TicketService()
 
-class CreateFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMessageMixin, CreateView):
+class CreateFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, PrimaryAfterWriteMixin, SuccessMessageMixin, TicketOwnerMixin, FlightObjectMixin, CreateView):
     '''CreateFlightTicketView, expressed as an OOP class.
     '''
 
@@ -892,6 +1043,8 @@ class CreateFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMes
     def __init__(self) -> None:
         self.login_url = reverse('auth.signin')
         self.flight_service = FlightService()
+        self.fare_service = FareService()
+        self.reservation_service = ReservationService()
     
     def get_success_url(self) -> str:
         return reverse(self.success_url, kwargs = {
@@ -903,9 +1056,7 @@ class CreateFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMes
         '''
         context = super().get_context_data(**kwargs)
 
-        context["flight"] = self.flight_service.get_flight(
-            flight_id = self.kwargs.get('pk')
-        )
+        context["flight"] = self.get_flight()
 
         return context
     
@@ -913,34 +1064,39 @@ class CreateFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMes
         '''Parsing this flight for form validation
         '''
         kwargs = super().get_form_kwargs()
-        kwargs['flight'] = self.flight_service.get_flight(
-            flight_id = self.kwargs.get('pk')
-        )
+        kwargs['flight'] = self.get_flight()
         return kwargs
 
     def test_func(self) -> bool:
-        flight = self.flight_service.get_flight(
-            flight_id = self.kwargs.get('pk')
-        )
-        return flight.is_bookable
+        '''Only users with a Customer profile can book, a bookable flight.
+        '''
+        return self.get_customer_id() is not None and self.get_flight().is_bookable
 
     def form_valid(self, form) -> HttpResponse:
         '''Automatically add flight, customer and ticket price to form.
         '''
-        form.instance.flight = self.flight_service.get_flight(
-            flight_id = self.kwargs.get('pk')
-        )
-        form.instance.customer = self.request.user.customer
+        form.instance.flight = self.get_flight()
+        form.instance.customer_id = self.get_customer_id()
 
-        # Hardcore ticket adding.
-        if form.instance.ticket_class.name == 'First':
-            form.instance.price = form.instance.flight.flightdetail.first_class_ticket_price
-        elif form.instance.ticket_class.name == 'Economy':
-            form.instance.price = form.instance.flight.flightdetail.second_class_ticket_price
+        form.instance.price = self.fare_service.get_price(form.instance.flight_id, form.instance.ticket_class_id)
 
-        return super().form_valid(form)
+        # Seats may be taken since the form was validated, book atomically.
+        result = self.reservation_service.reserve(form.instance.flight.id, form.instance)
 
-class UpdateFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMessageMixin, UpdateView):
+        if result.is_sold_out:
+            form.add_error('ticket_class', 'This class is out of seats, please choose another class.')
+            return self.form_invalid(form)
+
+        if result.is_limit_reached:
+            form.add_error(None, 'You already hold the most tickets allowed on this flight.')
+            return self.form_invalid(form)
+
+        self.object = result.ticket
+        messages.success(self.request, self.get_success_message(form.cleaned_data))
+
+        return redirect(self.get_success_url())
+
+class UpdateFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, PrimaryAfterWriteMixin, SuccessMessageMixin, TicketOwnerMixin, SingleObjectCacheMixin, UpdateView):
     '''UpdateFlightTicketView, expressed as an OOP class.
     '''
 
@@ -967,14 +1123,16 @@ class UpdateFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMes
     def __init__(self) -> None:
         self.login_url = reverse('auth.signin')
         self.ticket_service = TicketService()
+        self.fare_service = FareService()
+
+    def get_queryset(self):
+        return self.ticket_service.get_ticket_queryset()
     
     def get_form_kwargs(self):
         '''Parsing this flight for form validation
         '''
         kwargs = super().get_form_kwargs()
-        kwargs['flight'] = self.ticket_service.get_ticket(
-            ticket_id = self.kwargs.get('pk')
-        ).flight
+        kwargs['flight'] = self.get_object().flight
         return kwargs
 
     def get_success_url(self) -> str:
@@ -988,28 +1146,16 @@ class UpdateFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMes
         if not self.get_object().flight.is_bookable:
             return False
 
-        current_customer = self.request.user.customer
-        ticket_customer = self.get_object().customer
-
-        if current_customer == ticket_customer:
-            return True
-        if current_customer.is_in_group('Manager'):
-            return True
-
-        return False
+        return self.is_owner_or_manager(self.get_object())
 
     def form_valid(self, form) -> HttpResponse:
         '''Automatically add flight, customer and ticket price to form.
         '''
-        # Hardcore ticket adding.
-        if form.instance.ticket_class.name == 'First':
-            form.instance.price = form.instance.flight.flightdetail.first_class_ticket_price
-        elif form.instance.ticket_class.name == 'Economy':
-            form.instance.price = form.instance.flight.flightdetail.second_class_ticket_price
+        form.instance.price = self.fare_service.get_price(form.instance.flight_id, form.instance.ticket_class_id)
 
         return super().form_valid(form)
 
-class DeleteFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMessageMixin, DeleteView):
+class DeleteFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, PrimaryAfterWriteMixin, SuccessMessageMixin, TicketOwnerMixin, SingleObjectCacheMixin, DeleteView):
     '''DeleteFlightTicketView, expressed as an OOP class.
     '''
 
@@ -1031,6 +1177,10 @@ class DeleteFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMes
 
     def __init__(self) -> None:
         self.login_url = reverse('auth.signin')
+        self.ticket_service = TicketService()
+
+    def get_queryset(self):
+        return self.ticket_service.get_ticket_queryset()
 
     def get_success_url(self) -> str:
         return reverse(self.success_url)
@@ -1041,18 +1191,10 @@ class DeleteFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMes
         if not self.get_object().flight.is_bookable:
             return False
 
-        current_customer = self.request.user.customer
-        ticket_customer = self.get_object().customer
-
-        if current_customer == ticket_customer:
-            return True
-        if current_customer.is_in_group('Manager'):
-            return True
-
-        return False
+        return self.is_owner_or_manager(self.get_object())
 
 # Payment
-class PayFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMessageMixin, UpdateView):
+class PayFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, PrimaryAfterWriteMixin, SuccessMessageMixin, TicketOwnerMixin, SingleObjectCacheMixin, UpdateView):
     '''PayFlightTicketView, expressed as an OOP class.
     '''
 
@@ -1078,6 +1220,10 @@ class PayFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMessag
 
     def __init__(self) -> None:
         self.login_url = reverse('auth.signin')
+        self.ticket_service = TicketService()
+
+    def get_queryset(self):
+        return self.ticket_service.get_ticket_queryset()
 
     def get_success_url(self) -> str:
         return reverse(self.success_url, kwargs = {
@@ -1092,15 +1238,7 @@ class PayFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMessag
         if not self.get_object().can_update:
             return False
         
-        current_customer = self.request.user.customer
-        ticket_customer = self.get_object().customer
-
-        if current_customer == ticket_customer:
-            return True
-        if current_customer.is_in_group('Manager'):
-            return True
-        
-        return False
+        return self.is_owner_or_manager(self.get_object())
 
     def form_valid(self, form) -> HttpResponse:
         '''Only update one field - is_booked.
@@ -1109,7 +1247,7 @@ class PayFlightTicketView(LoginRequiredMixin, UserPassesTestMixin, SuccessMessag
         return super().form_valid(form)
 
 # Report
-class ListFlightReportGeneralView(LoginRequiredMixin, PermissionRequiredMixin, PaginatedFilterView, FilterView):
+class ListFlightReportGeneralView(LoginRequiredMixin, PermissionRequiredMixin, ReplicaReadMixin, PaginatedFilterView, FilterView):
     '''ListFlightReportGeneralView, expressed as an OOP class.
     '''
 
@@ -1144,25 +1282,63 @@ class ListFlightReportGeneralView(LoginRequiredMixin, PermissionRequiredMixin, P
 
         return queryset
 
-class ListFlightReportYearlyView(LoginRequiredMixin, PermissionRequiredMixin, FilterView):
-    '''ListFlightReportYearlyView, expressed as an OOP class.
+class ExportFlightReportGeneralView(LoginRequiredMixin, PermissionRequiredMixin, ReplicaReadMixin, View):
+    '''ExportFlightReportGeneralView, the whole general report as a CSV or JSON Lines download.
+
+    Takes the same criteria as ListFlightReportGeneralView,
+    plus ?format=csv (the default) or ?format=jsonl.
     '''
 
-    '''Model used in ListFlightReportYearlyView
+    '''Permission required to access this page.
     '''
-    model = Flight
+    permission_required = 'main.create_flight'
 
-    '''Idk why, but this allows get_queryset passing data to get_context_data.
+    '''Export columns, header to row key.
     '''
-    strict = False
+    columns = {
+        'flight' : 'id',
+        'date_time' : 'date_time',
+        'departure_airport' : 'departure_airport__name',
+        'arrival_airport' : 'arrival_airport__name',
+        'total_seats' : 'seats_count',
+        'total_tickets_sold' : 'tickets_sold_count',
+        'revenue' : 'revenue',
+        'ticket_sold_percentage' : 'sold_percentage',
+    }
 
-    '''HTML template used in ListFlightReportYearlyView
+    def __init__(self) -> None:
+        self.login_url = reverse('auth.signin')
+        self.flight_service = FlightService()
+        self.report_export_service = ReportExportService()
+
+    def get(self, request):
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in self.report_export_service.content_types:
+            return JsonResponse({'errors' : {'format' : ['Use csv or jsonl.']}}, status = 400)
+
+        report_filter = FlightReportGeneralFilter(request.GET, queryset = Flight.objects.all())
+        if not report_filter.is_valid():
+            return JsonResponse({'errors' : report_filter.errors}, status = 400)
+
+        queryset = self.flight_service.get_general_report_export_queryset(report_filter.qs)
+
+        response = StreamingHttpResponse(
+            self.report_export_service.stream(queryset, self.columns, export_format),
+            content_type = self.report_export_service.content_type(export_format),
+        )
+        response['Content-Disposition'] = f'attachment; filename="general-report.{export_format}"'
+        return response
+
+class ListFlightReportYearlyView(LoginRequiredMixin, PermissionRequiredMixin, ReplicaReadMixin, TemplateView):
+    '''ListFlightReportYearlyView, expressed as an OOP class.
+
+    Monthly rows come from RevenueRollup, so the page never scans
+    the tickets of the whole year.
     '''
-    template_name = 'main/flight/report/yearly.html'
 
-    '''Filterset used in ListFlightReportYearlyView
+    '''HTML template used in ListFlightReportYearlyView
     '''
-    filterset_class = FlightReportYearlyFilter
+    template_name = 'main/flight/report/yearly.html'
 
     '''Permission required to access this page.
     '''
@@ -1171,6 +1347,7 @@ class ListFlightReportYearlyView(LoginRequiredMixin, PermissionRequiredMixin, Fi
     def __init__(self) -> None:
         self.login_url = reverse('auth.signin')
         self.flight_service = FlightService()
+        self.chart_service = ChartService()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1182,56 +1359,78 @@ class ListFlightReportYearlyView(LoginRequiredMixin, PermissionRequiredMixin, Fi
 
         context['date_time'] = year
 
-        '''We've already get queryset inside self.object_list,
-        Now we just adding some summarise.
-        '''
-
-        # Count total flights
-        context['total_flights'] = self.flight_service.total_flights(year)
+        summary = self.flight_service.yearly_summary(year)
+        context.update(summary)
 
-        # Calculate total tickets sold
-        context['total_tickets_sold'] = self.flight_service.total_tickets_sold(year)
-
-        # Calculate total revenue
-        context['total_revenue'] = self.flight_service.total_revenue(year)
-        
-        # Total ratio = 0 if no revenue made, 100 otherwise.
-        context['total_ratio'] = (context['total_revenue'] > 0) * 100
-
-        # Adding ratio (revenue / total_revenue)
-        for month in self.object_list:
-            if context['total_revenue'] == 0:
-                month['ratio'] = 0
-            else:
-                month['ratio'] = month['revenue'] * 100 / context['total_revenue']
-
-        # Get formatted month label from list of months extracted from database's records.
-        month_list = [record.strftime('%B') for record in self.object_list.values_list('month', flat = True)]
+        # Labels and values of the graphs, from the same monthly rows.
+        month_list = [month['month'].strftime('%B') for month in summary['months']]
 
         # Adding flight graph
-        context['flight_graph'] = GraphPlotting(
+        context['flight_graph'] = self.chart_service.get_bar_chart_url(
             month_list, 
-            self.object_list.values_list('total_flights', flat = True), 
-            'Flight Graph'
-        ).get_bar_plot('Month', 'Flights')
+            [month['total_flights'] for month in summary['months']], 
+            'Flight Graph',
+            'Month',
+            'Flights',
+        )
 
         # Adding revenue graph
-        context['revenue_graph'] = GraphPlotting(
+        context['revenue_graph'] = self.chart_service.get_bar_chart_url(
             month_list, 
-            self.object_list.values_list('revenue', flat = True), 
-            'Revenue Graph'
-        ).get_bar_plot('Month', 'Revenue')
+            [month['revenue'] for month in summary['months']], 
+            'Revenue Graph',
+            'Month',
+            'Revenue',
+        )
 
         return context
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
+class ReportChartView(LoginRequiredMixin, PermissionRequiredMixin, View):
+    '''ReportChartView, serves charts of the report pages.
 
-        try:
-            year = datetime.strptime(self.request.GET.get('date_time'), "%Y").year
-        except Exception:
-            year = datetime.now().year
+    Charts never change for a given URL, so browsers may keep them
+    and revalidate with the ETag.
+    '''
 
-        queryset = self.flight_service.get_yearly_report_queryset(queryset, year)
+    '''Permission required to access this page.
+    '''
+    permission_required = 'main.create_flight'
+
+    '''Seconds browsers may reuse a chart without asking again.
+    '''
+    cache_max_age = 60 * 60 * 24
+
+    def __init__(self) -> None:
+        self.login_url = reverse('auth.signin')
+        self.chart_service = ChartService()
+
+    def get(self, request, token):
+        spec = self.chart_service.load_spec(token)
+        etag = f'"{self.chart_service.chart_key(spec)}"'
+
+        response = get_conditional_response(request, etag = etag)
+        if response is None:
+            response = HttpResponse(
+                self.chart_service.get_chart(spec),
+                content_type = self.chart_service.content_type(spec),
+            )
+
+        response['ETag'] = etag
+        patch_cache_control(response, private = True, max_age = self.cache_max_age)
+
+        return response
 
-        return queryset
\ No newline at end of file
+class SearchCacheMetricsView(LoginRequiredMixin, PermissionRequiredMixin, View):
+    '''SearchCacheMetricsView, hit rate and latency of the flight search cache, as JSON.
+    '''
+
+    '''Permission required to access this page.
+    '''
+    permission_required = 'main.create_flight'
+
+    def __init__(self) -> None:
+        self.login_url = reverse('auth.signin')
+        self.search_cache_service = SearchCacheService()
+
+    def get(self, request):
+        return JsonResponse(self.search_cache_service.get_metrics())
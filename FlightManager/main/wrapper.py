@@ -1,45 +1,54 @@
 from .models import Flight
+from .service import FlightService
 
 class FlightStatisticWrapper:
+    '''Seat and turnover statistics of a Flight.
+
+    Build wrappers of many flights with FlightStatisticWrapper.wrap_many(),
+    their statistics then come from one query (see FlightService.get_flight_statistics).
+    '''
     __flight: Flight
-    __numberOfEmptySeat: int
-    __numberOfSeat: int
-    __turnover: int
+    __statistic: dict
 
-    def __init__(self, flight: Flight):
+    def __init__(self, flight: Flight, statistic: dict = None):
         self.__flight = flight
-        self.update()
 
-    #Update data after retrieving the flight
-    def update(self) -> None:
+        if statistic is None:
+            self.update()
+        else:
+            self.__statistic = statistic
 
-        #Reset the counter
-        self.__numberOfEmptySeat = 0
-        self.__numberOfSeat = 0
-        
+    #Build the wrappers of many flights (a queryset or a list of flights), as a flight id -> wrapper map
+    @classmethod
+    def wrap_many(cls, flights) -> dict:
+        flights = list(flights)
+        statistics = FlightService().get_flight_statistics([flight.pk for flight in flights])
 
-        #Count the number of ticket which isn't booked
-        tickets = self.__flight.ticket_set.all()
-        for ticket in tickets:
-            self.__numberOfSeat += 1
-            if not ticket.is_booked:
-                self.__numberOfEmptySeat  += 1
-            else:
-                self.__turnover += ticket.price
+        return {
+            flight.pk : cls(flight, statistics.get(flight.pk, cls.empty_statistic()))
+            for flight in flights
+        }
+
+    @staticmethod
+    def empty_statistic() -> dict:
+        return {'seats' : 0, 'booked' : 0, 'empty' : 0, 'ratio' : 0, 'turnover' : 0}
+
+    #Update data after retrieving the flight
+    def update(self) -> None:
+        statistics = FlightService().get_flight_statistics([self.__flight.pk])
+        self.__statistic = statistics.get(self.__flight.pk, self.empty_statistic())
 
     def numberOfEmptySeat(self) -> int:
-        return self.__numberOfEmptySeat
+        return self.__statistic['empty']
     
     def numberOfAllSeat(self) -> int:
-        return self.__numberOfSeat
+        return self.__statistic['seats']
     
     def numberOfBookedSeat(self) -> int:
-        return self.__numberOfSeat - self.__numberOfEmptySeat
+        return self.__statistic['booked']
 
     def ratio(self) -> float:
-        return self.numberOfBookedSeat()/ self.numberOfAllSeat()
+        return self.__statistic['ratio']
 
     def turnover(self) -> int:
-        return self.__turnover
-
-
+        return self.__statistic['turnover']
@@ -0,0 +1,36 @@
+// Airport typeahead, see AirportTypeahead in main/forms.py
+document.querySelectorAll('input[data-typeahead-url]').forEach(function (input) {
+    var target = document.getElementById(input.dataset.typeaheadTarget)
+    var list = document.getElementById(input.getAttribute('list'))
+    var timer = null
+
+    input.addEventListener('input', function () {
+        var chosen = Array.prototype.find.call(list.options, function (option) {
+            return option.value === input.value
+        })
+        target.value = chosen ? chosen.dataset.id : ''
+        if (chosen) {
+            return
+        }
+
+        clearTimeout(timer)
+        timer = setTimeout(function () {
+            if (!input.value) {
+                list.innerHTML = ''
+                return
+            }
+
+            fetch(input.dataset.typeaheadUrl + '?q=' + encodeURIComponent(input.value))
+                .then(function (response) { return response.json() })
+                .then(function (data) {
+                    list.innerHTML = ''
+                    data.results.forEach(function (airport) {
+                        var option = document.createElement('option')
+                        option.value = airport.name
+                        option.dataset.id = airport.id
+                        list.appendChild(option)
+                    })
+                })
+        }, 150)
+    })
+})